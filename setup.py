@@ -37,6 +37,7 @@ setuptools.setup(
         "zstandard==0.22.0",
         "transformers==4.41.2",
         "datasets==2.18.0",
+        "pyahocorasick==2.1.0",
     ],
     python_requires=">=3.10",
 )
@@ -0,0 +1,151 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import multiprocessing as mp
+import numpy as np
+
+from zyda.connected_components.generate_connected_components import (
+    ENGINES,
+    add_pairs,
+    construct_graph,
+    find_connected_components,
+    save_components,
+    union_find_components,
+)
+from zyda.utils.doc_ids import pack_doc_ids
+from zyda.utils.pairs import BinaryPairWriter
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+# Number of distinct edges generated at once
+CHUNK_SIZE = 1 << 22
+
+
+def generate_pairs_files(args, out_dir: str) -> List[str]:
+    """
+    Writes synthetic pairs files of --bands bands. Edges link documents to documents at most --window rows before them,
+    and every band has each edge with probability --edge-probability, so that edges are repeated across bands as in LSH.
+    """
+    files = [os.path.join(out_dir, f"pairs-{band}.pairs") for band in range(args.bands)]
+    writers = [BinaryPairWriter(path) for path in files]
+    for chunk, start in enumerate(range(0, args.num_edges, CHUNK_SIZE)):
+        rng = np.random.default_rng([args.seed, chunk])
+        n = min(CHUNK_SIZE, args.num_edges - start)
+        rows = rng.integers(1, args.num_docs, size=n)
+        a = pack_doc_ids(0, rows)
+        b = pack_doc_ids(0, np.maximum(rows - rng.integers(1, args.window + 1, size=n), 0))
+        for writer in writers:
+            kept = rng.random(n) < args.edge_probability
+            reversed_ = rng.random(n) < 0.5
+            writer.write(np.where(reversed_, b, a)[kept], np.where(reversed_, a, b)[kept])
+    for writer in writers:
+        writer.close()
+    return files
+
+
+def peak_memory() -> int:
+    """
+    Returns peak resident memory of this process in bytes.
+    """
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def networkit_components(files: List[str]):
+    # the in-memory part of generate_connected_components.py --engine networkit, without its intermediate files
+    set_of_duplicate_pairs = set()
+    for file in files:
+        add_pairs(set_of_duplicate_pairs, file)
+    G, mapper = construct_graph(set_of_duplicate_pairs)
+    del set_of_duplicate_pairs
+    components, n_components = find_connected_components(G)
+    reverse_mapper = np.empty(len(mapper), dtype=np.uint64)
+    reverse_mapper[np.fromiter(mapper.values(), dtype=np.int64, count=len(mapper))] = np.fromiter(mapper.keys(), dtype=np.uint64, count=len(mapper))
+    return components, n_components, reverse_mapper
+
+
+def run_engine(engine: str, files: List[str], out_file: str, results: mp.Queue):
+    t0 = time.time()
+    if engine == "union-find":
+        components, n_components, reverse_mapper = union_find_components(files)
+    else:
+        components, n_components, reverse_mapper = networkit_components(files)
+    elapsed = time.time() - t0
+    save_components(out_file, components, n_components, reverse_mapper)
+    results.put((elapsed, peak_memory()))
+
+
+def component_labels(out_file: str) -> np.ndarray:
+    """
+    Returns the smallest document id of the component of every document, ordered by document id.
+    """
+    with open(out_file, "rb") as f:
+        components, _, reverse_mapper = pickle.load(f)
+    sizes = np.array([len(component) for component in components], dtype=np.int64)
+    doc_ids = reverse_mapper[np.fromiter((node for component in components for node in component), dtype=np.int64, count=sizes.sum())]
+    labels = np.repeat(np.minimum.reduceat(doc_ids, np.cumsum(sizes) - sizes) if len(sizes) else doc_ids, sizes)
+    return labels[np.argsort(doc_ids)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares connected components engines of generate_connected_components.py on synthetic pairs")
+    parser.add_argument('--num-docs', type=int, default=20_000_000, help='Number of synthetic documents')
+    parser.add_argument('--num-edges', type=int, default=5_000_000, help='Number of distinct synthetic edges')
+    parser.add_argument('--window', type=int, default=1000, help='Maximum distance in rows between linked documents')
+    parser.add_argument('--bands', type=int, default=8, help='Number of pairs files, one per band')
+    parser.add_argument('--edge-probability', type=float, default=0.5, help='Probability of an edge being found in a band')
+    parser.add_argument('--tmp-dir', type=str, default=tempfile.gettempdir(), help='Folder for synthetic pairs files and components')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating edges')
+    parser.add_argument('--engines', nargs='+', type=str, default=ENGINES, choices=ENGINES, help='Engines to run')
+    parser.add_argument('--check', action='store_true', help='Check that all engines find the same components')
+    args = parser.parse_args()
+    print()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        t0 = time.time()
+        files = generate_pairs_files(args, tmp_dir)
+        size = sum(os.path.getsize(file) for file in files)
+        logging.info(f"Generated pairs of {args.num_edges} edges in {args.bands} bands ({size / 2**20:.1f}MB) in {time.time() - t0:.1f}s")
+
+        labels = {}
+        for engine in args.engines:
+            # every engine runs in its own process, so that its peak memory is measured separately
+            out_file = os.path.join(tmp_dir, f"cc-{engine}.pickle")
+            results = mp.Queue()
+            p = mp.Process(target=run_engine, args=(engine, files, out_file, results))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError(f"{engine} failed with exit code {p.exitcode}")
+            elapsed, memory = results.get()
+            logging.info(f"{engine}: {args.num_edges * args.bands * args.edge_probability / elapsed / 1e6:.2f}M edges/sec, {elapsed:.1f}s, peak {memory / 2**20:.1f}MB")
+            if args.check:
+                labels[engine] = component_labels(out_file)
+
+        if args.check and len(labels) > 1:
+            reference = labels[args.engines[0]]
+            for engine, engine_labels in labels.items():
+                if not np.array_equal(engine_labels, reference):
+                    raise AssertionError(f"{engine} found different components than {args.engines[0]}")
+            logging.info(f"All engines found the same components of {len(reference)} documents")
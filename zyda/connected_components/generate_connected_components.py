@@ -13,11 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
 from glob import glob
 import argparse
 import pickle
 import os
+import numpy as np
 import networkit as nk
 import tqdm
 import subprocess
@@ -27,10 +28,14 @@ import gc
 import logging
 logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
 
+from zyda.connected_components.union_find import NodeMapper, UnionFind, group_components
 from zyda.utils.common import ensure_directory_exists
+from zyda.utils.pairs import read_pairs
 
+ENGINES = ["union-find", "networkit"]
 
-def construct_graph(set_of_duplicate_pairs: set) -> Tuple[nk.Graph, Dict[str, int]]:
+
+def construct_graph(set_of_duplicate_pairs: set) -> Tuple[nk.Graph, Dict[int, int]]:
     G = nk.Graph()
     mapper = {}
     for pair in tqdm.tqdm(set_of_duplicate_pairs, desc="Bulding graph", unit="dupes", unit_scale=True):
@@ -58,6 +63,51 @@ def count_file_lines(fname: str) -> int:
     return int(result.strip().split()[0])
 
 
+def add_pairs(set_of_duplicate_pairs: set, file: str, total: Optional[int] = None, position: Optional[int] = None):
+    # pairs files of both formats are read in chunks of uint64 arrays
+    with tqdm.tqdm(total=total, desc=file, unit="dupes", unit_scale=True, position=position) as pbar:
+        for pairs in read_pairs(file):
+            pbar.update(len(pairs))
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+            set_of_duplicate_pairs.update(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+
+
+def list_pairs_files(input_dir: str) -> List[str]:
+    return sorted(glob(f"{input_dir}/*.txt") + glob(f"{input_dir}/*.pairs"))
+
+
+def union_find_components(files: List[str]) -> Tuple[List[List[int]], int, np.ndarray]:
+    """
+    Streams pairs of all files into a union-find over nodes numbered from document ids, without keeping the pairs.
+    Returns components as lists of nodes, their number, and document ids indexed by node.
+    """
+    mapper = NodeMapper()
+    union_find = UnionFind()
+    for file in files:
+        with tqdm.tqdm(desc=file, unit="dupes", unit_scale=True) as pbar:
+            for pairs in read_pairs(file):
+                pbar.update(len(pairs))
+                pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+                nodes = mapper.nodes(pairs.reshape(-1)).reshape(-1, 2)
+                union_find.grow(len(mapper))
+                union_find.union(nodes[:, 0], nodes[:, 1])
+    labels = union_find.labels().copy()
+    reverse_mapper = mapper.reverse_mapper()
+    # the hash table of document ids is freed before components are built as Python lists
+    del union_find, mapper
+    gc.collect()
+    logging.info(f"Grouping {len(labels)} documents into connected components...")
+    components = group_components(labels)
+    return components, len(components), reverse_mapper
+
+
+def save_components(out_file: str, components: List[List[int]], n_components: int, reverse_mapper: np.ndarray):
+    logging.info(f"Saving connected components to {out_file}...")
+    ensure_directory_exists(out_file)
+    with open(out_file, "wb") as fout:
+        pickle.dump((components, n_components, reverse_mapper), fout, protocol=5)
+
+
 def process_files(args: Tuple[int, str, bool, List[str]]) -> str:
     set_of_duplicate_pairs = set()
     pid = args[0]
@@ -72,11 +122,7 @@ def process_files(args: Tuple[int, str, bool, List[str]]) -> str:
         return save_path, None
 
     for file in files:
-        with open(file, "r") as f:
-            for line in tqdm.tqdm(f, desc=file, unit="dupes", unit_scale=True, position=pid):
-                pair = tuple(line.strip().split(" :: "))
-                if pair[0] != pair[1]:
-                    set_of_duplicate_pairs.add(pair)
+        add_pairs(set_of_duplicate_pairs, file, position=pid)
     
     desc = f"Saving set to {save_path}"
     ensure_directory_exists(save_path)
@@ -93,14 +139,10 @@ def get_set_of_duplicate_pairs(set_save_path: str, from_scratch: bool) -> set:
         logging.info(f"Counting lines in {set_save_path}")
         total_lines = count_file_lines(set_save_path)
         logging.info(f"Constructing set of duplicates from {set_save_path}")
-        with open(set_save_path, "r") as f:
-            for line in tqdm.tqdm(f, total=total_lines, unit="docs", unit_scale=True):
-                pair = tuple(line.strip().split(" :: "))
-                if pair[0] != pair[1]:
-                    set_of_duplicate_pairs.add(pair)
+        add_pairs(set_of_duplicate_pairs, set_save_path, total=total_lines)
     else:
         # Need to generate a set of duplicates
-        all_files = sorted(glob(f"{args.input_dir}/*.txt"))
+        all_files = list_pairs_files(args.input_dir)
         workers_files = [[] for _ in range(args.workers)]
         for i, file in enumerate(all_files):
             workers_files[i % args.workers].append(file)
@@ -115,11 +157,7 @@ def get_set_of_duplicate_pairs(set_save_path: str, from_scratch: bool) -> set:
         logging.info("Processing sets from workers")
         logging.info("Constructing final set")
         for file, total_pairs in sets_files:
-            with open(file, "r") as f:
-                for line in tqdm.tqdm(f, total=total_pairs, desc=file, unit="dupes", unit_scale=True):
-                    pair = tuple(line.strip().split(" :: "))
-                    if pair[0] != pair[1]:
-                        set_of_duplicate_pairs.add(pair)
+            add_pairs(set_of_duplicate_pairs, file, total=total_pairs)
 
         desc = f"Saving final set to {set_save_path}..."
         ensure_directory_exists(set_save_path)
@@ -130,6 +168,16 @@ def get_set_of_duplicate_pairs(set_save_path: str, from_scratch: bool) -> set:
     return set_of_duplicate_pairs
 
 
+def generate_connected_components_union_find(args):
+    print()
+    files = list_pairs_files(args.input_dir)
+    logging.info(f"Streaming duplicate pairs of {len(files)} files into union-find...")
+    components, n_components, reverse_mapper = union_find_components(files)
+    logging.info(f"Number of connected components: {n_components}")
+    save_components(args.out_file, components, n_components, reverse_mapper)
+    logging.info("Done!")
+
+
 def generate_connected_components_mp(args):
     print()
     nk.setNumberOfThreads(args.nk_threads)
@@ -172,16 +220,15 @@ def generate_connected_components_mp(args):
     gc.collect()
     logging.info(f"Number of connected components: {n_components}")
 
+    # nodes are numbered from 0 in the order they were added, so the reverse mapper is an array of document ids indexed by node
     logging.info("Building reverse mapper...")
-    reverse_mapper = {value: key for key, value in tqdm.tqdm(mapper.items(), unit="docs", unit_scale=True)}
+    reverse_mapper = np.empty(len(mapper), dtype=np.uint64)
+    reverse_mapper[np.fromiter(mapper.values(), dtype=np.int64, count=len(mapper))] = np.fromiter(mapper.keys(), dtype=np.uint64, count=len(mapper))
     del mapper
     gc.collect()
 
     # dump pickled cc on disk and load if needed
-    logging.info(f"Saving connected components to {args.out_file}...")
-    ensure_directory_exists(args.out_file)
-    with open(args.out_file, "wb") as fout:
-        pickle.dump((components, n_components, reverse_mapper), fout, protocol=5)
+    save_components(args.out_file, components, n_components, reverse_mapper)
     logging.info("Done!")
 
 
@@ -192,8 +239,16 @@ if __name__ == "__main__":
         "--out-file", type=str, required=True, 
         help="Output pickle file to save connected components. Prefix will be used for saving intermediate things as well (sets of duplicates, graph)"
     )
+    parser.add_argument(
+        "--engine", type=str, default="union-find", choices=ENGINES,
+        help="union-find streams pairs into arrays of integer nodes without intermediate files. networkit builds a set of distinct pairs "
+             "and a graph first, saving them next to --out-file, and uses the options below"
+    )
     parser.add_argument("--workers", type=int, default=1, help="Number of workers for processing text files with duplicate pairs")
     parser.add_argument("--nk-threads", type=int, default=96, help="Number of threads for graph processing")
     parser.add_argument("--from-scratch", action="store_true", help="Start from scratch ignoring any intermediate files")
     args = parser.parse_args()
-    generate_connected_components_mp(args)
+    if args.engine == "union-find":
+        generate_connected_components_union_find(args)
+    else:
+        generate_connected_components_mp(args)
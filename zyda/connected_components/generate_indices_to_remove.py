@@ -19,6 +19,8 @@ from collections import defaultdict
 
 import tqdm
 
+from zyda.utils.doc_ids import DocRegistry
+
 import logging
 logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
 
@@ -37,16 +39,21 @@ def generate_duplicates(args):
     with open(args.input_file, "rb") as fin:
         components, n_components, reverse_mapper = pickle.load(fin)
 
+    # components only have document ids, their dataset names and indices are looked up in minhash shards
+    logging.info(f"Looking up {len(reverse_mapper)} documents in datasets of {args.registry}")
+    registry = DocRegistry.load(args.registry)
+    columns = registry.key_columns(reverse_mapper)
+    names, shards, shard_inds, global_inds = columns["dataset_name"], columns["shard"], columns["shard_index"], columns["global_index"]
+
     logging.info("Processing connected components...")
     duplicates = defaultdict(set)
     n_duplicate_docs = 0
     for component in tqdm.tqdm(components, unit="components", unit_scale=True):
         if args.ranking:
-            component.sort(key=lambda x: ranking[reverse_mapper[x].split("@")[0]])
+            component.sort(key=lambda x: ranking[names[x]])
         for j in range(1, len(component)):
-            doc = reverse_mapper[component[j]]
-            file_name, shard, shard_index, global_index = doc.split("@")
-            duplicates[file_name].add((int(shard), int(shard_index), int(global_index)))
+            node = component[j]
+            duplicates[names[node]].add((int(shards[node]), int(shard_inds[node]), int(global_inds[node])))
             n_duplicate_docs += 1
 
     logging.info(f"Total number of duplicate documents that will be removed: {n_duplicate_docs}")
@@ -63,6 +70,10 @@ def generate_duplicates(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-file", type=str, required=True, help="Input pickle file with connected components")
+    parser.add_argument(
+        "--registry", type=str, required=True,
+        help="Registry of datasets saved by build_lsh_index.py next to duplicate pairs (<dupes out name>-registry.json)"
+    )
     parser.add_argument("--out-file", type=str, required=True, help="Output pickle file to save indices of duplicates to remove")
     parser.add_argument("--ranking", nargs="+", type=str, help="Ranking of datasets for choosing a single document from a component")
     
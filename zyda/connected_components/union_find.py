@@ -0,0 +1,126 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+import numpy as np
+
+from zyda.lsh_minhash.band_index import MIN_CAPACITY, BandIndex
+from zyda.utils.doc_ids import NO_DOC
+
+
+class NodeMapper:
+    """
+    Numbers uint64 document ids from 0 as they are first seen, keeping ids in a BandIndex as a hash table of ids to nodes.
+    New ids of a batch are numbered in increasing order of ids.
+    """
+    def __init__(self):
+        self.index = BandIndex()
+
+    def __len__(self):
+        return len(self.index)
+
+    def nodes(self, doc_ids: np.ndarray) -> np.ndarray:
+        """
+        Returns nodes of document ids, numbering ids that were not seen before.
+        """
+        nodes = self.index.get(doc_ids)
+        # pairs of later bands mostly repeat documents of earlier ones, so only ids that were not found are sorted
+        missing = np.flatnonzero(nodes == NO_DOC)
+        if len(missing):
+            new_ids, inverse = np.unique(doc_ids[missing], return_inverse=True)
+            new_nodes = np.arange(len(self), len(self) + len(new_ids), dtype=np.uint64)
+            self.index.get_or_insert(new_ids, new_nodes)
+            nodes[missing] = new_nodes[inverse.reshape(-1)]
+        return nodes.astype(np.int64)
+
+    def reverse_mapper(self) -> np.ndarray:
+        """
+        Returns document ids indexed by node.
+        """
+        entries = self.index.entries()
+        reverse_mapper = np.empty(len(entries), dtype=np.uint64)
+        reverse_mapper[entries["doc"].astype(np.int64)] = entries["key"]
+        return reverse_mapper
+
+
+class UnionFind:
+    """
+    Disjoint sets of nodes numbered from 0, kept as an array of parents with all operations vectorized over batches of edges.
+    Every set is a tree whose root is its smallest node, so linking roots of a batch never creates cycles, also when several
+    edges link the same root and only one of them is written. Edges within a set, including repeated ones, are skipped.
+    """
+    def __init__(self, capacity: int = MIN_CAPACITY):
+        self.parent = np.arange(capacity, dtype=np.int64)
+        self.num_nodes = 0
+
+    def __len__(self):
+        return self.num_nodes
+
+    def grow(self, num_nodes: int):
+        """
+        Adds nodes up to num_nodes, each of them in its own set.
+        """
+        capacity = len(self.parent)
+        while num_nodes > capacity:
+            capacity *= 2
+        if capacity > len(self.parent):
+            self.parent = np.concatenate([self.parent, np.arange(len(self.parent), capacity, dtype=np.int64)])
+        self.num_nodes = max(self.num_nodes, num_nodes)
+
+    def find(self, nodes: np.ndarray) -> np.ndarray:
+        """
+        Returns roots of nodes, and points nodes directly to their roots.
+        """
+        roots = self.parent[nodes]
+        while True:
+            grandparents = self.parent[roots]
+            if np.array_equal(grandparents, roots):
+                break
+            roots = grandparents
+        self.parent[nodes] = roots
+        return roots
+
+    def union(self, a: np.ndarray, b: np.ndarray):
+        """
+        Merges sets of nodes a[i] and b[i] for all edges i.
+        """
+        while len(a):
+            a, b = self.find(a), self.find(b)
+            pending = a != b
+            a, b = a[pending], b[pending]
+            # of several writes to the same root one wins, and the other edges are linked again from the new roots
+            self.parent[np.maximum(a, b)] = np.minimum(a, b)
+
+    def labels(self) -> np.ndarray:
+        """
+        Returns the root of every node, which is the smallest node of its set.
+        """
+        parent = self.parent[:self.num_nodes]
+        while True:
+            grandparents = parent[parent]
+            if np.array_equal(grandparents, parent):
+                break
+            parent = grandparents
+        self.parent[:self.num_nodes] = parent
+        return parent
+
+
+def group_components(labels: np.ndarray) -> List[List[int]]:
+    """
+    Returns lists of nodes with the same label, ordered by their smallest node, with nodes of every component in increasing order.
+    """
+    order = np.argsort(labels, kind="stable")
+    bounds = [0] + (np.flatnonzero(np.diff(labels[order])) + 1).tolist() + [len(order)]
+    order = order.tolist()
+    return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
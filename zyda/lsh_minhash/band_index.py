@@ -0,0 +1,401 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Iterator, Optional, Sequence, Tuple
+import os
+import numpy as np
+
+from zyda.lsh_minhash.minhash import mix64
+from zyda.utils.doc_ids import NO_DOC
+
+EMPTY = np.uint64(0)
+MIN_CAPACITY = 1 << 16
+MAX_LOAD_FACTOR = 0.7
+# Band indexes are saved as arrays of (band key, document id) sorted by band key
+INDEX_DTYPE = np.dtype([("key", "<u8"), ("doc", "<u8")])
+# Peak bytes per record while sorting a partition of SpilledBandIndex: the records, keys and ids being sorted, the sort order and copies
+SORT_BYTES_PER_RECORD = 64
+# Number of entries copied at once from spilled entries to the output file
+COPY_CHUNK_SIZE = 1 << 22
+
+
+def load_entries(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode="r")
+
+
+def save_entries(path: str, entries: np.ndarray):
+    # written to a temporary file first, so that a file with this path is always complete
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, entries)
+    os.replace(tmp_path, path)
+
+
+class BandIndex:
+    """
+    Open-addressing hash table with linear probing, mapping uint64 band keys to uint64 ids of the first document
+    seen with that key. Keys and values are stored in two parallel arrays, i.e. 16 bytes per slot, and all operations
+    are vectorized over batches of documents.
+
+    Slots with key 0 are empty, so a band key equal to 0 is kept separately in zero_value.
+    """
+    def __init__(self, capacity: int = MIN_CAPACITY):
+        capacity = 1 << (max(MIN_CAPACITY, int(np.ceil(capacity))) - 1).bit_length()
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+        self.zero_value = NO_DOC
+
+    def __len__(self):
+        return self.size + (self.zero_value != NO_DOC)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.values.nbytes
+
+    @staticmethod
+    def peak_nbytes(num_entries: int) -> int:
+        """
+        Returns peak memory of an index growing to num_entries: when it is resized to its final capacity,
+        old arrays and copies of their entries are alive together with the new ones.
+        """
+        capacity = MIN_CAPACITY
+        while num_entries > MAX_LOAD_FACTOR * capacity:
+            capacity *= 2
+        return 2 * 8 * (capacity + capacity // 2 + num_entries)
+
+    def _slots(self, keys: np.ndarray) -> np.ndarray:
+        return (mix64(keys) & np.uint64(len(self.keys) - 1)).astype(np.int64)
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Returns slots of non-zero keys: either the slot holding the key, or the empty slot where the probe ended.
+        """
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        mask = len(self.keys) - 1
+        while len(pending):
+            found = self.keys[slots[pending]]
+            pending = pending[(found != keys[pending]) & (found != EMPTY)]
+            slots[pending] = (slots[pending] + 1) & mask
+        return slots
+
+    def get(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Returns ids of documents stored for keys, or NO_DOC for keys not in the index.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        result = np.full(len(keys), NO_DOC, dtype=np.uint64)
+        nonzero = keys != EMPTY
+        slots = self._find(keys[nonzero])
+        result[nonzero] = np.where(self.keys[slots] == keys[nonzero], self.values[slots], NO_DOC)
+        result[~nonzero] = self.zero_value
+        return result
+
+    def _insert_new(self, keys: np.ndarray, values: np.ndarray):
+        # keys are unique, non-zero and not in the index yet
+        self._reserve(self.size + len(keys))
+        mask = len(self.keys) - 1
+        slots = self._find(keys)
+        pending = np.arange(len(keys))
+        while len(pending):
+            # several keys may end their probes at the same empty slot: the first one takes it, others probe further
+            _, first = np.unique(slots[pending], return_index=True)
+            winners = pending[first]
+            self.keys[slots[winners]] = keys[winners]
+            self.values[slots[winners]] = values[winners]
+            losers = np.setdiff1d(pending, winners, assume_unique=True)
+            slots[losers] = (slots[losers] + 1) & mask
+            while len(losers):
+                occupied = self.keys[slots[losers]] != EMPTY
+                if not occupied.any():
+                    break
+                slots[losers[occupied]] = (slots[losers[occupied]] + 1) & mask
+            pending = losers
+        self.size += len(keys)
+
+    def _reserve(self, size: int):
+        if size <= MAX_LOAD_FACTOR * len(self.keys):
+            return
+        capacity = len(self.keys)
+        while size > MAX_LOAD_FACTOR * capacity:
+            capacity *= 2
+        occupied = self.keys != EMPTY
+        keys, values = self.keys[occupied], self.values[occupied]
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+        self._insert_new(keys, values)
+
+    def get_or_insert(self, keys: np.ndarray, values: np.ndarray, insert: bool = True) -> np.ndarray:
+        """
+        Processes documents in order: returns the id stored for every key, or NO_DOC if the key was not in the index,
+        in which case the document's id is inserted. A key repeated within the batch returns the id of its first occurrence.
+        With insert=False nothing is inserted, and repeated keys within the batch return NO_DOC as well.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        values = np.asarray(values, dtype=np.uint64)
+        result = self.get(keys)
+        if not insert:
+            return result
+
+        new = np.flatnonzero(result == NO_DOC)
+        unique_keys, first, inverse = np.unique(keys[new], return_index=True, return_inverse=True)
+        first_ids = values[new[first]]
+        # later occurrences of a new key get the id of the first one, which is the one inserted
+        result[new] = first_ids[inverse]
+        result[new[first]] = NO_DOC
+
+        if len(unique_keys) and unique_keys[0] == EMPTY:
+            self.zero_value = first_ids[0]
+            unique_keys, first_ids = unique_keys[1:], first_ids[1:]
+        self._insert_new(unique_keys, first_ids)
+        return result
+
+    def entries(self) -> np.ndarray:
+        """
+        Returns (key, doc) entries of the index sorted by key.
+        """
+        occupied = self.keys != EMPTY
+        keys, docs = self.keys[occupied], self.values[occupied]
+        if self.zero_value != NO_DOC:
+            keys = np.concatenate([[EMPTY], keys])
+            docs = np.concatenate([[self.zero_value], docs])
+        order = np.argsort(keys)
+        entries = np.empty(len(keys), dtype=INDEX_DTYPE)
+        entries["key"] = keys[order]
+        entries["doc"] = docs[order]
+        return entries
+
+    def save(self, path: str):
+        # saved as sorted entries rather than the table, so that the file can be memory-mapped and read by key ranges
+        save_entries(path, self.entries())
+
+    @classmethod
+    def from_entries(cls, entries: np.ndarray) -> "BandIndex":
+        index = cls(len(entries) / MAX_LOAD_FACTOR)
+        keys, docs = np.asarray(entries["key"]), np.asarray(entries["doc"])
+        if len(keys) and keys[0] == EMPTY:
+            index.zero_value = docs[0]
+            keys, docs = keys[1:], docs[1:]
+        index._insert_new(keys, docs)
+        return index
+
+    @classmethod
+    def load(cls, path: str) -> "BandIndex":
+        return cls.from_entries(load_entries(path))
+
+
+def get_partition_bits(num_records: int, memory_budget: int) -> int:
+    """
+    Returns the number of top bits of keys defining partitions small enough to be sorted within the memory budget.
+    """
+    num_partitions = max(1, int(np.ceil(num_records * SORT_BYTES_PER_RECORD / memory_budget)))
+    return (num_partitions - 1).bit_length()
+
+
+def append_partitions(records: np.ndarray, partitions: np.ndarray, files: list):
+    """
+    Appends every record to the file of its partition, keeping the order of records within a partition.
+    """
+    order = np.argsort(partitions, kind="stable")
+    bounds = np.searchsorted(partitions[order], np.arange(len(files) + 1))
+    for p in np.flatnonzero(np.diff(bounds)):
+        records[order[bounds[p]:bounds[p + 1]]].tofile(files[p])
+
+
+def partition_bounds(sorted_keys: np.ndarray, partition_bits: int) -> np.ndarray:
+    """
+    Returns positions where partitions start in sorted keys, and the end of the last one.
+    """
+    if partition_bits == 0:
+        return np.array([0, len(sorted_keys)])
+    starts = np.arange(1 << partition_bits, dtype=np.uint64) << np.uint64(64 - partition_bits)
+    return np.append(np.searchsorted(sorted_keys, starts), len(sorted_keys))
+
+
+def save_raw_entries(raw_path: str, num_entries: int, out_path: str):
+    """
+    Saves entries written to a raw binary file as .npy file, atomically and without loading them into memory.
+    """
+    if num_entries == 0:
+        save_entries(out_path, np.empty(0, dtype=INDEX_DTYPE))
+        return
+    tmp_path = os.path.join(os.path.dirname(out_path), f".{os.path.basename(out_path)}.tmp")
+    raw_entries = np.memmap(raw_path, dtype=INDEX_DTYPE, mode="r", shape=(num_entries,))
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=INDEX_DTYPE, shape=(num_entries,))
+    for start in range(0, num_entries, COPY_CHUNK_SIZE):
+        out[start:start + COPY_CHUNK_SIZE] = raw_entries[start:start + COPY_CHUNK_SIZE]
+    out.flush()
+    del out, raw_entries
+    os.replace(tmp_path, out_path)
+
+
+def merge_entries(segments: Sequence[np.ndarray], out_path: str, memory_budget: int, tmp_dir: str) -> int:
+    """
+    Merges sorted entries of several segments into one sorted segment, one range of keys at a time so that it fits
+    into the memory budget. If a key is in several segments, the entry of the earliest segment is kept.
+    Returns the number of entries saved to out_path.
+    """
+    partition_bits = get_partition_bits(sum(len(segment) for segment in segments), memory_budget)
+    bounds = [partition_bounds(segment["key"], partition_bits) for segment in segments]
+    raw_path = os.path.join(tmp_dir, f".{os.path.basename(out_path)}.raw")
+    num_entries = 0
+    with open(raw_path, "wb") as f:
+        for p in range(1 << partition_bits):
+            entries = np.concatenate([np.asarray(segment[b[p]:b[p + 1]]) for segment, b in zip(segments, bounds)])
+            entries = entries[np.argsort(entries["key"], kind="stable")]
+            firsts = np.concatenate([[True], entries["key"][1:] != entries["key"][:-1]]) if len(entries) else np.zeros(0, dtype=bool)
+            entries[firsts].tofile(f)
+            num_entries += int(firsts.sum())
+    save_raw_entries(raw_path, num_entries, out_path)
+    os.remove(raw_path)
+    return num_entries
+
+
+class SpilledBandIndex:
+    """
+    Out-of-core alternative to BandIndex that builds a band within a memory budget. Documents are appended as (key, doc)
+    records to run files of partitions on local disk, and then every partition is sorted on its own. Partitions are ranges
+    of top bits of keys, so sorted partitions concatenated in order give sorted entries of the whole band.
+
+    A sort is stable, so within a key records stay in the order documents were added, and the first of them is the document
+    BandIndex would have kept: both produce the same duplicate pairs.
+    """
+    def __init__(self, spill_dir: str, num_records: int, memory_budget: int):
+        self.partition_bits = get_partition_bits(num_records, memory_budget)
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.files = [open(self._run_path(p), "wb") for p in range(self.num_partitions)]
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def num_partitions(self) -> int:
+        return 1 << self.partition_bits
+
+    @property
+    def nbytes(self) -> int:
+        # bytes spilled to disk
+        return self.size * INDEX_DTYPE.itemsize
+
+    def _run_path(self, partition: int) -> str:
+        return os.path.join(self.spill_dir, f"run-{partition:05d}.bin")
+
+    def _partitions(self, keys: np.ndarray) -> np.ndarray:
+        if self.partition_bits == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        return (keys >> np.uint64(64 - self.partition_bits)).astype(np.int64)
+
+    def add(self, keys: np.ndarray, doc_ids: np.ndarray):
+        records = np.empty(len(keys), dtype=INDEX_DTYPE)
+        records["key"] = keys
+        records["doc"] = doc_ids
+        append_partitions(records, self._partitions(records["key"]), self.files)
+        self.size += len(keys)
+
+    def merge(
+        self,
+        segments: Sequence[np.ndarray] = (),
+        check_only: bool = False,
+        out_path: Optional[str] = None,
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Sorts partitions one by one and yields (doc ids, candidate doc ids) of duplicate pairs found in each of them.
+        Sorted entries of existing segments with distinct keys, e.g. memory-mapped files, come before all added documents.
+        With check_only, added documents are only matched against existing entries. Otherwise, new entries, i.e. the ones
+        of keys that are not in existing segments, are saved to out_path.
+        """
+        for f in self.files:
+            f.close()
+        bounds = [partition_bounds(segment["key"], self.partition_bits) for segment in segments]
+        entries_path = os.path.join(self.spill_dir, "entries.bin")
+        num_entries = 0
+        with open(entries_path, "wb") as entries_file:
+            for p in range(self.num_partitions):
+                records = np.fromfile(self._run_path(p), dtype=INDEX_DTYPE)
+                os.remove(self._run_path(p))
+                old = [np.asarray(segment[b[p]:b[p + 1]]) for segment, b in zip(segments, bounds)]
+                n_old = sum(len(x) for x in old)
+                keys = np.concatenate([x["key"] for x in old] + [records["key"]])
+                docs = np.concatenate([x["doc"] for x in old] + [records["doc"]])
+                is_old = np.arange(len(keys)) < n_old
+                del records, old
+
+                order = np.argsort(keys, kind="stable")
+                keys, docs, is_old = keys[order], docs[order], is_old[order]
+                del order
+                firsts = np.concatenate([[True], keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=bool)
+                groups = np.cumsum(firsts) - 1
+                # keys of existing segments are unique and come first, so all other records of a key are added documents
+                if check_only:
+                    matches = ~firsts & is_old[firsts][groups]
+                else:
+                    matches = ~firsts
+                yield docs[matches], docs[firsts][groups[matches]]
+
+                if not check_only:
+                    new = firsts & ~is_old
+                    entries = np.empty(int(new.sum()), dtype=INDEX_DTYPE)
+                    entries["key"] = keys[new]
+                    entries["doc"] = docs[new]
+                    entries.tofile(entries_file)
+                    num_entries += len(entries)
+
+        if out_path is not None and not check_only:
+            save_raw_entries(entries_path, num_entries, out_path)
+        os.remove(entries_path)
+
+
+class SegmentedBandIndex:
+    """
+    Band of an LSH index stored in the style of an LSM tree: immutable segments of sorted (key, doc) entries with distinct keys,
+    which are memory-mapped and searched with binary search, and an in-memory BandIndex for keys of new documents,
+    which becomes a new segment when it is saved.
+    """
+    def __init__(self, segments: Sequence[np.ndarray] = ()):
+        self.segments = list(segments)
+        self.memtable = BandIndex()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments) + len(self.memtable)
+
+    @property
+    def nbytes(self) -> int:
+        # segments are memory-mapped, so only the in-memory part counts
+        return self.memtable.nbytes
+
+    def get(self, keys: np.ndarray) -> np.ndarray:
+        keys = np.asarray(keys, dtype=np.uint64)
+        result = np.full(len(keys), NO_DOC, dtype=np.uint64)
+        for segment in self.segments:
+            if len(segment) == 0:
+                continue
+            segment_keys = segment["key"]
+            positions = np.minimum(np.searchsorted(segment_keys, keys), len(segment) - 1)
+            found = np.flatnonzero(segment_keys[positions] == keys)
+            result[found] = segment["doc"][positions[found]]
+        return result
+
+    def get_or_insert(self, keys: np.ndarray, values: np.ndarray, insert: bool = True) -> np.ndarray:
+        """
+        Same as BandIndex.get_or_insert(), where keys found in segments are never inserted into the memtable.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        values = np.asarray(values, dtype=np.uint64)
+        result = self.get(keys)
+        missing = np.flatnonzero(result == NO_DOC)
+        result[missing] = self.memtable.get_or_insert(keys[missing], values[missing], insert=insert)
+        return result
@@ -0,0 +1,154 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+import numpy as np
+
+from zyda.lsh_minhash.band_index import BandIndex, SpilledBandIndex, load_entries
+from zyda.lsh_minhash.minhash import band_keys
+from zyda.utils.doc_ids import NO_DOC
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+def generate_band(args) -> np.ndarray:
+    """
+    Returns minhash values of one band of synthetic documents, of which a fraction duplicates the band of an earlier document.
+    """
+    rng = np.random.default_rng(args.seed)
+    band = rng.integers(0, 2**32, size=(args.num_docs, args.range), dtype=np.uint64)
+    duplicates = np.flatnonzero(rng.random(args.num_docs) < args.duplicate_fraction)
+    duplicates = duplicates[duplicates > 0]
+    band[duplicates] = band[rng.integers(0, duplicates)]
+    return band
+
+
+def benchmark_band_index(args):
+    band = generate_band(args)
+    doc_keys = [f"synthetic@{i // 100_000}@{i % 100_000}@{i}" for i in range(args.num_docs)]
+    batches = range(0, args.num_docs, args.batch_size)
+
+    # reference: dict of big-endian band bytes to document keys, as built by lsh_process() before
+    t0 = time.time()
+    lsh_dict = defaultdict(str)
+    reference = []
+    for start in batches:
+        rows = np.ascontiguousarray(band[start:start + args.batch_size], dtype=">u8").view(np.uint8)
+        data, width = rows.tobytes(), rows.shape[1]
+        for key, H in zip(doc_keys[start:start + args.batch_size], [data[j:j + width] for j in range(0, len(data), width)]):
+            cand = lsh_dict.get(H, "None")
+            if cand != "None":
+                reference.append((key, cand))
+            else:
+                lsh_dict[H] = key
+    reference_time = time.time() - t0
+    # the dict itself, its bytes keys and the document keys it keeps alive
+    reference_memory = sys.getsizeof(lsh_dict) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in lsh_dict.items())
+    index_entries = len(lsh_dict)
+    del lsh_dict
+
+    t0 = time.time()
+    index = BandIndex()
+    candidates = []
+    doc_ids = np.arange(args.num_docs, dtype=np.uint64)
+    for start in batches:
+        keys = band_keys(band[start:start + args.batch_size], 1, args.range)[:, 0]
+        candidates.append(index.get_or_insert(keys, doc_ids[start:start + args.batch_size]))
+    candidate_time = time.time() - t0
+    candidates = np.concatenate(candidates)
+
+    logging.info(
+        f"band_index: {args.num_docs} documents, {index_entries} index entries; "
+        f"dict {args.num_docs / reference_time / 1_000:.1f}kdocs/sec, {reference_memory / 2**20:.1f}MB; "
+        f"arrays {args.num_docs / candidate_time / 1_000:.1f}kdocs/sec, {index.nbytes / 2**20:.1f}MB "
+        f"({reference_memory / index.nbytes:.1f}x less memory)"
+    )
+
+    if args.check:
+        found = np.flatnonzero(candidates != NO_DOC)
+        pairs = [(doc_keys[i], doc_keys[j]) for i, j in zip(found.tolist(), candidates[found].tolist())]
+        if pairs != reference or len(index) != index_entries:
+            raise AssertionError(f"band_index: {len(pairs)} pairs and {len(index)} entries instead of {len(reference)} and {index_entries}")
+        logging.info(f"band_index: {len(pairs)} duplicate pairs are identical")
+
+
+def benchmark_spill(args):
+    band = generate_band(args)
+    keys = band_keys(band, 1, args.range)[:, 0]
+    doc_ids = np.arange(args.num_docs, dtype=np.uint64)
+    batches = range(0, args.num_docs, args.batch_size)
+
+    t0 = time.time()
+    index = BandIndex()
+    candidates = np.concatenate([index.get_or_insert(keys[start:start + args.batch_size], doc_ids[start:start + args.batch_size]) for start in batches])
+    found = np.flatnonzero(candidates != NO_DOC)
+    reference = {(i, j) for i, j in zip(found.tolist(), candidates[found].tolist())}
+    reference_time = time.time() - t0
+
+    memory_budget = int(args.memory_budget * 2**30)
+    with tempfile.TemporaryDirectory(dir=args.spill_dir) as spill_dir:
+        # NumPy reports its allocations to tracemalloc, so its peak is the memory used by the spilled index
+        tracemalloc.start()
+        t0 = time.time()
+        spilled = SpilledBandIndex(spill_dir, args.num_docs, memory_budget)
+        for start in batches:
+            spilled.add(keys[start:start + args.batch_size], doc_ids[start:start + args.batch_size])
+        out_path = os.path.join(spill_dir, "index.npy")
+        spilled_pairs = list(spilled.merge(out_path=out_path))
+        spilled_time = time.time() - t0
+        _, spilled_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        pairs = {(i, j) for docs, cands in spilled_pairs for i, j in zip(docs.tolist(), cands.tolist())}
+        identical_entries = np.array_equal(load_entries(out_path), index.entries())
+
+    logging.info(
+        f"spill: {args.num_docs} documents; hash table {args.num_docs / reference_time / 1_000:.1f}kdocs/sec, {index.nbytes / 2**20:.1f}MB; "
+        f"spilled to {spilled.num_partitions} partitions {args.num_docs / spilled_time / 1_000:.1f}kdocs/sec, "
+        f"peak {spilled_memory / 2**20:.1f}MB with budget {memory_budget / 2**20:.1f}MB"
+    )
+    if args.check:
+        if pairs != reference or not identical_entries:
+            raise AssertionError(f"spill: {len(pairs)} pairs instead of {len(reference)}, identical index entries: {identical_entries}")
+        logging.info(f"spill: {len(pairs)} duplicate pairs and index entries are identical")
+
+
+BENCHMARKS = {
+    "band_index": benchmark_band_index,
+    "spill": benchmark_spill,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=2_000_000, help='Number of synthetic documents')
+    parser.add_argument('--duplicate-fraction', type=float, default=0.2, help='Fraction of documents whose band duplicates the band of an earlier document')
+    parser.add_argument('--range', type=int, default=8, help='Range of LSH index, i.e. number of minhash values per band')
+    parser.add_argument('--batch-size', type=int, default=10_000, help='Number of documents per batch sent to a band worker')
+    parser.add_argument('--memory-budget', type=float, default=0.01, help='Memory budget of spilled index in GB')
+    parser.add_argument('--spill-dir', type=str, default=tempfile.gettempdir(), help='Folder for spilled documents')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating documents')
+    parser.add_argument('--benchmarks', nargs='+', type=str, default=list(BENCHMARKS), choices=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--check', action='store_true', help='Check that new implementations produce outputs identical to reference ones')
+    args = parser.parse_args()
+    print()
+
+    for benchmark in args.benchmarks:
+        BENCHMARKS[benchmark](args)
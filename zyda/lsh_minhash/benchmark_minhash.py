@@ -0,0 +1,142 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+import argparse
+import random
+import time
+import numpy as np
+
+from zyda.lsh_minhash.compute_minhash import to_minhash, to_minhash_datasketch
+from zyda.lsh_minhash.minhash import minhash_hashes, one_permutation_hashes, shingle_hashes_batch
+from zyda.preprocessing_and_filtering.benchmark_preprocessing import load_texts
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+def run_timed(fn, batches):
+    t0 = time.time()
+    results = [fn(batch) for batch in batches]
+    return np.concatenate(results), time.time() - t0
+
+
+def benchmark_engines(texts: List[str], args):
+    batches = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)]
+
+    def reference(batch):
+        return np.array(to_minhash_datasketch({"text": batch}, key="text", width=args.width, num_perm=args.num_perm)["hashvalues"])
+
+    def candidate(batch):
+        return np.array(to_minhash({"text": batch}, key="text", width=args.width, num_perm=args.num_perm)["hashvalues"])
+
+    reference_signatures, reference_time = run_timed(reference, batches)
+    candidate_signatures, candidate_time = run_timed(candidate, batches)
+    logging.info(
+        f"engines: datasketch {len(texts) / reference_time:.1f} docs/sec, numpy {len(texts) / candidate_time:.1f} docs/sec "
+        f"({reference_time / candidate_time:.1f}x)"
+    )
+
+    # minhashing from shingle hashes saved in preprocessing, i.e. without any text processing
+    hashed_batches = [shingle_hashes_batch(batch, args.width) for batch in batches]
+    hashed_signatures, hashed_time = run_timed(lambda x: minhash_hashes(*x, num_perm=args.num_perm), hashed_batches)
+    logging.info(f"engines: numpy from shingle hashes {len(texts) / hashed_time:.1f} docs/sec")
+
+    if args.check:
+        for name, signatures in [("numpy", candidate_signatures), ("numpy from shingle hashes", hashed_signatures)]:
+            mismatches = np.flatnonzero((signatures != reference_signatures).any(axis=1))
+            if len(mismatches):
+                raise AssertionError(f"engines: {name} has {len(mismatches)} mismatches, e.g. document {mismatches[0]}")
+        logging.info(f"engines: signatures are identical on {len(texts)} documents")
+
+
+def perturb(text: str, rate: float, rng: random.Random) -> str:
+    """
+    Returns a near-duplicate of the text with a fraction of words deleted or replaced by other words of the text.
+    """
+    words = text.split()
+    result = []
+    for word in words:
+        r = rng.random()
+        if r < rate / 2:
+            continue
+        result.append(rng.choice(words) if r < rate else word)
+    return " ".join(result)
+
+
+def jaccard_errors(pairs, signatures_a: np.ndarray, signatures_b: np.ndarray) -> np.ndarray:
+    true_jaccard = np.array([len(a & b) / len(a | b) for a, b in pairs])
+    estimates = (signatures_a == signatures_b).mean(axis=1)
+    return estimates - true_jaccard
+
+
+def benchmark_one_permutation(texts: List[str], args):
+    batches = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)]
+    hashed_batches = [shingle_hashes_batch(batch, args.width) for batch in batches]
+    _, classic_time = run_timed(lambda x: minhash_hashes(*x, num_perm=args.num_perm), hashed_batches)
+    _, oph_time = run_timed(lambda x: one_permutation_hashes(*x, num_perm=args.num_perm), hashed_batches)
+    logging.info(
+        f"one_permutation: from shingle hashes classic {len(texts) / classic_time:.1f} docs/sec, "
+        f"one-permutation {len(texts) / oph_time:.1f} docs/sec ({classic_time / oph_time:.1f}x)"
+    )
+
+    # accuracy of Jaccard estimates on pairs of documents and their near-duplicates
+    rng = random.Random(args.seed)
+    originals = texts[:args.num_pairs]
+    duplicates = [perturb(text, rng.uniform(0.0, 0.3), rng) for text in originals]
+    hashes_a, lengths_a = shingle_hashes_batch(originals, args.width)
+    hashes_b, lengths_b = shingle_hashes_batch(duplicates, args.width)
+    offsets_a, offsets_b = np.cumsum(lengths_a), np.cumsum(lengths_b)
+    sets_a = [set(x.tolist()) for x in np.split(hashes_a, offsets_a[:-1])]
+    sets_b = [set(x.tolist()) for x in np.split(hashes_b, offsets_b[:-1])]
+    # pairs where both documents are empty have undefined Jaccard similarity
+    valid = [i for i in range(len(originals)) if sets_a[i] or sets_b[i]]
+    pairs = [(sets_a[i], sets_b[i]) for i in valid]
+    for name, engine in [("classic", minhash_hashes), ("one-permutation", one_permutation_hashes)]:
+        signatures_a = engine(hashes_a, lengths_a, num_perm=args.num_perm)[valid]
+        signatures_b = engine(hashes_b, lengths_b, num_perm=args.num_perm)[valid]
+        errors = jaccard_errors(pairs, signatures_a, signatures_b)
+        logging.info(
+            f"one_permutation: {name} Jaccard estimates on {len(pairs)} pairs: "
+            f"mean error {errors.mean():+.4f}, mean absolute error {np.abs(errors).mean():.4f}, RMSE {np.sqrt((errors ** 2).mean()):.4f}"
+        )
+
+
+BENCHMARKS = {
+    "engines": benchmark_engines,
+    "one_permutation": benchmark_one_permutation,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hf-path', type=str, default=None, help='Path of HF dataset. If not specified, synthetic documents are used')
+    parser.add_argument('--hf-dir', type=str, default=None, help='Dir in HF dataset')
+    parser.add_argument('--load-from-disk', action='store_true', help='Use datasets.load_from_disk() to load the dataset')
+    parser.add_argument('--key', type=str, default='transformed_text', help='Key to extract')
+    parser.add_argument('--num-docs', type=int, default=10_000, help='Number of documents to benchmark on')
+    parser.add_argument('--code-fraction', type=float, default=0.3, help='Fraction of code-like documents among synthetic ones')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for sampling or generating documents')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of documents per batch, as in datasets.map()')
+    parser.add_argument('--width', type=int, default=13, help='n-grams size for minhashes')
+    parser.add_argument('--num-perm', type=int, default=128, help='Number of permutation for computing minhashes')
+    parser.add_argument('--num-pairs', type=int, default=2000, help='Number of near-duplicate pairs for evaluating accuracy of Jaccard estimates')
+    parser.add_argument('--benchmarks', nargs='+', type=str, default=list(BENCHMARKS), choices=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--check', action='store_true', help='Check that new implementations produce outputs identical to reference ones')
+    args = parser.parse_args()
+    print()
+
+    texts = load_texts(args)
+    for benchmark in args.benchmarks:
+        BENCHMARKS[benchmark](texts, args)
@@ -14,17 +14,55 @@
 # limitations under the License.
 
 import argparse
-import pickle
-import queue
 import time
 import os
+import shutil
+import tempfile
 import more_itertools
-from typing import List
+import numpy as np
+from typing import List, Optional, Tuple
 from tqdm import tqdm
-from collections import defaultdict
-from multiprocessing import Process, Queue
-from datasketch.lean_minhash import LeanMinHash
-from zyda.utils.common import ensure_directory_exists
+from multiprocessing import Array, Process, Queue
+from multiprocessing.connection import wait
+from zyda.utils.common import ensure_directory_exists, list_shards
+from zyda.utils.doc_ids import NO_DOC, DocRegistry, pack_doc_ids
+from zyda.utils.pairs import PAIRS_FORMATS, open_pair_writer
+from zyda.lsh_minhash.minhash import band_key_column, band_keys as compute_band_keys, load_minhash_config
+from zyda.lsh_minhash.band_index import INDEX_DTYPE, BandIndex, SegmentedBandIndex, SpilledBandIndex, append_partitions, load_entries
+from zyda.lsh_minhash.lsh_index import (
+    COMPACTION_MEMORY_BUDGET,
+    compact_band,
+    load_index_config,
+    load_segment_paths,
+    new_segment_path,
+    next_segment_sequence,
+    registry_path,
+    save_index_config,
+    save_segment_paths,
+    segment_path,
+)
+from zyda.lsh_minhash.schedule import (
+    MEMORY_FRACTION,
+    BandScheduler,
+    available_cores,
+    available_memory,
+    estimate_band_memory,
+    plan_bands_parallel,
+    plan_readers,
+    run_measured,
+    sample_fill_ratio,
+)
+from zyda.lsh_minhash.checkpoint import (
+    clear_checkpoint,
+    done_path,
+    load_band_done,
+    load_checkpoint,
+    mark_band_done,
+    pairs_path,
+    save_checkpoint,
+    tmp_pairs_path,
+)
+from zyda.lsh_minhash.shuffle import key_ranks, mark_failed, mark_stage, marker_path, run_path, wait_for_ranks
 
 import datasets
 
@@ -32,25 +70,81 @@ import logging
 logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
 
 
-def _H(hs):
-    return bytes(hs.byteswap().data)
+# Number of documents read and sent to a band worker at once
+READ_BATCH_SIZE = 10_000
+# Number of batches buffered in a document queue
+QUEUE_SIZE = 100
+# Sentinels sent by every reader process when it is done, or when it failed
+END_OF_STREAM = None
+READER_FAILED = "READER_FAILED"
 
 
-def get_hashes_band(
-    shards: List[datasets.Dataset],
-    doc_queue: Queue,
-    i: int,
+def get_hashes_bands(
+    parts: List[Tuple[int, int, datasets.Dataset]],
+    doc_queues: List[Queue],
+    bands: List[int],
     r: int,
     log_interval: int = 0,
+    band_keys: bool = False,
+    reader_idx: int = 0,
+    skip: int = 0,
 ):
-    for shard in shards:
-        for j, item in enumerate(shard):
-            if log_interval and j % log_interval == 0:
-                logging.debug(f"Band {i}: read {j} records")
-            key = f"{item['dataset_name']}@{item['shard']}@{item['shard_index']}@{item['global_index']}"
-            minhash = LeanMinHash(seed=item['seed'], hashvalues=item['hashvalues'])
-            H = _H(minhash.hashvalues[i * r : (i + 1) * r])
-            doc_queue.put((key, H))
+    """
+    Reads every record batch once and sends batches of (reader_idx, position, document ids, band keys) to workers of all bands,
+    with keys of bands[j] sent to doc_queues[j], followed by END_OF_STREAM. Ids and keys are uint64 arrays, and position is
+    the number of documents of parts before the batch. The first skip documents are not read.
+    Every part is (index of the dataset in the registry, row of the dataset the part starts at, part of the dataset).
+    Band keys are either computed from hashvalues, or read from precomputed keys saved by compute_minhash.py --compact --bands,
+    which are the same.
+    """
+    try:
+        n = 0
+        columns = [band_key_column(i) for i in bands] if band_keys else ["hashvalues"]
+        for dataset_idx, start_row, part in parts:
+            if n + len(part) <= skip:
+                n += len(part)
+                continue
+            if n < skip:
+                # documents already processed by workers of all bands before they were interrupted
+                part = part.select(range(skip - n, len(part)))
+                start_row += skip - n
+                n = skip
+            part = part.select_columns(columns).with_format("arrow")
+            for batch in part.iter(batch_size=READ_BATCH_SIZE):
+                if log_interval and n % log_interval + len(batch) >= log_interval:
+                    logging.debug(f"Bands {bands}: read {n} records")
+                doc_ids = pack_doc_ids(dataset_idx, np.arange(start_row, start_row + len(batch)))
+                position = n
+                start_row += len(batch)
+                n += len(batch)
+                if not band_keys:
+                    hashvalues = batch.column("hashvalues").combine_chunks().flatten().to_numpy().reshape(len(batch), -1)
+                for doc_queue, i in zip(doc_queues, bands):
+                    if band_keys:
+                        keys = batch.column(band_key_column(i)).combine_chunks().to_numpy()
+                    else:
+                        keys = compute_band_keys(hashvalues[:, i * r : (i + 1) * r], 1, r)[:, 0]
+                    doc_queue.put((reader_idx, position, doc_ids, keys))
+    except BaseException:
+        for doc_queue in doc_queues:
+            doc_queue.put(READER_FAILED)
+        raise
+    for doc_queue in doc_queues:
+        doc_queue.put(END_OF_STREAM)
+
+
+def load_band_segments(lsh_in: str, band_idx: int, check_only: bool) -> List[str]:
+    """
+    Returns paths of segments of a band of an existing LSH index, or an empty list if there is no such band.
+    """
+    segment_paths = load_segment_paths(lsh_in, band_idx)
+    if segment_paths is not None:
+        logging.info(f"Band {band_idx}: memory-mapping {len(segment_paths)} segments of LSH index at {lsh_in}")
+        return segment_paths
+    if check_only:
+        raise FileNotFoundError(f"Band {band_idx}: did not find LSH index at {lsh_in}")
+    logging.info(f"Band {band_idx}: did not find existing LSH index at {lsh_in}, so creating a new one")
+    return []
 
 
 def lsh_process(
@@ -63,117 +157,516 @@ def lsh_process(
     log_interval: int = 1_000_000,
     n_docs: int = 0, 
     check_only: bool = False,
+    n_readers: int = 1,
+    memory_budget: int = 0,
+    spill_dir: Optional[str] = None,
+    max_segments: int = 0,
+    pairs_format: str = "text",
+    segment_out: Optional[str] = None,
+    checkpoint: Optional[dict] = None,
+    checkpoint_interval: int = 0,
+    reader_layout: Optional[list] = None,
 ):
-    lsh_dict = defaultdict(str)
-    if lsh_in:
-        lsh_in_band = lsh_in.replace(".pickle", f"-{band_idx}.pickle")
-        if os.path.exists(lsh_in_band):
-            with open(lsh_in_band, "rb") as f:
-                logging.info(f"Band {band_idx}: loading LSH index from {lsh_in_band}")
-                lsh_dict = pickle.load(f)
-                logging.info(f"Band {band_idx}: loaded LSH index from {lsh_in_band}")
-        elif check_only:
-            raise FileExistsError()
-        else:
-            logging.info(f"Band {band_idx}: did not find existing LSH index at {lsh_in_band}, so creating a new one")
-    
+    """
+    Builds the index of one band from documents sent by readers and writes duplicate pairs.
+    Segments of an existing index are memory-mapped, and keys of new documents are saved as a new segment.
+    With memory_budget (in bytes), documents are spilled to spill_dir and pairs are written after all documents are read.
+    With segment_out, the new segment is saved there and the manifest of the band is left to the caller.
+    Pairs are written to a temporary file renamed once the band is complete, and then the band is marked as done (see checkpoint.py).
+    With checkpoint_interval, a snapshot of the band is saved every checkpoint_interval documents, and with checkpoint,
+    the snapshot loaded by load_checkpoint(), the band is resumed from it.
+    """
+    segment_paths = load_band_segments(lsh_in, band_idx, check_only) if lsh_in else []
+    segments = [load_entries(path) for path in segment_paths]
+    if memory_budget:
+        os.makedirs(spill_dir, exist_ok=True)
+        band_spill_dir = tempfile.mkdtemp(prefix=f"lsh-band-{band_idx}-", dir=spill_dir)
+        n_records = n_docs + sum(len(segment) for segment in segments)
+        index = SpilledBandIndex(band_spill_dir, n_records, memory_budget)
+        logging.info(f"Band {band_idx}: spilling documents to {index.num_partitions} partitions in {band_spill_dir}")
+    else:
+        index = SegmentedBandIndex(segments)
+
     ensure_directory_exists(dupes_out)
-    with open(dupes_out.replace(".txt", f"-{band_idx}.txt"), "w") as f:
-        i = 0
+    tmp_path = tmp_pairs_path(dupes_out, band_idx, pairs_format)
+    if os.path.exists(done_path(dupes_out, band_idx)):
+        os.remove(done_path(dupes_out, band_idx))
+    # documents consumed from every reader, so that documents sent again after a restart are skipped
+    reader_offsets = [0] * n_readers
+    i = 0
+    if checkpoint:
+        index.memtable = BandIndex.load(checkpoint["entries"])
+        os.truncate(tmp_path, checkpoint["pairs_bytes"])
+        reader_offsets, i = checkpoint["reader_offsets"], checkpoint["docs"]
+        logging.info(f"Band {band_idx}: resuming from snapshot {checkpoint['snapshot']} after {i} documents with {len(index.memtable)} new entries")
+    else:
+        clear_checkpoint(dupes_out, band_idx)
+    last_checkpoint = i
+    with open_pair_writer(tmp_path, pairs_format, append=checkpoint is not None) as f:
         start_time = time.time()
         t0 = start_time
+        i0 = i
         if n_docs:
-            pbar = tqdm(desc=f"Band {band_idx}", total=n_docs, unit_scale=True, position=queue_idx, dynamic_ncols=True)
-        while True:
-            try:
-                key, H = doc_queue.get(timeout=30)
-                cand = lsh_dict.get(H, "None")
-                if cand != "None":
-                    f.write(f'{key} :: {cand}\n')
-                elif not check_only:
-                    lsh_dict[H] = key
-                i += 1
-                if n_docs:
-                    pbar.update(1)
-                elif i % log_interval == 0:
-                    speed = log_interval / (time.time() - t0)
-                    t0 = time.time()                
-                    logging.info(
-                        f"Band {band_idx}: Processed {i / 1_000_000:.1f}M in {time.time() - start_time:.1f}s; "
-                        f"{speed / 1_000:.1f}kdocs/sec. Index size: {len(lsh_dict) / i * 100:.2f}%. "
-                        f"Doc queue size: {doc_queue.qsize()}"
-                    )
-            except queue.Empty:
-                break
+            pbar = tqdm(desc=f"Band {band_idx}", total=n_docs, initial=i, unit_scale=True, position=queue_idx, dynamic_ncols=True)
+        finished_readers = 0
+        while finished_readers < n_readers:
+            batch = doc_queue.get()
+            if batch is END_OF_STREAM:
+                finished_readers += 1
+                continue
+            if isinstance(batch, str) and batch == READER_FAILED:
+                raise RuntimeError(f"Band {band_idx}: a reader process failed, LSH index is not saved")
+            reader_idx, position, doc_ids, keys = batch
+            skip = reader_offsets[reader_idx] - position
+            if skip >= len(doc_ids):
+                continue
+            reader_offsets[reader_idx] = position + len(doc_ids)
+            if skip > 0:
+                doc_ids, keys = doc_ids[skip:], keys[skip:]
+            if memory_budget:
+                index.add(keys, doc_ids)
+            else:
+                candidates = index.get_or_insert(keys, doc_ids, insert=not check_only)
+                found = np.flatnonzero(candidates != NO_DOC)
+                f.write(doc_ids[found], candidates[found])
+            i += len(doc_ids)
+            if n_docs:
+                pbar.update(len(doc_ids))
+            elif i % log_interval < len(doc_ids):
+                speed = (i - i0) / (time.time() - t0)
+                t0, i0 = time.time(), i
+                logging.info(
+                    f"Band {band_idx}: Processed {i / 1_000_000:.1f}M in {time.time() - start_time:.1f}s; "
+                    f"{speed / 1_000:.1f}kdocs/sec. Index size: {len(index) / i * 100:.2f}%, {index.nbytes / 2**20:.1f}MB. "
+                    f"Doc queue size: {doc_queue.qsize()} batches"
+                )
+            if checkpoint_interval and not memory_budget and i - last_checkpoint >= checkpoint_interval:
+                state = {"reader_layout": reader_layout, "reader_offsets": reader_offsets, "pairs_bytes": f.sync(), "docs": i}
+                save_checkpoint(dupes_out, band_idx, state, index.memtable.entries())
+                last_checkpoint = i
         if n_docs:
             pbar.close()
 
+        new_segment = segment_out or new_segment_path(lsh_out, band_idx)
         if not check_only:
-            lsh_out_band = lsh_out.replace(".pickle", f"-{band_idx}.pickle")
-            ensure_directory_exists(lsh_out_band)
-            with open(lsh_out_band, "wb") as f:
-                logging.info(f"Band {band_idx}: saving LSH index to {lsh_out_band}")
-                pickle.dump(lsh_dict, f, protocol=5)
-                logging.info(f"Band {band_idx}: saved LSH index to {lsh_out_band}")
-        logging.info(f"Band {band_idx}: Total number of documents: {i}")
+            ensure_directory_exists(new_segment)
+        if memory_budget:
+            logging.info(f"Band {band_idx}: sorting {index.num_partitions} partitions of {len(index)} spilled documents")
+            for doc_ids, candidates in index.merge(segments, check_only, new_segment):
+                f.write(doc_ids, candidates)
+            shutil.rmtree(band_spill_dir)
+        elif not check_only:
+            logging.info(f"Band {band_idx}: saving {len(index.memtable)} new entries to {new_segment}")
+            index.memtable.save(new_segment)
+        f.sync()
+    os.replace(tmp_path, pairs_path(dupes_out, band_idx, pairs_format))
+
+    if check_only or segment_out is not None:
+        mark_band_done(dupes_out, band_idx, None)
+    else:
+        new_segments = [new_segment]
+        if segment_paths and len(load_entries(new_segment)) == 0:
+            # all keys were already in the index
+            os.remove(new_segment)
+            new_segments = []
+        # segments of the existing index are listed in the manifest as they are, without rewriting them
+        segment_paths = segment_paths + new_segments
+        # the band is marked as done before its manifest is saved, so that a restart can save it from the marker
+        mark_band_done(dupes_out, band_idx, segment_paths)
+        save_segment_paths(lsh_out, band_idx, segment_paths)
+        logging.info(f"Band {band_idx}: saved LSH index with {len(segment_paths)} segments to {lsh_out}")
+        if max_segments and len(segment_paths) > max_segments:
+            compact_band(lsh_out, band_idx, memory_budget or COMPACTION_MEMORY_BUDGET, spill_dir)
+            mark_band_done(dupes_out, band_idx, load_segment_paths(lsh_out, band_idx))
+    clear_checkpoint(dupes_out, band_idx)
+    logging.info(f"Band {band_idx}: Total number of documents: {i}")
+
+
+def restore_finished_band(args, band_idx: int, done: dict):
+    """
+    Saves the manifest of a band marked as done if the builder was interrupted before saving it or compacting the band.
+    """
+    segment_paths = done["segments"]
+    if segment_paths is None or load_segment_paths(args.lsh_out, band_idx) == segment_paths:
+        return
+    logging.info(f"Band {band_idx}: saving LSH index with {len(segment_paths)} segments interrupted after the band was done")
+    save_segment_paths(args.lsh_out, band_idx, segment_paths)
+    if args.max_segments and len(segment_paths) > args.max_segments:
+        compact_band(args.lsh_out, band_idx, int(args.memory_budget * 2**30) or COMPACTION_MEMORY_BUDGET, args.spill_dir)
+        mark_band_done(args.dupes_out, band_idx, load_segment_paths(args.lsh_out, band_idx))
+
+
+def shuffle_process(
+    shuffle_dir: str,
+    doc_queue: Queue,
+    queue_idx: int,
+    band_idx: int,
+    rank: int,
+    num_ranks: int,
+    n_docs: int = 0,
+    n_readers: int = 1,
+):
+    """
+    Map side of key-partitioned indexing: appends (key, doc) records of documents read by this rank to run files
+    of the ranks owning their keys, and marks the band as shuffled by this rank.
+    """
+    files = [open(run_path(shuffle_dir, band_idx, rank, dest), "wb") for dest in range(num_ranks)]
+    pbar = tqdm(desc=f"Band {band_idx} shuffle", total=n_docs, unit_scale=True, position=queue_idx, dynamic_ncols=True)
+    finished_readers = 0
+    while finished_readers < n_readers:
+        batch = doc_queue.get()
+        if batch is END_OF_STREAM:
+            finished_readers += 1
+            continue
+        if isinstance(batch, str) and batch == READER_FAILED:
+            raise RuntimeError(f"Band {band_idx}: a reader process failed, records are not shuffled")
+        _, _, doc_ids, keys = batch
+        records = np.empty(len(keys), dtype=INDEX_DTYPE)
+        records["key"] = keys
+        records["doc"] = doc_ids
+        append_partitions(records, key_ranks(records["key"], num_ranks), files)
+        pbar.update(len(keys))
+    pbar.close()
+    for f in files:
+        f.close()
+    mark_stage(shuffle_dir, band_idx, rank, "shuffled")
+
+
+def get_shuffled_records(shuffle_dir: str, band_idx: int, rank: int, num_ranks: int, doc_queue: Queue):
+    """
+    Reduce side of key-partitioned indexing: sends records of keys owned by this rank to the band worker,
+    from run files of ranks in the order of ranks, followed by END_OF_STREAM.
+    """
+    try:
+        position = 0
+        for source in range(num_ranks):
+            path = run_path(shuffle_dir, band_idx, source, rank)
+            if os.path.getsize(path) == 0:
+                continue
+            records = np.memmap(path, dtype=INDEX_DTYPE, mode="r")
+            for start in range(0, len(records), READ_BATCH_SIZE):
+                batch = records[start:start + READ_BATCH_SIZE]
+                doc_queue.put((0, position, np.array(batch["doc"]), np.array(batch["key"])))
+                position += len(batch)
+            del records
+    except BaseException:
+        doc_queue.put(READER_FAILED)
+        raise
+    doc_queue.put(END_OF_STREAM)
+
+
+def get_reader_parts(datasets_list: List[Tuple[int, datasets.Dataset]], start: int, end: int, n_readers: int) -> List[list]:
+    """
+    Splits rows [start, end) of the concatenation of datasets into contiguous parts of readers.
+    Every dataset is (index of the dataset in the registry, dataset).
+    """
+    reader_parts = [[] for _ in range(n_readers)]
+    bounds = [start + (end - start) * i // n_readers for i in range(n_readers + 1)]
+    offset = 0
+    for dataset_idx, ds in datasets_list:
+        for i in range(n_readers):
+            lo, hi = max(bounds[i], offset) - offset, min(bounds[i + 1], offset + len(ds)) - offset
+            if lo < hi:
+                reader_parts[i].append((dataset_idx, lo, ds.select(range(lo, hi))))
+        offset += len(ds)
+    return reader_parts
+
+
+def save_shuffled_manifests(args, bands: List[int]):
+    """
+    Waits for all ranks to save their segments of bands and lists them in manifests after segments of --lsh-in.
+    """
+    for band_idx in bands:
+        reduced = wait_for_ranks(args.shuffle_dir, band_idx, args.num_nodes, "reduced")
+        segment_paths = load_band_segments(args.lsh_in, band_idx, False) if args.lsh_in else []
+        for data in reduced:
+            if len(load_entries(data["segment"])) == 0:
+                os.remove(data["segment"])
+            else:
+                segment_paths.append(data["segment"])
+        save_segment_paths(args.lsh_out, band_idx, segment_paths)
+        logging.info(f"Band {band_idx}: saved LSH index with {len(segment_paths)} segments to {args.lsh_out}")
+        if args.max_segments and len(segment_paths) > args.max_segments:
+            compact_band(args.lsh_out, band_idx, int(args.memory_budget * 2**30) or COMPACTION_MEMORY_BUDGET, args.spill_dir)
+
+
+def check_minhash_configs(configs: dict, args) -> dict:
+    """
+    Checks that all minhash shards can be indexed together, and that they have band keys of this LSH index if --band-keys is used.
+    Shards without minhash_config.json were saved in the legacy format with default parameters.
+    Returns the config of the index: its bands and range, and parameters of minhash signatures shared by all shards.
+    """
+    signature_params = ["seed", "num_perm", "one_permutation", "width"]
+    legacy_config = {"format": "legacy", "seed": 1, "num_perm": 128, "one_permutation": False, "width": 13, "bands": 0, "range": 0}
+    configs = {path: config or legacy_config for path, config in configs.items()}
+    distinct = {tuple(config[param] for param in signature_params) for config in configs.values()}
+    if len(distinct) > 1:
+        raise ValueError(f"Minhash shards were computed with different {signature_params}: {sorted(distinct)}")
+    if args.band_keys:
+        for path, config in configs.items():
+            if (config["bands"], config["range"]) != (args.bands, args.range):
+                raise ValueError(
+                    f"Shard {path} has band keys for {config['bands']} bands of range {config['range']}, "
+                    f"but the index has {args.bands} bands of range {args.range}: recompute minhashes with --compact --bands {args.bands} --range {args.range}"
+                )
+    index_config = {"bands": args.bands, "range": args.range, **dict(zip(signature_params, distinct.pop()))}
+    # documents of an existing index are only comparable with new ones if they were hashed and banded the same way
+    existing = load_index_config(args.lsh_in) if args.lsh_in else None
+    if existing is not None and existing != index_config:
+        raise ValueError(f"LSH index {args.lsh_in} was built with {existing}, which doesn't match {index_config}")
+    return index_config
+
+
+def wait_for_processes(processes: List[Process]) -> List[Process]:
+    """
+    Waits for all processes and returns the ones that failed. Once any of them fails, the rest are terminated:
+    readers are shared by workers of all bands, so a failed worker would block them, and all other workers with them.
+    """
+    running = list(processes)
+    failed = []
+    while running:
+        wait([p.sentinel for p in running])
+        for p in [p for p in running if not p.is_alive()]:
+            p.join()
+            running.remove(p)
+            if p.exitcode != 0:
+                failed.append(p)
+        if failed:
+            for p in running:
+                p.terminate()
+                p.join()
+            break
+    return failed
+
+
+def plan_schedule(args, datasets_list: List[Tuple[int, datasets.Dataset]], bands: List[int], n_docs: int) -> BandScheduler:
+    """
+    Chooses --bands-parallel and --reader-processes from the memory of a band worker estimated for n_docs documents
+    and available memory and cores. Both are re-planned after every group of bands.
+    """
+    memory_budget = int(args.memory_budget * 2**30)
+    fill_ratio = 0.0 if memory_budget else sample_fill_ratio(datasets_list, bands, args.range, args.band_keys)
+    band_memory = estimate_band_memory(n_docs, fill_ratio, memory_budget, QUEUE_SIZE * READ_BATCH_SIZE)
+    memory = int(args.max_memory * 2**30) or int(available_memory() * MEMORY_FRACTION)
+    cores = available_cores()
+    bands_parallel = plan_bands_parallel(len(bands), band_memory, memory, 1, cores)
+    n_readers = plan_readers(bands_parallel, band_memory, memory, cores)
+    logging.info(
+        f"Auto schedule: {n_docs} documents, sampled index fill ratio {fill_ratio:.3f}, {band_memory / 2**30:.2f}GB per band, "
+        f"{memory / 2**30:.1f}GB memory and {cores} cores: {bands_parallel} bands in parallel, {n_readers} reader processes"
+    )
+    return BandScheduler(bands, bands_parallel, band_memory, memory, n_readers, cores)
+
+
+def generate_pairs_shuffled(args, scheduler: BandScheduler, datasets_list: List[Tuple[int, datasets.Dataset]], start: int, end: int):
+    """
+    Key-partitioned indexing on one of --num-nodes nodes: records of documents read by this node are shuffled through
+    --shuffle-dir to nodes owning their keys, and then this node indexes its range of keys of every band, reading the records
+    of all nodes in the order of nodes. A node holds 1/num_nodes of every band, and pairs are the same as with one node.
+    """
+    rank, num_ranks = args.node_rank, args.num_nodes
+    if any(os.path.exists(marker_path(args.shuffle_dir, band_idx, rank, "shuffled")) for band_idx in range(args.bands)):
+        raise ValueError(f"{args.shuffle_dir} has files of a previous build: use a new --shuffle-dir")
+    # sequence numbers of new segments are taken before this node shuffles any band, and so before any node saves a segment
+    first_sequences = {band_idx: next_segment_sequence(args.lsh_out, band_idx) for band_idx in range(args.bands)}
+    dupes_out = args.dupes_out.replace(".txt", f"-{rank}.txt")
+
+    t0 = time.time()
+    try:
+        for bands_split in scheduler:
+            logging.info('-' * 120)
+            logging.info(f"Shuffling bands: {bands_split}")
+            logging.info('-' * 120)
+            n_readers = scheduler.n_readers
+            reader_parts = get_reader_parts(datasets_list, start, end, n_readers)
+            doc_queues = [Queue(QUEUE_SIZE) for _ in bands_split]
+            peaks = Array("q", len(bands_split))
+            for band_idx in bands_split:
+                os.makedirs(os.path.dirname(run_path(args.shuffle_dir, band_idx, rank, 0)), exist_ok=True)
+            processes = [
+                Process(
+                    target=get_hashes_bands,
+                    args=(reader_parts[process_id], doc_queues[:len(bands_split)], bands_split, args.range, args.log_interval, args.band_keys),
+                )
+                for process_id in range(n_readers)
+            ]
+            processes += [
+                Process(
+                    target=run_measured,
+                    args=(peaks, q_i, shuffle_process, args.shuffle_dir, doc_queues[q_i], q_i, band_i, rank, num_ranks, end - start, n_readers),
+                )
+                for q_i, band_i in enumerate(bands_split)
+            ]
+            for p in processes:
+                p.start()
+            failed = wait_for_processes(processes)
+            if failed:
+                raise RuntimeError(f"{len(failed)} processes failed while shuffling bands {bands_split}")
+            scheduler.report_peak(max(peaks))
+
+            logging.info(f"Waiting for {num_ranks} nodes to shuffle bands {bands_split}")
+            for band_idx in bands_split:
+                wait_for_ranks(args.shuffle_dir, band_idx, num_ranks, "shuffled")
+            logging.info('-' * 120)
+            logging.info(f"Processing bands: {bands_split}")
+            logging.info('-' * 120)
+            processes = []
+            for q_i, band_i in enumerate(bands_split):
+                run_paths = [run_path(args.shuffle_dir, band_i, source, rank) for source in range(num_ranks)]
+                n_records = sum(os.path.getsize(path) for path in run_paths) // INDEX_DTYPE.itemsize
+                processes.append(Process(target=get_shuffled_records, args=(args.shuffle_dir, band_i, rank, num_ranks, doc_queues[q_i])))
+                processes.append(Process(
+                    target=run_measured,
+                    args=(
+                        peaks, q_i, lsh_process, dupes_out, args.lsh_in, args.lsh_out, doc_queues[q_i], q_i, band_i, args.log_interval, n_records,
+                        args.check_only, 1, int(args.memory_budget * 2**30), args.spill_dir, 0,
+                        args.pairs_format, segment_path(args.lsh_out, band_i, first_sequences[band_i] + rank),
+                    ),
+                ))
+            for p in processes:
+                p.start()
+            failed = wait_for_processes(processes)
+            if failed:
+                raise RuntimeError(f"{len(failed)} processes failed while processing bands {bands_split}")
+            scheduler.report_peak(max(peaks))
+            for band_i in bands_split:
+                for source in range(num_ranks):
+                    os.remove(run_path(args.shuffle_dir, band_i, source, rank))
+                mark_stage(args.shuffle_dir, band_i, rank, "reduced", {"segment": segment_path(args.lsh_out, band_i, first_sequences[band_i] + rank)})
+
+        if rank == 0 and not args.check_only:
+            logging.info(f"Waiting for {num_ranks} nodes to save their segments")
+            save_shuffled_manifests(args, list(range(args.bands)))
+    except BaseException:
+        mark_failed(args.shuffle_dir, rank)
+        raise
+
+    logging.info('-' * 120)
+    logging.info(f'Done processing LSH index in {time.time() - t0:.1f}s.')
+    logging.info('-' * 120)
 
 
 def generate_pairs(args):
     print()
 
     bands_inds = range(args.bands)
-    bands_splits = [list(x) for x in more_itertools.divide(args.num_nodes, bands_inds)]
-    if args.node_rank > -1:
-        bands_splits = [bands_splits[args.node_rank]]
-    if args.bands_parallel > 0:
-        bands_splits_flattened = [band for bands in bands_splits for band in bands]
-        bands_splits = [list(x) for x in more_itertools.chunked(bands_splits_flattened, args.bands_parallel)]
-    logging.info(f"Bands splits: {bands_splits}")
-
-    num_queues = max([len(x) for x in bands_splits])
-    doc_queues = [Queue(1_000_000) for _ in range(num_queues)]    
-
-    reader_shards = [[] for _ in range(args.reader_processes)]
+    if args.shuffle_dir:
+        # every node indexes its range of keys of all bands
+        if args.node_rank < 0:
+            raise ValueError("--shuffle-dir requires --node-rank")
+        if args.resume:
+            raise ValueError("--resume is not supported with --shuffle-dir: rerun the build with a new --shuffle-dir")
+        bands_splits = [list(bands_inds)]
+    else:
+        bands_splits = [list(x) for x in more_itertools.divide(args.num_nodes, bands_inds)]
+        if args.node_rank > -1:
+            bands_splits = [bands_splits[args.node_rank]]
+    bands = [band for split in bands_splits for band in split]
+    if args.resume:
+        finished = [band_idx for band_idx in bands if load_band_done(args.dupes_out, band_idx) is not None]
+        for band_idx in finished:
+            restore_finished_band(args, band_idx, load_band_done(args.dupes_out, band_idx))
+        bands = [band_idx for band_idx in bands if band_idx not in finished]
+        logging.info(f"Resuming: skipping {len(finished)} bands finished before, {len(bands)} bands left")
+        if not bands:
+            return
+
+    # documents are identified by their row in the concatenation of shards of their load path, and new load paths
+    # are appended to the registry of an existing index, so that ids stored in it stay valid
+    registry = DocRegistry()
+    if args.lsh_in and os.path.exists(registry_path(args.lsh_in)):
+        registry = DocRegistry.load(registry_path(args.lsh_in))
+    datasets_list = []
     total_length = 0
+    configs = {}
     for arg_load_path in args.load_path:        
-        mh_dirs = sorted(os.listdir(arg_load_path))
+        mh_dirs = list_shards(arg_load_path)
         logging.info(f'Loading {len(mh_dirs)} minhash shards from {arg_load_path}')
         mh_shards = []
         for mh_dir in tqdm(mh_dirs):
             load_path = os.path.join(arg_load_path, mh_dir)
+            configs[load_path] = load_minhash_config(load_path)
             mh_shards.append(datasets.load_from_disk(load_path))
         logging.info('Concatenating into a single dataset')
         mh_ds = datasets.concatenate_datasets(mh_shards)
         total_length += len(mh_ds)
-        logging.info(f'Splitting into {args.reader_processes} shards')
-        for i in range(args.reader_processes):
-            shard = mh_ds.shard(num_shards=args.reader_processes, index=i, contiguous=True)
-            reader_shards[i].append(shard)
-        
+        dataset_idx = registry.add(arg_load_path, num_rows=len(mh_ds))
+        datasets_list.append((dataset_idx, mh_ds))
+    start, end = 0, total_length
+    if args.shuffle_dir:
+        # nodes read contiguous ranges of documents, so that records of all nodes are shuffled in the order of document ids
+        start, end = total_length * args.node_rank // args.num_nodes, total_length * (args.node_rank + 1) // args.num_nodes
+        logging.info(f"Node {args.node_rank}: reading documents {start}-{end} of {total_length}")
+    if args.auto_schedule:
+        scheduler = plan_schedule(args, datasets_list, bands, end - start)
+    else:
+        scheduler = BandScheduler(bands, args.bands_parallel, n_readers=args.reader_processes)
+        logging.info(f"Bands splits: {[list(x) for x in more_itertools.chunked(bands, scheduler.bands_parallel)]}")
+    index_config = check_minhash_configs(configs, args)
+    # with --shuffle-dir, nodes write to the same folders, and the first one saves files shared by all of them
+    if not args.shuffle_dir or args.node_rank == 0:
+        # pairs files only have document ids, so the registry is saved next to them too, including with --check-only
+        registry.save(args.dupes_out.replace(".txt", "-registry.json"))
+        if not args.check_only:
+            registry.save(registry_path(args.lsh_out))
+            save_index_config(args.lsh_out, index_config)
+
+    if args.shuffle_dir:
+        generate_pairs_shuffled(args, scheduler, datasets_list, start, end)
+        return
+
     t0 = time.time()
-    for bands_split in bands_splits:
+    for bands_split in scheduler:
+        n_readers = scheduler.n_readers
+        logging.info(f'Splitting into {n_readers} shards')
+        reader_parts = get_reader_parts(datasets_list, start, end, n_readers)
+        # snapshots can only be resumed by readers reading the same parts of the same datasets
+        reader_layout = [[[dataset_idx, start_row, len(part)] for dataset_idx, start_row, part in parts] for parts in reader_parts]
+        checkpoints = {
+            band_idx: load_checkpoint(args.dupes_out, band_idx, args.pairs_format, reader_layout) if args.resume else None
+            for band_idx in bands_split
+        }
+        # every reader skips documents already processed by workers of all bands, and workers skip the rest of their documents
+        skips = [
+            min(checkpoints[band_idx]["reader_offsets"][process_id] if checkpoints[band_idx] else 0 for band_idx in bands_split)
+            for process_id in range(n_readers)
+        ]
         logging.info('-' * 120)
         logging.info(f"Processing bands: {bands_split}")
         logging.info('-' * 120)
-        processes = []
-        for q_i, band_i in enumerate(bands_split):
-            for process_id in range(args.reader_processes):
-                p = Process(
-                    target=get_hashes_band,
-                    args=(reader_shards[process_id], doc_queues[q_i], band_i, args.range, args.log_interval),
-                )
-                processes.append(p)
-                p.start()
+        doc_queues = [Queue(QUEUE_SIZE) for _ in bands_split]
+        peaks = Array("q", len(bands_split))
+        # every reader reads its part of the documents once and feeds workers of all bands of the split
+        readers = []
+        for process_id in range(n_readers):
+            p = Process(
+                target=get_hashes_bands,
+                args=(
+                    reader_parts[process_id], doc_queues[:len(bands_split)], bands_split, args.range, args.log_interval, args.band_keys,
+                    process_id, skips[process_id],
+                ),
+            )
+            readers.append(p)
+            p.start()
 
+        workers = []
+        for q_i, band_i in enumerate(bands_split):
             p = Process(
-                target=lsh_process,
-                args=(args.dupes_out, args.lsh_in, args.lsh_out, doc_queues[q_i], q_i, band_i, args.log_interval, total_length, args.check_only),
+                target=run_measured,
+                args=(
+                    peaks, q_i, lsh_process,
+                    args.dupes_out, args.lsh_in, args.lsh_out, doc_queues[q_i], q_i, band_i, args.log_interval, total_length,
+                    args.check_only, n_readers, int(args.memory_budget * 2**30), args.spill_dir, args.max_segments,
+                    args.pairs_format, None, checkpoints[band_i], args.checkpoint_interval, reader_layout,
+                ),
             )
-            processes.append(p)
+            workers.append(p)
             p.start()
 
-        for p in processes:
-            p.join()
+        failed = wait_for_processes(readers + workers)
+        if failed:
+            raise RuntimeError(f"{len(failed)} processes failed while processing bands {bands_split}")
+        scheduler.report_peak(max(peaks))
 
     logging.info('-' * 120)
     logging.info(f'Done processing LSH index in {time.time() - t0:.1f}s.')
@@ -184,16 +677,64 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--load-path", nargs="+", type=str, required=True, help="Path to a folder with shards from minhashing step")
     parser.add_argument("--check-only", action="store_true", help="Only check existing LSH index")
-    parser.add_argument("--dupes-out", type=str, required=True, help="Output text file with duplicates")
-    parser.add_argument("--lsh-in", type=str, help="Pickle file with LSH index to load")
-    parser.add_argument("--lsh-out", type=str, required=True, help="Output pickle file with LSH index")
+    parser.add_argument(
+        "--dupes-out", type=str, required=True,
+        help="Output text file with duplicates: pairs of document ids are saved in <name>-<band index>.txt files and the registry of datasets in <name>-registry.json"
+    )
+    parser.add_argument(
+        "--lsh-in", type=str,
+        help="Path prefix of LSH index to extend or check against. Its segments are memory-mapped and never rewritten (see lsh_index.py)"
+    )
+    parser.add_argument(
+        "--lsh-out", type=str, required=True,
+        help="Path prefix of LSH index to save. It can be the same as --lsh-in to add a segment of new documents to that index in place"
+    )
+    parser.add_argument(
+        "--max-segments", type=int, default=0,
+        help="Compact bands of the saved index into one segment when they have more segments than this. Never compact if 0"
+    )
     parser.add_argument("--range", type=int, required=True, help="Range of LSH index")
     parser.add_argument("--bands", type=int, required=True, help="Number of bands of LSH index")
     parser.add_argument("--num-nodes", type=int, default=1, help="Number of nodes for dsitributed processing")
     parser.add_argument("--node-rank", type=int, default=-1, help="Rank of the node")
     parser.add_argument("--bands-parallel", type=int, default=-1, help="Number of bands to be processed in parallel")
-    parser.add_argument("--reader-processes", type=int, default=1, help="Number of reader processes per band to populate document queues")
+    parser.add_argument("--reader-processes", type=int, default=1, help="Number of reader processes that populate document queues of all bands processed in parallel")
     parser.add_argument("--log-interval", type=int, default=100_000, help="Interval of logging/updating progress bar")
+    parser.add_argument(
+        "--memory-budget", type=float, default=0,
+        help="Memory budget of every band worker in GB. If set, documents are spilled to --spill-dir and sorted in partitions that fit into "
+             "the budget instead of keeping a hash table of the whole band in RAM"
+    )
+    parser.add_argument("--spill-dir", type=str, default=tempfile.gettempdir(), help="Folder on local disk for documents spilled with --memory-budget")
+    parser.add_argument(
+        "--band-keys", action="store_true",
+        help="Read precomputed uint64 band keys saved by compute_minhash.py --compact --bands instead of computing keys from hashvalues"
+    )
+    parser.add_argument(
+        "--auto-schedule", action="store_true",
+        help="Choose --bands-parallel and --reader-processes from available memory and cores and the estimated memory of a band, "
+             "and re-plan bands in parallel after every group of bands from the peak memory it used"
+    )
+    parser.add_argument("--max-memory", type=float, default=0, help=f"Memory in GB planned with --auto-schedule. {MEMORY_FRACTION:.0%}% of available memory by default")
+    parser.add_argument(
+        "--shuffle-dir", type=str,
+        help="Folder on storage shared by all --num-nodes nodes. If set, every node indexes a range of keys of all bands instead of "
+             "all keys of some bands, receiving records of its keys from other nodes through this folder. Use a new folder for every build"
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Resume an interrupted build with the same arguments: skip bands marked as done next to --dupes-out, "
+             "and resume other bands from their last snapshot saved with --checkpoint-interval"
+    )
+    parser.add_argument(
+        "--checkpoint-interval", type=int, default=0,
+        help="Save a snapshot of every band worker each time it has processed this many documents. Never if 0. "
+             "Every snapshot rewrites all new entries of the band, and snapshots are not saved with --memory-budget"
+    )
+    parser.add_argument(
+        "--pairs-format", type=str, default="text", choices=PAIRS_FORMATS,
+        help="Format of duplicate pairs files: text lines, or zstd-compressed blocks of uint64 pairs saved with .pairs extension"
+    )
     args = parser.parse_args()
 
     generate_pairs(args)
@@ -0,0 +1,110 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Progress of a band is kept next to its pairs file <dupes>-<band>.<ext>, where <dupes> is --dupes-out without .txt:
+#   .<dupes>-<band>.<ext>.tmp           pairs being written, renamed to <dupes>-<band>.<ext> once the band is complete
+#   <dupes>-<band>.checkpoint.json      last snapshot: documents consumed from every reader and bytes of pairs written by then
+#   <dupes>-<band>.checkpoint-<k>.npy   entries of the in-memory part of the band at snapshot k
+#   <dupes>-<band>.done                 written once pairs of the band are complete, with segments of the band
+
+from typing import List, Optional
+import glob
+import json
+import os
+import numpy as np
+
+from zyda.lsh_minhash.band_index import save_entries
+from zyda.utils.common import write_json_atomic
+from zyda.utils.pairs import PAIRS_EXTENSIONS
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+def band_prefix(dupes_out: str, band_idx: int) -> str:
+    return dupes_out.replace(".txt", f"-{band_idx}")
+
+
+def pairs_path(dupes_out: str, band_idx: int, pairs_format: str) -> str:
+    return band_prefix(dupes_out, band_idx) + PAIRS_EXTENSIONS[pairs_format]
+
+
+def tmp_pairs_path(dupes_out: str, band_idx: int, pairs_format: str) -> str:
+    path = pairs_path(dupes_out, band_idx, pairs_format)
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+
+
+def checkpoint_path(dupes_out: str, band_idx: int) -> str:
+    return f"{band_prefix(dupes_out, band_idx)}.checkpoint.json"
+
+
+def done_path(dupes_out: str, band_idx: int) -> str:
+    return f"{band_prefix(dupes_out, band_idx)}.done"
+
+
+def save_checkpoint(dupes_out: str, band_idx: int, state: dict, entries: np.ndarray):
+    """
+    Saves a snapshot of a band. Entries are saved to a new file before the snapshot refers to it,
+    so the last complete snapshot stays valid if this one is interrupted.
+    """
+    previous = load_checkpoint_state(dupes_out, band_idx)
+    snapshot = previous["snapshot"] + 1 if previous else 0
+    entries_path = f"{band_prefix(dupes_out, band_idx)}.checkpoint-{snapshot}.npy"
+    save_entries(entries_path, entries)
+    write_json_atomic(checkpoint_path(dupes_out, band_idx), {**state, "snapshot": snapshot, "entries": os.path.basename(entries_path)})
+    if previous:
+        os.remove(os.path.join(os.path.dirname(entries_path), previous["entries"]))
+
+
+def load_checkpoint_state(dupes_out: str, band_idx: int) -> Optional[dict]:
+    path = checkpoint_path(dupes_out, band_idx)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_checkpoint(dupes_out: str, band_idx: int, pairs_format: str, reader_layout: List[list]) -> Optional[dict]:
+    """
+    Returns the last snapshot of a band with the path of its entries, or None if there is none that can be resumed:
+    documents consumed from readers can only be skipped if readers read the same parts of datasets as when it was saved.
+    """
+    state = load_checkpoint_state(dupes_out, band_idx)
+    if state is None:
+        return None
+    tmp_path = tmp_pairs_path(dupes_out, band_idx, pairs_format)
+    if state["reader_layout"] != reader_layout:
+        logging.warning(f"Band {band_idx}: snapshot was saved with different reader processes or datasets, so the band is started from scratch")
+        return None
+    if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) < state["pairs_bytes"]:
+        logging.warning(f"Band {band_idx}: pairs written before the snapshot are missing, so the band is started from scratch")
+        return None
+    return {**state, "entries": os.path.join(os.path.dirname(checkpoint_path(dupes_out, band_idx)), state["entries"])}
+
+
+def clear_checkpoint(dupes_out: str, band_idx: int):
+    for path in glob.glob(f"{glob.escape(band_prefix(dupes_out, band_idx))}.checkpoint*"):
+        os.remove(path)
+
+
+def mark_band_done(dupes_out: str, band_idx: int, segment_paths: Optional[List[str]]):
+    write_json_atomic(done_path(dupes_out, band_idx), {"segments": segment_paths})
+
+
+def load_band_done(dupes_out: str, band_idx: int) -> Optional[dict]:
+    path = done_path(dupes_out, band_idx)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
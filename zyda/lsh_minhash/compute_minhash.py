@@ -15,10 +15,26 @@
 
 import os
 import argparse
+import shutil
+import multiprocessing
+from typing import List, Optional, Tuple
+import numpy as np
 import datasets
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasketch import MinHash
 from collections import defaultdict
-from zyda.utils.text import get_features
+from tqdm import tqdm
+from zyda.utils.common import atomic_output_dir, commit_output_dir, list_shards, release_lock, try_lock
+from zyda.utils.text import get_features, shingle_hashes_column
+from zyda.lsh_minhash.minhash import (
+    band_key_column,
+    band_keys,
+    minhash_hashes,
+    minhash_texts,
+    one_permutation_hashes,
+    save_minhash_config,
+)
 
 import nltk
 nltk.download('punkt')
@@ -27,6 +43,35 @@ import logging
 logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
 
 COLUMNS_TO_SAVE = ["dataset_name", "shard", "shard_index", "global_index"]
+# Seed of datasketch.MinHash permutations
+SEED = 1
+# Hidden folders in --save-path with outputs of finished chunks and lock files of claimed ones
+CHUNKS_DIR = ".chunks"
+LOCKS_DIR = ".locks"
+
+
+def signatures_to_columns(signatures: np.ndarray, compact: bool = False, bands: int = 0, r: int = 0):
+    """
+    Legacy format has seed and variable-length uint64 hashvalues in every row.
+    Compact format has fixed-size uint32 hashvalues, with the seed saved once in minhash_config.json,
+    and optionally a uint64 key of every band in band_key_<band> columns.
+    """
+    if not compact:
+        return {"seed": [SEED] * len(signatures), "hashvalues": list(signatures)}
+    columns = {"hashvalues": signatures.astype(np.uint32)}
+    if bands:
+        keys = band_keys(signatures, bands, r)
+        for band_idx in range(bands):
+            columns[band_key_column(band_idx)] = keys[:, band_idx]
+    return columns
+
+
+def compact_features(shard_features: datasets.Features, num_perm: int, bands: int = 0) -> datasets.Features:
+    features = datasets.Features({col: shard_features[col] for col in COLUMNS_TO_SAVE})
+    features["hashvalues"] = datasets.Sequence(datasets.Value("uint32"), length=num_perm)
+    for band_idx in range(bands):
+        features[band_key_column(band_idx)] = datasets.Value("uint64")
+    return features
 
 
 def to_minhash(
@@ -34,6 +79,20 @@ def to_minhash(
     key: str = "transformed_text",
     width: int = 13,
     num_perm: int = 128,
+    one_permutation: bool = False,
+    compact: bool = False,
+    bands: int = 0,
+    r: int = 0,
+):
+    signatures = minhash_texts(batch[key], width=width, num_perm=num_perm, seed=SEED, one_permutation=one_permutation)
+    return signatures_to_columns(signatures, compact=compact, bands=bands, r=r)
+
+
+def to_minhash_datasketch(
+    batch,
+    key: str = "transformed_text",
+    width: int = 13,
+    num_perm: int = 128,
 ):
     output = defaultdict(list)
     for text in batch[key]:
@@ -44,37 +103,239 @@ def to_minhash(
     return output
 
 
+def to_minhash_from_shingle_hashes(
+    batch: pa.Table,
+    key: str,
+    num_perm: int = 128,
+    one_permutation: bool = False,
+    compact: bool = False,
+    bands: int = 0,
+    r: int = 0,
+):
+    """
+    Same as to_minhash(), but takes an Arrow batch with hashes of shingles saved by preprocess_and_filter.py --shingle-width.
+    Columns of the batch are not kept by map() in Arrow format, so key columns of documents are returned too.
+    """
+    column = batch.column(key).combine_chunks()
+    lengths = pc.list_value_length(column).to_numpy(zero_copy_only=False)
+    engine = one_permutation_hashes if one_permutation else minhash_hashes
+    signatures = engine(column.flatten().to_numpy(), lengths, num_perm=num_perm, seed=SEED)
+    columns = {col: batch.column(col).to_numpy() for col in COLUMNS_TO_SAVE}
+    columns.update(signatures_to_columns(signatures, compact=compact, bands=bands, r=r))
+    return columns
+
+
+def minhash_shard(shard: datasets.Dataset, args) -> datasets.Dataset:
+    format_kwargs = {"compact": args.compact, "bands": args.bands, "r": args.range}
+    if args.use_shingle_hashes:
+        key = shingle_hashes_column(args.width)
+        if key not in shard.column_names:
+            raise ValueError(f"Column {key} not found: run preprocess_and_filter.py with --shingle-width {args.width}")
+        shard = shard.with_format("arrow")
+        minhash_fn = lambda batch: to_minhash_from_shingle_hashes(
+            batch, key=key, num_perm=args.num_perm, one_permutation=args.one_permutation, **format_kwargs,
+        )
+    elif args.engine == "datasketch":
+        minhash_fn = lambda batch: to_minhash_datasketch(batch, key=args.key, width=args.width, num_perm=args.num_perm)
+    else:
+        minhash_fn = lambda batch: to_minhash(
+            batch, key=args.key, width=args.width, num_perm=args.num_perm, one_permutation=args.one_permutation, **format_kwargs,
+        )
+
+    minhashes = shard.map(
+        minhash_fn,
+        batched=True,
+        keep_in_memory=True,
+        remove_columns=[col for col in shard.column_names if col not in COLUMNS_TO_SAVE],
+        features=compact_features(shard.features, args.num_perm, args.bands) if args.compact else None,
+    ).with_format(None)
+    # documents are looked up by these columns when duplicates are removed
+    missing = [col for col in COLUMNS_TO_SAVE if col not in minhashes.column_names]
+    if missing:
+        raise ValueError(f"Minhashes are missing columns {missing} of documents")
+    return minhashes
+
+
+def chunk_path(save_path: str, shard_dir: str, chunk_idx: int) -> str:
+    return os.path.join(save_path, CHUNKS_DIR, shard_dir, f"chunk_{chunk_idx:05d}")
+
+
+def lock_path(save_path: str, shard_dir: str, name: str) -> str:
+    return os.path.join(save_path, LOCKS_DIR, f"{shard_dir}-{name}.lock")
+
+
+# Shards are memory-mapped, so every worker process opens each shard only once
+LOADED_SHARDS = {}
+def get_shard(load_path: str) -> datasets.Dataset:
+    if load_path not in LOADED_SHARDS:
+        LOADED_SHARDS.clear()
+        LOADED_SHARDS[load_path] = datasets.load_from_disk(load_path)
+    return LOADED_SHARDS[load_path]
+
+
+def process_chunk(task: Tuple[str, str, str, int, int, int, int], args) -> Optional[Tuple[str, str]]:
+    """
+    Computes minhashes of rows [start, end) of a shard, unless another process has already claimed or finished them.
+    Returns the shard if all of its chunks are done after this one, so that it can be finalized.
+    """
+    load_path, save_path, shard_dir, chunk_idx, start, end, n_chunks = task
+    output_path = chunk_path(save_path, shard_dir, chunk_idx)
+    lock = lock_path(save_path, shard_dir, f"chunk_{chunk_idx:05d}")
+
+    def is_done():
+        # chunks are removed only after the shard is finalized, so the chunk has to be checked first
+        return os.path.exists(output_path) or os.path.exists(os.path.join(save_path, shard_dir))
+
+    if not is_done() and try_lock(lock):
+        try:
+            # the chunk might have been finished between the check and claiming it
+            if not is_done():
+                chunk = get_shard(os.path.join(load_path, shard_dir)).select(range(start, end))
+                tmp_path = atomic_output_dir(output_path)
+                minhash_shard(chunk, args).save_to_disk(tmp_path)
+                commit_output_dir(tmp_path, output_path)
+        finally:
+            release_lock(lock)
+    if os.path.exists(os.path.join(save_path, shard_dir)):
+        return None
+    if all(os.path.exists(chunk_path(save_path, shard_dir, i)) for i in range(n_chunks)):
+        return save_path, shard_dir
+    return None
+
+
+def finalize_shard(save_path: str, shard_dir: str, n_chunks: int, config: dict):
+    """
+    Concatenates chunks of a shard into its final folder. Only one process finalizes every shard.
+    """
+    output_path = os.path.join(save_path, shard_dir)
+    lock = lock_path(save_path, shard_dir, "finalize")
+    if os.path.exists(output_path) or not try_lock(lock):
+        return
+    try:
+        if not os.path.exists(output_path):
+            chunks = [datasets.load_from_disk(chunk_path(save_path, shard_dir, i)) for i in range(n_chunks)]
+            tmp_path = atomic_output_dir(output_path)
+            datasets.concatenate_datasets(chunks).save_to_disk(tmp_path, max_shard_size="8GB")
+            save_minhash_config(tmp_path, config)
+            commit_output_dir(tmp_path, output_path)
+            logging.info(f"Saved minhash to: {output_path}")
+        shutil.rmtree(os.path.join(save_path, CHUNKS_DIR, shard_dir), ignore_errors=True)
+    finally:
+        release_lock(lock)
+
+
+def list_tasks(load_paths: List[str], save_paths: List[str], chunk_size: int, from_scratch: bool) -> List[Tuple]:
+    tasks = []
+    for load_path, save_path in zip(load_paths, save_paths):
+        shards_dirs = list_shards(load_path)
+        logging.info(f"Found {len(shards_dirs)} shards in {load_path}")
+        for shard_dir in shards_dirs:
+            if os.path.exists(os.path.join(save_path, shard_dir)):
+                if not from_scratch:
+                    logging.info(f"{shard_dir} of {load_path}: already processed!")
+                    continue
+                shutil.rmtree(os.path.join(save_path, shard_dir))
+                shutil.rmtree(os.path.join(save_path, CHUNKS_DIR, shard_dir), ignore_errors=True)
+            n_rows = len(datasets.load_from_disk(os.path.join(load_path, shard_dir)))
+            bounds = list(range(0, n_rows, chunk_size)) + [n_rows]
+            # empty shards still get one empty chunk, so that their output exists
+            n_chunks = max(len(bounds) - 1, 1)
+            for chunk_idx in range(n_chunks):
+                tasks.append((load_path, save_path, shard_dir, chunk_idx, bounds[chunk_idx], bounds[min(chunk_idx + 1, len(bounds) - 1)], n_chunks))
+    return tasks
+
+
+def remove_empty_dirs(save_path: str):
+    # other nodes may still be working, in which case these folders are not empty and stay in place
+    for name in [CHUNKS_DIR, LOCKS_DIR]:
+        try:
+            os.rmdir(os.path.join(save_path, name))
+        except OSError:
+            pass
+
+
+WORKER_ARGS = None
+def init_worker(args):
+    global WORKER_ARGS
+    WORKER_ARGS = args
+
+
+def process_chunk_in_worker(task):
+    return process_chunk(task, WORKER_ARGS)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--load-path', type=str, required=True, help='Path to folder with preprocessed shards')
-    parser.add_argument('--save-path', type=str, required=True, help='Path to folder to where we save ')
-    parser.add_argument('--num-proc', type=int, default=1, help='Number of processes')
+    parser.add_argument('--load-path', nargs='+', type=str, required=True, help='Paths to folders with preprocessed shards')
+    parser.add_argument('--save-path', nargs='+', type=str, required=True, help='Paths to folders to where we save minhashes, one per --load-path')
+    parser.add_argument('--num-proc', type=int, default=1, help='Number of worker processes shared by all shards')
+    parser.add_argument('--chunk-size', type=int, default=100_000, help='Number of rows of a shard processed by a worker at once')
     parser.add_argument('--key', type=str, default='transformed_text', help='Key to use for minhashing')
     parser.add_argument('--width', type=int, default=13, help='n-grams size for minhashes')
     parser.add_argument('--num-perm', type=int, default=128, help='Number of permutation for computing minhashes')
-    parser.add_argument('--from-scratch', action='store_true', help='If specified, will forcefully do every shard regardless of previous progress')
+    parser.add_argument('--from-scratch', action='store_true', help='If specified, will forcefully do every shard regardless of previous progress. Must not be used while other nodes are running')
+    parser.add_argument(
+        '--use-shingle-hashes', action='store_true',
+        help='If specified, minhashes are computed from shingle hashes saved by preprocess_and_filter.py --shingle-width instead of from --key'
+    )
+    parser.add_argument(
+        '--engine', type=str, default='numpy', choices=['numpy', 'datasketch'],
+        help='numpy computes minhashes of a whole batch with vectorized operations, datasketch builds one MinHash object per document. Both produce identical minhashes'
+    )
+    parser.add_argument(
+        '--one-permutation', action='store_true',
+        help='If specified, signatures are computed with one-permutation hashing and densification, at a cost independent of --num-perm. '
+             'Such signatures must not be indexed together with classic ones'
+    )
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='If specified, minhashes are saved as fixed-size uint32 arrays, and the seed is saved once in minhash_config.json'
+    )
+    parser.add_argument('--bands', type=int, default=0, help='If specified with --compact, a uint64 key of every band is saved in band_key_<band> columns')
+    parser.add_argument('--range', type=int, default=0, help='Range of LSH bands, required with --bands')
     args = parser.parse_args()
+    if args.one_permutation and args.engine == "datasketch":
+        parser.error("--one-permutation is only supported by numpy engine")
+    if args.compact and args.engine == "datasketch":
+        parser.error("--compact is only supported by numpy engine")
+    if args.bands and not (args.compact and args.range):
+        parser.error("--bands requires --compact and --range")
+    if args.bands * args.range > args.num_perm:
+        parser.error(f"{args.bands} bands of range {args.range} don't fit into {args.num_perm} permutations")
+    if len(args.load_path) != len(args.save_path):
+        parser.error("--load-path and --save-path must have the same number of folders")
+    config = {
+        "format": "compact" if args.compact else "legacy",
+        "seed": SEED,
+        "num_perm": args.num_perm,
+        "width": args.width,
+        "one_permutation": args.one_permutation,
+        "bands": args.bands,
+        "range": args.range,
+    }
 
-    shards_dirs = sorted(os.listdir(args.load_path))
-    logging.info(f"Found {len(shards_dirs)} shards")
-    for i, shard_dir in enumerate(shards_dirs):
-        load_path = os.path.join(args.load_path, shard_dir)
-        save_path = os.path.join(args.save_path, shard_dir)
-        print()
-        logging.info(f"Processing shard {i + 1} / {len(shards_dirs)} from {load_path}")
-        if os.path.exists(save_path) and not args.from_scratch:
-            logging.info(f"Already processed!")
-            continue
-        
-        shard = datasets.load_from_disk(load_path)
-        logging.info(f"Cache cleaned: {shard.cleanup_cache_files()}")
-
-        shard_minhash = shard.map(
-            lambda batch: to_minhash(batch, key=args.key, width=args.width, num_perm=args.num_perm),
-            batched=True,
-            num_proc=args.num_proc,
-            remove_columns=[col for col in shard.column_names if col not in COLUMNS_TO_SAVE]
-        )
-        logging.info(f"Saving minhash to: {save_path}")
-        shard_minhash.save_to_disk(save_path, max_shard_size="8GB")
-        logging.info(f"Cache cleaned: {shard.cleanup_cache_files()}")
+    tasks = list_tasks(args.load_path, args.save_path, args.chunk_size, args.from_scratch)
+    n_chunks = {(task[1], task[2]): task[6] for task in tasks}
+    logging.info(f"Processing {len(tasks)} chunks of {len(n_chunks)} shards with {args.num_proc} processes")
+
+    # one pool processes chunks of all shards, so workers don't idle at shard boundaries
+    if args.num_proc > 1:
+        pool = multiprocessing.Pool(args.num_proc, initializer=init_worker, initargs=(args,))
+        results = pool.imap_unordered(process_chunk_in_worker, tasks)
+    else:
+        pool = None
+        results = (process_chunk(task, args) for task in tasks)
+    done = set()
+    for result in tqdm(results, total=len(tasks)):
+        if result is not None and result not in done:
+            done.add(result)
+            finalize_shard(*result, n_chunks[result], config)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    unfinished = [shard for shard in n_chunks if shard not in done]
+    if unfinished:
+        logging.info(f"{len(unfinished)} shards have chunks claimed by other processes, which will finalize them: {unfinished}")
+    for save_path in args.save_path:
+        remove_empty_dirs(save_path)
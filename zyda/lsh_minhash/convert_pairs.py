@@ -0,0 +1,51 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import tqdm
+
+from zyda.utils.common import ensure_directory_exists
+from zyda.utils.pairs import PAIRS_EXTENSIONS, PAIRS_FORMATS, open_pair_writer, read_pairs
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts files of duplicate pairs written by build_lsh_index.py between text and binary formats")
+    parser.add_argument("--input-files", nargs="+", type=str, required=True, help="Files with duplicate pairs, in either format")
+    parser.add_argument("--to", type=str, default="binary", choices=PAIRS_FORMATS, help="Format of converted files")
+    parser.add_argument("--out-dir", type=str, help="Folder for converted files. Next to input files by default")
+    parser.add_argument("--delete-input", action="store_true", help="Delete every input file once it is converted")
+    args = parser.parse_args()
+
+    for input_file in args.input_files:
+        name = os.path.splitext(os.path.basename(input_file))[0] + PAIRS_EXTENSIONS[args.to]
+        out_file = os.path.join(args.out_dir or os.path.dirname(input_file), name)
+        if os.path.abspath(out_file) == os.path.abspath(input_file):
+            raise ValueError(f"{input_file} would be overwritten by its conversion: use --out-dir")
+        ensure_directory_exists(out_file)
+        # pairs are written to a temporary file first, so that an interrupted conversion doesn't leave a valid-looking file
+        tmp_file = os.path.join(os.path.dirname(out_file), f".{name}.tmp")
+        n = 0
+        with open_pair_writer(tmp_file, args.to) as writer, tqdm.tqdm(desc=input_file, unit="dupes", unit_scale=True) as pbar:
+            for pairs in read_pairs(input_file):
+                writer.write(pairs[:, 0], pairs[:, 1])
+                n += len(pairs)
+                pbar.update(len(pairs))
+        os.replace(tmp_file, out_file)
+        logging.info(f"Converted {n} pairs from {input_file} to {out_file} ({os.path.getsize(out_file) / max(os.path.getsize(input_file), 1):.2f} of the size)")
+        if args.delete_input:
+            os.remove(input_file)
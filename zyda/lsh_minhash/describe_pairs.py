@@ -0,0 +1,39 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import tqdm
+
+from zyda.utils.common import ensure_directory_exists
+from zyda.utils.doc_ids import DocRegistry
+from zyda.utils.pairs import read_pairs
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts pairs of document ids to human-readable dataset_name@shard@shard_index@global_index keys")
+    parser.add_argument("--input-file", type=str, required=True, help="File with duplicate pairs written by build_lsh_index.py, in either format")
+    parser.add_argument("--registry", type=str, required=True, help="Registry of datasets saved by build_lsh_index.py next to duplicate pairs")
+    parser.add_argument("--out-file", type=str, required=True, help="Output text file with pairs of document keys")
+    args = parser.parse_args()
+
+    registry = DocRegistry.load(args.registry)
+    ensure_directory_exists(args.out_file)
+    with open(args.out_file, "w") as fout, tqdm.tqdm(unit="dupes", unit_scale=True) as pbar:
+        for pairs in read_pairs(args.input_file):
+            fout.writelines(f"{a} :: {b}\n" for a, b in zip(registry.describe(pairs[:, 0]), registry.describe(pairs[:, 1])))
+            pbar.update(len(pairs))
+    logging.info(f"Saved pairs to {args.out_file}")
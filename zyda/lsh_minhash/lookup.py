@@ -0,0 +1,209 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Sequence, Tuple
+import argparse
+import json
+import os
+import socketserver
+import time
+import numpy as np
+
+from zyda.lsh_minhash.band_index import SegmentedBandIndex, load_entries
+from zyda.lsh_minhash.lsh_index import load_index_config, load_segment_paths, registry_path
+from zyda.lsh_minhash.minhash import MAX_HASH, band_keys, minhash_texts
+from zyda.utils.doc_ids import NO_DOC, DocRegistry
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+
+class LSHLookup:
+    """
+    Finds near-duplicate candidates of new documents in an LSH index built by build_lsh_index.py, without modifying it.
+    Segments of bands are memory-mapped, so the index is loaded in constant time and only pages touched by queries are read.
+    Candidates are the documents stored for band keys of a query, i.e. the first indexed document of every matching bucket,
+    and their Jaccard similarity with the query is estimated from their minhash signatures in registered datasets.
+    Segments are read when the lookup is created: segments added to the index later are only seen by a new lookup.
+    """
+    def __init__(self, lsh_path: str, bands: Optional[Sequence[int]] = None):
+        self.config = load_index_config(lsh_path)
+        if self.config is None:
+            raise ValueError(f"LSH index {lsh_path} has no config with its minhash parameters: rebuild it with build_lsh_index.py")
+        self.bands = list(bands) if bands is not None else list(range(self.config["bands"]))
+        self.indexes = []
+        for band_idx in self.bands:
+            segment_paths = load_segment_paths(lsh_path, band_idx)
+            if segment_paths is None:
+                raise FileNotFoundError(f"Band {band_idx} of LSH index {lsh_path} doesn't exist")
+            self.indexes.append(SegmentedBandIndex([load_entries(path) for path in segment_paths]))
+        self.registry = DocRegistry.load(registry_path(lsh_path))
+        # signatures of candidates are read from memory-mapped datasets, which are opened upfront to keep first queries fast
+        for path in self.registry.paths:
+            self.registry.dataset(path, ("hashvalues",))
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """
+        Computes minhash signatures of texts with parameters of the index. Texts have to be preprocessed the same way
+        as the column minhashed by compute_minhash.py for their signatures to be comparable.
+        """
+        return minhash_texts(
+            texts, width=self.config["width"], num_perm=self.config["num_perm"],
+            seed=self.config["seed"], one_permutation=self.config["one_permutation"],
+        )
+
+    def query(self, signatures: np.ndarray, min_jaccard: float = 0.0) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns candidates of a batch of signatures of shape (n, num_perm): for every signature, ids of candidate documents
+        and their estimated Jaccard similarity, sorted by decreasing similarity and filtered by min_jaccard.
+        """
+        signatures = np.asarray(signatures, dtype=np.uint64)
+        if signatures.ndim != 2 or signatures.shape[1] != self.config["num_perm"]:
+            raise ValueError(f"Signatures have shape {signatures.shape} instead of (n, {self.config['num_perm']})")
+        r = self.config["range"]
+        keys = band_keys(signatures, self.config["bands"], r)
+        candidates = np.stack([index.get(keys[:, band_idx]) for band_idx, index in zip(self.bands, self.indexes)], axis=1)
+
+        # a document can be stored for several bands of a query, so (query, document) pairs are deduplicated
+        queries, band_positions = np.nonzero(candidates != NO_DOC)
+        docs = candidates[queries, band_positions]
+        order = np.lexsort((docs, queries))
+        queries, docs = queries[order], docs[order]
+        distinct = np.ones(len(docs), dtype=bool)
+        distinct[1:] = (queries[1:] != queries[:-1]) | (docs[1:] != docs[:-1])
+        queries, docs = queries[distinct], docs[distinct]
+
+        unique_docs, inverse = np.unique(docs, return_inverse=True)
+        doc_signatures = self.registry.hashvalues(unique_docs, self.config["num_perm"])
+        jaccard = (doc_signatures[inverse] == signatures[queries]).mean(axis=1)
+
+        keep = jaccard >= min_jaccard
+        queries, docs, jaccard = queries[keep], docs[keep], jaccard[keep]
+        order = np.lexsort((-jaccard, queries))
+        queries, docs, jaccard = queries[order], docs[order], jaccard[order]
+        bounds = np.searchsorted(queries, np.arange(len(signatures) + 1))
+        return [(docs[start:end], jaccard[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def query_texts(self, texts: List[str], min_jaccard: float = 0.0) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return self.query(self.signatures(texts), min_jaccard=min_jaccard)
+
+
+def check_request(request):
+    """
+    Raises TypeError unless a query has either a list of texts or a list of signatures, each of them a list of values,
+    and ValueError if minhash values are out of range.
+    """
+    if not isinstance(request, dict):
+        raise TypeError("Request must be a JSON object")
+    if "texts" in request:
+        if not isinstance(request["texts"], list) or not all(isinstance(text, str) for text in request["texts"]):
+            raise TypeError("texts must be a list of strings")
+    elif "signatures" in request:
+        if not isinstance(request["signatures"], list) or not all(isinstance(signature, list) for signature in request["signatures"]):
+            raise TypeError("signatures must be a list of lists of minhash values")
+        for signature in request["signatures"]:
+            if not all(isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_HASH for value in signature):
+                raise ValueError(f"minhash values of signatures must be integers from 0 to {MAX_HASH}")
+    else:
+        raise KeyError("Request must have texts or signatures")
+    if not isinstance(request.get("min_jaccard", 0.0), (int, float)) or isinstance(request.get("min_jaccard"), bool):
+        raise TypeError("min_jaccard must be a number")
+
+
+def make_handler(lookup: LSHLookup):
+    class LookupHandler(BaseHTTPRequestHandler):
+        """
+        GET /config returns the config of the index.
+        POST /query takes {"texts": [...]} or {"signatures": [[...], ...]}, optionally with "min_jaccard" and "describe",
+        and returns {"results": [[{"doc_id", "jaccard", "key"}, ...], ...]} with one list of candidates per query.
+        """
+        def send_json(self, status: int, data: dict):
+            body = json.dumps(data).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/config":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            self.send_json(200, {**lookup.config, "bands_loaded": lookup.bands, "datasets": lookup.registry.paths})
+
+        def do_POST(self):
+            if self.path != "/query":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                check_request(request)
+                t0 = time.time()
+                if "texts" in request:
+                    signatures = lookup.signatures(request["texts"])
+                else:
+                    signatures = np.array(request["signatures"], dtype=np.uint64).reshape(len(request["signatures"]), -1)
+                results = lookup.query(signatures, min_jaccard=request.get("min_jaccard", 0.0))
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            results = [
+                [{"doc_id": doc, "jaccard": j} for doc, j in zip(docs.tolist(), jaccard.tolist())]
+                for docs, jaccard in results
+            ]
+            if request.get("describe"):
+                candidates = [candidate for candidates in results for candidate in candidates]
+                keys = lookup.registry.describe(np.array([candidate["doc_id"] for candidate in candidates], dtype=np.uint64))
+                for candidate, key in zip(candidates, keys):
+                    candidate["key"] = key
+            self.send_json(200, {"results": results, "seconds": time.time() - t0})
+
+        def address_string(self):
+            # clients of Unix sockets have no address
+            return self.client_address[0] if self.client_address else "unix"
+
+    return LookupHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves lookups of near-duplicate candidates of new documents in an LSH index over HTTP")
+    parser.add_argument("--lsh-path", type=str, required=True, help="Path prefix of LSH index built by build_lsh_index.py")
+    parser.add_argument("--bands", nargs="+", type=int, help="Bands to load. All bands of the index by default")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--unix-socket", type=str, help="Listen on this Unix socket instead of a TCP port")
+    args = parser.parse_args()
+
+    lookup = LSHLookup(args.lsh_path, bands=args.bands)
+    logging.info(f"Loaded {len(lookup.bands)} bands of {args.lsh_path} with {sum(len(index) for index in lookup.indexes)} entries")
+    handler = make_handler(lookup)
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        logging.info(f"Listening on {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        logging.info(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
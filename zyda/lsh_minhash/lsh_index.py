@@ -0,0 +1,165 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# On-disk layout of an LSH index with path prefix <prefix>:
+#   <prefix>-registry.json            datasets whose documents are indexed (zyda.utils.doc_ids.DocRegistry)
+#   <prefix>-config.json              bands, range and minhash parameters of the index
+#   <prefix>-<band>.json              manifest of a band: list of its segments, oldest first
+#   <prefix>-<band>-<sequence>.npy    segment: sorted (key, doc) entries with keys that are not in older segments of the band
+# Manifests refer to segments by paths relative to their folder, so an index built with --lsh-in of another index
+# lists segments of that index without copying them.
+
+from typing import List, Optional
+import argparse
+import glob
+import json
+import os
+import re
+import tempfile
+
+from zyda.lsh_minhash.band_index import load_entries, merge_entries
+from zyda.utils.common import ensure_directory_exists
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+# Memory budget for merging segments when compacting bands during indexing
+COMPACTION_MEMORY_BUDGET = 4 * 2**30
+
+
+def index_prefix(lsh_path: str) -> str:
+    # --lsh-in/--lsh-out used to be pickle files, so an extension is dropped for backward compatibility of scripts
+    return os.path.splitext(lsh_path)[0]
+
+
+def registry_path(lsh_path: str) -> str:
+    return f"{index_prefix(lsh_path)}-registry.json"
+
+
+def config_path(lsh_path: str) -> str:
+    return f"{index_prefix(lsh_path)}-config.json"
+
+
+def save_index_config(lsh_path: str, config: dict):
+    path = config_path(lsh_path)
+    ensure_directory_exists(path)
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+
+
+def load_index_config(lsh_path: str) -> Optional[dict]:
+    # indexes saved before the config was introduced don't have it
+    path = config_path(lsh_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def manifest_path(lsh_path: str, band_idx: int) -> str:
+    return f"{index_prefix(lsh_path)}-{band_idx}.json"
+
+
+def segment_path(lsh_path: str, band_idx: int, sequence: int) -> str:
+    return f"{index_prefix(lsh_path)}-{band_idx}-{sequence}.npy"
+
+
+def load_segment_paths(lsh_path: str, band_idx: int) -> Optional[List[str]]:
+    """
+    Returns paths of segments of a band, oldest first, or None if the index doesn't have the band.
+    """
+    path = manifest_path(lsh_path, band_idx)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        return [os.path.normpath(os.path.join(os.path.dirname(path), segment)) for segment in manifest["segments"]]
+    # bands saved before manifests were introduced consist of one segment
+    single_segment = f"{index_prefix(lsh_path)}-{band_idx}.npy"
+    if os.path.exists(single_segment):
+        return [single_segment]
+    if os.path.exists(f"{index_prefix(lsh_path)}-{band_idx}.pickle"):
+        raise ValueError(f"Band {band_idx}: LSH index at {lsh_path} was saved as pickled dicts, which are not supported anymore: rebuild it")
+    return None
+
+
+def save_segment_paths(lsh_path: str, band_idx: int, segment_paths: List[str]):
+    # manifest is replaced atomically, so readers see either the old or the new list of segments
+    path = manifest_path(lsh_path, band_idx)
+    ensure_directory_exists(path)
+    segments = [os.path.relpath(segment, os.path.dirname(os.path.abspath(path))) for segment in map(os.path.abspath, segment_paths)]
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"segments": segments}, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def next_segment_sequence(lsh_path: str, band_idx: int) -> int:
+    pattern = re.compile(re.escape(os.path.basename(index_prefix(lsh_path))) + rf"-{band_idx}-(\d+)\.npy$")
+    existing = [pattern.match(os.path.basename(x)) for x in glob.glob(f"{glob.escape(index_prefix(lsh_path))}-{band_idx}-*.npy")]
+    return max([int(m.group(1)) + 1 for m in existing if m], default=0)
+
+
+def new_segment_path(lsh_path: str, band_idx: int) -> str:
+    return segment_path(lsh_path, band_idx, next_segment_sequence(lsh_path, band_idx))
+
+
+def is_own_segment(lsh_path: str, band_idx: int, path: str) -> bool:
+    prefix = os.path.abspath(index_prefix(lsh_path))
+    return re.fullmatch(re.escape(prefix) + rf"-{band_idx}(-\d+)?\.npy", os.path.abspath(path)) is not None
+
+
+def list_bands(lsh_path: str) -> List[int]:
+    pattern = re.compile(re.escape(os.path.basename(index_prefix(lsh_path))) + r"-(\d+)\.(json|npy)$")
+    matches = [pattern.match(os.path.basename(x)) for x in glob.glob(f"{glob.escape(index_prefix(lsh_path))}-*")]
+    return sorted({int(m.group(1)) for m in matches if m})
+
+
+def compact_band(lsh_path: str, band_idx: int, memory_budget: int, tmp_dir: Optional[str] = None) -> List[str]:
+    """
+    Merges all segments of a band into one new segment and points the manifest to it.
+    Old segments are not deleted, since other indexes may refer to them: their paths are returned.
+    """
+    segment_paths = load_segment_paths(lsh_path, band_idx)
+    if not segment_paths or len(segment_paths) == 1:
+        return []
+    out_path = new_segment_path(lsh_path, band_idx)
+    n = merge_entries([load_entries(path) for path in segment_paths], out_path, memory_budget, tmp_dir or os.path.dirname(out_path))
+    save_segment_paths(lsh_path, band_idx, [out_path])
+    logging.info(f"Band {band_idx}: merged {len(segment_paths)} segments into {out_path} with {n} entries")
+    return segment_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compacts segments of bands of an LSH index built by build_lsh_index.py")
+    parser.add_argument("--lsh-path", type=str, required=True, help="Path prefix of LSH index")
+    parser.add_argument("--bands", nargs="+", type=int, help="Bands to compact. All bands of the index by default")
+    parser.add_argument("--max-segments", type=int, default=1, help="Only compact bands with more segments than this")
+    parser.add_argument("--memory-budget", type=float, default=4, help="Memory budget for merging segments in GB")
+    parser.add_argument("--tmp-dir", type=str, default=tempfile.gettempdir(), help="Folder for temporary files")
+    parser.add_argument(
+        "--delete-obsolete", action="store_true",
+        help="Delete merged segments of this index. Only use it if no other index was built on top of this one with --lsh-in"
+    )
+    args = parser.parse_args()
+
+    for band_idx in args.bands or list_bands(args.lsh_path):
+        segment_paths = load_segment_paths(args.lsh_path, band_idx) or []
+        if len(segment_paths) <= args.max_segments:
+            continue
+        obsolete = compact_band(args.lsh_path, band_idx, int(args.memory_budget * 2**30), args.tmp_dir)
+        for path in obsolete:
+            # segments of other indexes listed in this one are never deleted
+            if args.delete_obsolete and is_own_segment(args.lsh_path, band_idx, path):
+                os.remove(path)
+                logging.info(f"Band {band_idx}: deleted {path}")
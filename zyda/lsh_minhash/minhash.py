@@ -0,0 +1,186 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional, Sequence, Tuple
+import os
+import json
+import numpy as np
+from datasketch import MinHash
+from datasketch.minhash import _mersenne_prime as MERSENNE_PRIME, _max_hash as MAX_HASH
+
+MINHASH_CONFIG_FILE = "minhash_config.json"
+
+# Number of shingles whose permuted hashes are materialized at once: 8192 x 128 x 8 bytes = 8MB
+CHUNK_SIZE = 8192
+
+# Permutations are generated once per process instead of once per document
+PERMUTATIONS = {}
+def get_permutations(num_perm: int, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    if (num_perm, seed) not in PERMUTATIONS:
+        PERMUTATIONS[(num_perm, seed)] = MinHash(num_perm=num_perm, seed=seed).permutations
+    return PERMUTATIONS[(num_perm, seed)]
+
+
+def minhash_hashes(
+    hashes: np.ndarray,
+    lengths: Sequence[int],
+    num_perm: int = 128,
+    seed: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+) -> np.ndarray:
+    """
+    Computes minhash signatures of a batch of documents from hashes of their shingles, concatenated into one array.
+    lengths[i] is the number of shingles of the i-th document.
+
+    Returns an array of shape (len(lengths), num_perm), whose rows are bit-identical to datasketch.MinHash(num_perm, seed).hashvalues
+    updated with the same shingles: hashes are permuted as ((a * h + b) mod 2^61 - 1) mod 2^32 with uint64 wraparound,
+    and documents without shingles get MAX_HASH in every slot.
+    """
+    a, b = get_permutations(num_perm, seed)
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    signatures = np.full((len(lengths), num_perm), MAX_HASH, dtype=np.uint64)
+    doc_ids = np.repeat(np.arange(len(lengths)), lengths)
+    for start in range(0, len(hashes), chunk_size):
+        chunk = hashes[start:start + chunk_size]
+        chunk_doc_ids = doc_ids[start:start + chunk_size]
+        permuted = np.bitwise_and((np.outer(chunk, a) + b) % MERSENNE_PRIME, MAX_HASH)
+        # documents are contiguous in the chunk, but the first and the last one may continue in neighbouring chunks
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(chunk_doc_ids)) + 1])
+        docs = chunk_doc_ids[starts]
+        signatures[docs] = np.minimum(signatures[docs], np.minimum.reduceat(permuted, starts, axis=0))
+    return signatures
+
+
+# Bins that empty bins of one-permutation hashing borrow values from, in the order they are tried
+DENSIFICATION_ORDERS = {}
+def get_densification_order(num_perm: int, seed: int = 1) -> np.ndarray:
+    if (num_perm, seed) not in DENSIFICATION_ORDERS:
+        generator = np.random.RandomState(seed)
+        DENSIFICATION_ORDERS[(num_perm, seed)] = np.stack([generator.permutation(num_perm) for _ in range(num_perm)])
+    return DENSIFICATION_ORDERS[(num_perm, seed)]
+
+
+def one_permutation_hashes(
+    hashes: np.ndarray,
+    lengths: Sequence[int],
+    num_perm: int = 128,
+    seed: int = 1,
+) -> np.ndarray:
+    """
+    Same interface as minhash_hashes(), but computes signatures with one-permutation hashing in O(number of shingles):
+    shingle hashes are permuted once with the first datasketch permutation, the top bits of the permuted hash pick one
+    of num_perm bins, and every bin keeps its minimum. Empty bins are filled with optimal densification
+    (Shrivastava, 2017): an empty bin takes the value of the first non-empty bin from its own fixed random sequence of bins.
+
+    Signatures are not compatible with minhash_hashes() ones, but they estimate Jaccard similarity the same way
+    (fraction of equal slots), so they can be indexed with the same LSH code.
+    """
+    a, b = get_permutations(num_perm, seed)
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    permuted = np.bitwise_and((hashes * a[0] + b[0]) % MERSENNE_PRIME, MAX_HASH)
+    bins = (permuted * np.uint64(num_perm)) >> np.uint64(32)
+    slots = np.repeat(np.arange(len(lengths)) * num_perm, lengths) + bins.astype(np.int64)
+
+    signatures = np.full((len(lengths), num_perm), MAX_HASH, dtype=np.uint64)
+    np.minimum.at(signatures.reshape(-1), slots, permuted)
+    filled = np.zeros((len(lengths), num_perm), dtype=bool)
+    filled.reshape(-1)[slots] = True
+
+    # documents without shingles keep MAX_HASH everywhere, as in minhash_hashes()
+    missing = ~filled & (lengths > 0)[:, None]
+    order = get_densification_order(num_perm, seed)
+    source = signatures.copy()
+    for step in range(num_perm):
+        docs, empty_bins = np.nonzero(missing)
+        if len(docs) == 0:
+            break
+        candidates = order[empty_bins, step]
+        found = filled[docs, candidates]
+        docs, empty_bins, candidates = docs[found], empty_bins[found], candidates[found]
+        signatures[docs, empty_bins] = source[docs, candidates]
+        missing[docs, empty_bins] = False
+    return signatures
+
+
+def shingle_hashes_batch(texts: List[str], width: int) -> Tuple[np.ndarray, List[int]]:
+    """
+    Returns hashes of shingles of get_features() of all texts concatenated into one array, and the number of shingles per text.
+    """
+    # text.py downloads NLTK data when imported, so it is only imported by processes that minhash texts,
+    # and not by LSH stages that only use band keys of this module
+    import nltk
+    from zyda.utils.text import get_normalized_words, hash_shingles
+
+    shingles = []
+    lengths = []
+    for text in texts:
+        n = len(shingles)
+        shingles.extend(" ".join(x).encode('utf8') for x in nltk.ngrams(get_normalized_words(text), width))
+        lengths.append(len(shingles) - n)
+    return hash_shingles(shingles), lengths
+
+
+def minhash_texts(texts: List[str], width: int = 13, num_perm: int = 128, seed: int = 1, one_permutation: bool = False) -> np.ndarray:
+    hashes, lengths = shingle_hashes_batch(texts, width)
+    engine = one_permutation_hashes if one_permutation else minhash_hashes
+    return engine(hashes, lengths, num_perm=num_perm, seed=seed)
+
+
+def save_minhash_config(shard_path: str, config: dict):
+    with open(os.path.join(shard_path, MINHASH_CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=4)
+
+
+def load_minhash_config(shard_path: str) -> Optional[dict]:
+    """
+    Returns parameters of minhashes saved by compute_minhash.py in a shard folder, or None for shards saved before
+    the config was introduced, which all use the legacy format.
+    """
+    config_path = os.path.join(shard_path, MINHASH_CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+
+def band_key_column(band_idx: int) -> str:
+    return f"band_key_{band_idx}"
+
+
+def mix64(x: np.ndarray) -> np.ndarray:
+    """
+    SplitMix64 finalizer: a bijection on uint64 with good avalanche.
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def band_keys(signatures: np.ndarray, bands: int, r: int) -> np.ndarray:
+    """
+    Returns an array of shape (len(signatures), bands) with a 64-bit key of every band of r values.
+    Values fit into 32 bits, so pairs of them are packed into one uint64 and mixed into the key one pair at a time.
+    For r <= 2 keys are collision-free, for larger r two different bands share a key with probability ~2^-64.
+    """
+    values = signatures[:, :bands * r].astype(np.uint64).reshape(len(signatures), bands, r)
+    if r % 2:
+        values = np.concatenate([values, np.zeros((len(signatures), bands, 1), dtype=np.uint64)], axis=2)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for j in range(0, values.shape[2], 2):
+        keys = mix64(keys ^ ((values[:, :, j] << np.uint64(32)) | values[:, :, j + 1]))
+    return keys
@@ -0,0 +1,187 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Callable, Iterator, List, Optional, Tuple
+import math
+import os
+import numpy as np
+import datasets
+
+from zyda.lsh_minhash.band_index import BandIndex, INDEX_DTYPE
+from zyda.lsh_minhash.minhash import band_key_column, band_keys as compute_band_keys
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+# Resident memory of a worker or reader process before it gets any documents: interpreter, NumPy, datasets
+PROCESS_OVERHEAD = 256 * 2**20
+# Documents read to estimate the fraction of them that become index entries, in SAMPLE_CHUNKS evenly spaced chunks
+SAMPLE_SIZE = 100_000
+SAMPLE_CHUNKS = 10
+# Number of bands whose keys are sampled
+SAMPLE_BANDS = 4
+# Fraction of available memory that band workers and readers are planned to use
+MEMORY_FRACTION = 0.8
+
+
+def available_memory() -> int:
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def available_cores() -> int:
+    return len(os.sched_getaffinity(0))
+
+
+def peak_rss(pid: Optional[int] = None) -> int:
+    """
+    Returns peak resident memory of a process, this one by default, in bytes.
+    """
+    with open(f"/proc/{pid or 'self'}/status", "r") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def run_measured(peaks, idx: int, target: Callable, *args):
+    """
+    Runs target(*args) and stores peak resident memory of this process in peaks[idx], before the process exits
+    and its memory statistics are gone.
+    """
+    try:
+        target(*args)
+    finally:
+        peaks[idx] = peak_rss()
+
+
+def sample_fill_ratio(datasets_list: List[Tuple[int, datasets.Dataset]], bands: List[int], r: int, band_keys: bool = False) -> float:
+    """
+    Returns the largest fraction of distinct keys among sampled documents over sampled bands, i.e. the fraction of documents
+    that become index entries. A sample has fewer duplicates than the whole corpus, so the fraction is overestimated.
+    """
+    total = sum(len(ds) for _, ds in datasets_list)
+    chunk_size = max(1, min(SAMPLE_SIZE, total) // SAMPLE_CHUNKS)
+    bands = bands[:SAMPLE_BANDS]
+    columns = [band_key_column(i) for i in bands] if band_keys else ["hashvalues"]
+    keys = [[] for _ in bands]
+    offset = 0
+    starts = [total * i // SAMPLE_CHUNKS for i in range(SAMPLE_CHUNKS)] if total else []
+    for _, ds in datasets_list:
+        for start in starts:
+            lo, hi = max(start, offset) - offset, min(start + chunk_size, offset + len(ds)) - offset
+            if lo >= hi:
+                continue
+            batch = ds.select_columns(columns).with_format("arrow")[lo:hi]
+            if not band_keys:
+                hashvalues = batch.column("hashvalues").combine_chunks().flatten().to_numpy().reshape(len(batch), -1)
+            for j, i in enumerate(bands):
+                if band_keys:
+                    keys[j].append(batch.column(band_key_column(i)).combine_chunks().to_numpy())
+                else:
+                    keys[j].append(compute_band_keys(hashvalues[:, i * r : (i + 1) * r], 1, r)[:, 0])
+        offset += len(ds)
+    if not starts:
+        return 1.0
+    return max(len(np.unique(np.concatenate(band))) / len(np.concatenate(band)) for band in keys)
+
+
+def estimate_band_memory(n_docs: int, fill_ratio: float, memory_budget: int = 0, queue_records: int = 0) -> int:
+    """
+    Returns peak memory of a band worker: its hash table, or its memory budget when documents are spilled, and a full queue.
+    """
+    queue_bytes = queue_records * INDEX_DTYPE.itemsize
+    index_bytes = memory_budget or BandIndex.peak_nbytes(math.ceil(n_docs * fill_ratio))
+    return PROCESS_OVERHEAD + queue_bytes + index_bytes
+
+
+def plan_bands_parallel(n_bands: int, band_memory: int, memory: int, n_readers: int, cores: int) -> int:
+    """
+    Returns how many of n_bands bands fit into memory next to readers, and into cores leaving at least one of them to readers,
+    split evenly into groups.
+    """
+    fits = int((memory - n_readers * PROCESS_OVERHEAD) // band_memory)
+    if fits < 1:
+        logging.warning(
+            f"Estimated memory of a band worker {band_memory / 2**30:.1f}GB doesn't fit into {memory / 2**30:.1f}GB: "
+            f"processing bands one at a time, consider --memory-budget"
+        )
+        return 1
+    fits = max(1, min(fits, cores - 1))
+    n_groups = math.ceil(n_bands / min(fits, n_bands))
+    return math.ceil(n_bands / n_groups)
+
+
+def plan_readers(bands_parallel: int, band_memory: int, memory: int, cores: int) -> int:
+    """
+    Returns the number of readers using cores not taken by band workers, within memory left by them.
+    """
+    spare_memory = memory - bands_parallel * band_memory
+    return max(1, min(cores - bands_parallel, int(spare_memory // PROCESS_OVERHEAD)))
+
+
+class BandScheduler:
+    """
+    Yields groups of bands processed in parallel, bands_parallel at a time, each of them read by n_readers readers.
+    With band_memory, the estimated peak memory of a band worker, the size of the next group and its readers are planned
+    to fit into max_memory and cores, and re-planned after every group from the peak memory of its band workers
+    reported with report_peak().
+    """
+    def __init__(
+        self,
+        bands: List[int],
+        bands_parallel: int,
+        band_memory: int = 0,
+        max_memory: int = 0,
+        n_readers: int = 1,
+        cores: int = 1,
+    ):
+        self.pending = list(bands)
+        self.bands_parallel = bands_parallel if bands_parallel > 0 else len(self.pending)
+        self.band_memory = band_memory
+        self.max_memory = max_memory
+        self.n_readers = n_readers
+        self.cores = cores
+        self.group_peak = 0
+
+    def __iter__(self) -> Iterator[List[int]]:
+        while self.pending:
+            group, self.pending = self.pending[:self.bands_parallel], self.pending[self.bands_parallel:]
+            self.group_peak = 0
+            yield group
+            if self.band_memory and self.pending:
+                self.adjust()
+
+    def report_peak(self, peak: int):
+        """
+        Records peak resident memory of a band worker of the current group.
+        """
+        self.group_peak = max(self.group_peak, peak)
+
+    def adjust(self):
+        measured = max(self.group_peak, PROCESS_OVERHEAD)
+        memory = min(self.max_memory, int(available_memory() * MEMORY_FRACTION))
+        bands_parallel = plan_bands_parallel(len(self.pending), measured, memory, 1, self.cores)
+        n_readers = plan_readers(bands_parallel, measured, memory, self.cores)
+        logging.info(
+            f"Peak memory of a band worker was {measured / 2**30:.2f}GB (planned with {self.band_memory / 2**30:.2f}GB), "
+            f"{memory / 2**30:.1f}GB available: processing {bands_parallel} bands in parallel instead of {self.bands_parallel}, "
+            f"with {n_readers} reader processes instead of {self.n_readers}"
+        )
+        self.band_memory = measured
+        self.bands_parallel = bands_parallel
+        self.n_readers = n_readers
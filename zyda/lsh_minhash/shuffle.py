@@ -0,0 +1,75 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Key-partitioned indexing shuffles (key, doc) records of every band between ranks through a folder on shared storage:
+#   band-<band>/<rank>-<dest>.bin     records of documents read by rank with keys owned by dest, in the order they were read
+#   band-<band>/<rank>.<stage>        JSON marker written by rank once it has finished a stage of the band
+#   <rank>.failed                     written by a rank that failed, so that the others stop waiting for it
+# Markers are written atomically, so a marker that exists always refers to complete files.
+
+from typing import List, Optional
+import glob
+import json
+import os
+import time
+import numpy as np
+
+from zyda.utils.common import write_json_atomic
+
+# Seconds between checks of markers of other ranks
+POLL_INTERVAL = 5
+
+
+def key_ranks(keys: np.ndarray, num_ranks: int) -> np.ndarray:
+    """
+    Returns ranks owning band keys. Ranks own contiguous ranges of keys, so their sorted segments together are sorted too.
+    """
+    return (((keys >> np.uint64(32)) * np.uint64(num_ranks)) >> np.uint64(32)).astype(np.int64)
+
+
+def band_dir(shuffle_dir: str, band_idx: int) -> str:
+    return os.path.join(shuffle_dir, f"band-{band_idx}")
+
+
+def run_path(shuffle_dir: str, band_idx: int, rank: int, dest: int) -> str:
+    return os.path.join(band_dir(shuffle_dir, band_idx), f"{rank}-{dest}.bin")
+
+
+def marker_path(shuffle_dir: str, band_idx: int, rank: int, stage: str) -> str:
+    return os.path.join(band_dir(shuffle_dir, band_idx), f"{rank}.{stage}")
+
+
+def mark_stage(shuffle_dir: str, band_idx: int, rank: int, stage: str, data: Optional[dict] = None):
+    write_json_atomic(marker_path(shuffle_dir, band_idx, rank, stage), data or {})
+
+
+def mark_failed(shuffle_dir: str, rank: int):
+    write_json_atomic(os.path.join(shuffle_dir, f"{rank}.failed"), {})
+
+
+def wait_for_ranks(shuffle_dir: str, band_idx: int, num_ranks: int, stage: str) -> List[dict]:
+    """
+    Waits until all ranks have finished a stage of a band, and returns data of their markers in the order of ranks.
+    """
+    paths = [marker_path(shuffle_dir, band_idx, rank, stage) for rank in range(num_ranks)]
+    while not all(os.path.exists(path) for path in paths):
+        failed = glob.glob(os.path.join(glob.escape(shuffle_dir), "*.failed"))
+        if failed:
+            raise RuntimeError(f"Band {band_idx}: ranks {sorted(os.path.basename(x).split('.')[0] for x in failed)} failed")
+        time.sleep(POLL_INTERVAL)
+    data = []
+    for path in paths:
+        with open(path, "r") as f:
+            data.append(json.load(f))
+    return data
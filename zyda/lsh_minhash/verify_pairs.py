@@ -0,0 +1,134 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from glob import glob
+from typing import List
+import argparse
+import os
+import shutil
+import tempfile
+import numpy as np
+import tqdm
+
+from zyda.lsh_minhash.band_index import append_partitions, get_partition_bits
+from zyda.lsh_minhash.minhash import mix64
+from zyda.utils.common import ensure_directory_exists
+from zyda.utils.doc_ids import DocRegistry
+from zyda.utils.pairs import PAIRS_FORMATS, count_pairs, open_pair_writer, read_pairs
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+PAIR_RECORD = np.dtype([("a", "<u8"), ("b", "<u8")])
+# Number of pairs whose signatures are compared at once
+VERIFY_BATCH_SIZE = 1 << 18
+
+
+def canonical_pairs(pairs: np.ndarray) -> np.ndarray:
+    """
+    Returns pairs as records with the smaller id first, without pairs of a document with itself.
+    """
+    records = np.empty(len(pairs), dtype=PAIR_RECORD)
+    records["a"] = np.minimum(pairs[:, 0], pairs[:, 1])
+    records["b"] = np.maximum(pairs[:, 0], pairs[:, 1])
+    return records[records["a"] != records["b"]]
+
+
+def estimate_jaccard(registry: DocRegistry, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns Jaccard similarity of pairs of documents estimated from their minhash signatures.
+    """
+    docs, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+    signatures = registry.hashvalues(docs)
+    return (signatures[inverse[:len(a)]] == signatures[inverse[len(a):]]).mean(axis=1)
+
+
+def partition_pairs(files: List[str], spill_dir: str, partition_bits: int) -> int:
+    """
+    Appends canonical pairs of all files to run files of partitions, so that all copies of a pair end up in the same partition.
+    Returns the number of pairs read.
+    """
+    runs = [open(os.path.join(spill_dir, f"run-{p:05d}.bin"), "wb") for p in range(1 << partition_bits)]
+    n = 0
+    for file in files:
+        with tqdm.tqdm(desc=file, unit="dupes", unit_scale=True) as pbar:
+            for pairs in read_pairs(file):
+                n += len(pairs)
+                pbar.update(len(pairs))
+                records = canonical_pairs(pairs)
+                if partition_bits == 0:
+                    records.tofile(runs[0])
+                    continue
+                partitions = (mix64(records["a"] ^ mix64(records["b"])) >> np.uint64(64 - partition_bits)).astype(np.int64)
+                append_partitions(records, partitions, runs)
+    for run in runs:
+        run.close()
+    return n
+
+
+def verify_pairs(args):
+    print()
+    files = sorted(glob(os.path.join(args.input_dir, "*.txt")) + glob(os.path.join(args.input_dir, "*.pairs")))
+    if not files:
+        raise FileNotFoundError(f"No pairs files in {args.input_dir}")
+    registry = DocRegistry.load(args.registry)
+
+    num_pairs = sum(count_pairs(file) for file in files)
+    partition_bits = get_partition_bits(num_pairs, int(args.memory_budget * 2**30))
+    logging.info(f"Deduplicating {num_pairs} pairs from {len(files)} files in {1 << partition_bits} partitions")
+
+    os.makedirs(args.tmp_dir, exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix="verify-pairs-", dir=args.tmp_dir)
+    ensure_directory_exists(args.out_file)
+    tmp_file = os.path.join(os.path.dirname(args.out_file), f".{os.path.basename(args.out_file)}.tmp")
+    num_unique = num_kept = 0
+    try:
+        num_pairs = partition_pairs(files, spill_dir, partition_bits)
+        with open_pair_writer(tmp_file, args.pairs_format) as writer:
+            for p in tqdm.trange(1 << partition_bits, desc="Verifying partitions"):
+                records = np.unique(np.fromfile(os.path.join(spill_dir, f"run-{p:05d}.bin"), dtype=PAIR_RECORD))
+                os.remove(os.path.join(spill_dir, f"run-{p:05d}.bin"))
+                num_unique += len(records)
+                for start in range(0, len(records), VERIFY_BATCH_SIZE):
+                    batch = records[start:start + VERIFY_BATCH_SIZE]
+                    if args.threshold > 0:
+                        batch = batch[estimate_jaccard(registry, batch["a"], batch["b"]) >= args.threshold]
+                    writer.write(batch["a"], batch["b"])
+                    num_kept += len(batch)
+    finally:
+        shutil.rmtree(spill_dir)
+    os.replace(tmp_file, args.out_file)
+    # pairs are passed to connected components without the dupes folder, so the registry goes next to them
+    registry.save(os.path.splitext(args.out_file)[0] + "-registry.json")
+    logging.info(
+        f"Saved {num_kept} pairs to {args.out_file}: {num_pairs - num_unique} repeated pairs and pairs of documents with themselves, "
+        f"and {num_unique - num_kept} pairs with estimated Jaccard similarity below {args.threshold} were dropped"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merges duplicate pairs of all bands written by build_lsh_index.py into one file of distinct pairs, "
+                    "keeping only pairs whose Jaccard similarity estimated from minhash signatures reaches a threshold"
+    )
+    parser.add_argument("--input-dir", type=str, required=True, help="Folder with duplicate pairs files of all bands, in either format")
+    parser.add_argument("--registry", type=str, required=True, help="Registry of datasets saved by build_lsh_index.py next to duplicate pairs")
+    parser.add_argument("--out-file", type=str, required=True, help="Output file with verified pairs, which should be in its own folder")
+    parser.add_argument("--pairs-format", type=str, default="binary", choices=PAIRS_FORMATS, help="Format of the output file")
+    parser.add_argument("--threshold", type=float, default=0.4, help="Minimum estimated Jaccard similarity of kept pairs. 0 only deduplicates pairs")
+    parser.add_argument("--memory-budget", type=float, default=8, help="Memory budget for deduplicating pairs in GB")
+    parser.add_argument("--tmp-dir", type=str, default=tempfile.gettempdir(), help="Folder on local disk for partitions of pairs")
+    args = parser.parse_args()
+
+    verify_pairs(args)
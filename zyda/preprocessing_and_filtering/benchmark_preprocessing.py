@@ -0,0 +1,266 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Callable, List
+import argparse
+import random
+import time
+import datasets
+
+from zyda.preprocessing_and_filtering.preprocess_and_filter import (
+    PATTERNS,
+    WORD_LISTS,
+    count_PII_items,
+    count_pattern,
+    count_word_list,
+    document_statistics,
+    fraction_non_alphanumeric,
+    fraction_numerical,
+    get_pattern_counter,
+    mean_word_length,
+    preprocess,
+    preprocess_staged,
+    staged_features,
+    transform,
+    transform_sequential,
+)
+from zyda.utils.filtering import filter_batch
+from zyda.utils.text import get_normalized_words, needs_ftfy
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+WEB_WORDS = (
+    "the of and to in is for on that with as was by it this are from at be an have or not which you "
+    "data model results figure table section page home contact privacy policy terms news blog "
+    "download free online best price review shop cart login register email phone address "
+    "lorem ipsum dolor sit amet xml json html www example com org https http vol ep nr "
+    "damn crap sex porn penis dick cock anal xxx mp3 ownload caoporn 99re dy888"
+).split()
+WEB_SNIPPETS = [
+    "https://www.example.com/path/to/page?id=42",
+    "<div class=\"content\"><p>",
+    "</p></div>",
+    "{\"key\": \"value\", \"other\": 1}",
+    "<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+    "Lorem ipsum dolor sit amet, consectetur adipisicing elit",
+    "contact: john.doe@example.com or 192.168.0.1",
+    "Vol. 12, Ep. 3, nr.",
+    "\xa0\xa0",
+    "-" * 30,
+    "=" * 20,
+    "." * 12,
+    "?" * 11,
+    "\n" * 12,
+    " " * 45,
+    "ааааааааа",
+    "Ünïcödé tëxt wïth äccents",
+    "“Gonna” say it: you cannot &amp; won’t",
+    "mojibake: cafÃ©\r\n",
+]
+CODE_LINES = [
+    "def {name}(self, x, y=None):",
+    "    return {name}(x) + y  # comment",
+    "    if x is None:\n        raise ValueError(\"x is None\")",
+    "\tfor i in range(10):\n\t\tprint(i)",
+    "# " + "-" * 76,
+    "/* " + "*" * 70 + " */",
+    "// " + "/" * 40,
+    "path = \"C:\\\\Users\\\\name\\\\file.txt\"",
+    "x = {{\"a\": 1, \"b\": [1, 2, 3]}}",
+    "<xml><item id=\"1\">{name}</item></xml>",
+    "_" * 20 + " " * 50 + "\t" * 25,
+    "\r\n" * 3,
+]
+
+# Number of documents in batches of the check of staged preprocessing on a batch without rejections followed by one with them
+MIXED_BATCH_SIZE = 10
+
+
+def generate_synthetic_texts(n_docs: int, seed: int = 0, code_fraction: float = 0.3) -> List[str]:
+    """
+    Generates a mix of web-like and code-like documents for benchmarking.
+    """
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n_docs):
+        parts = []
+        if rng.random() >= code_fraction:
+            for _ in range(rng.randint(20, 400)):
+                if rng.random() < 0.01:
+                    parts.append(rng.choice(WEB_SNIPPETS))
+                else:
+                    word = rng.choice(WEB_WORDS)
+                    parts.append(word.capitalize() + "." if rng.random() < 0.07 else word)
+            texts.append(" ".join(parts))
+        else:
+            for _ in range(rng.randint(5, 150)):
+                parts.append(rng.choice(CODE_LINES).format(name=rng.choice(WEB_WORDS)))
+            texts.append("\n".join(parts))
+    return texts
+
+
+def generate_clean_texts(n_docs: int, seed: int = 0) -> List[str]:
+    """
+    Generates documents of plain words only, which pass all filtering rules.
+    """
+    rng = random.Random(seed)
+    words = WEB_WORDS[:WEB_WORDS.index("lorem")]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(50, 200))) for _ in range(n_docs)]
+
+
+def load_texts(args) -> List[str]:
+    if args.hf_path is None:
+        logging.info(f"Generating {args.num_docs} synthetic documents")
+        return generate_synthetic_texts(args.num_docs, args.seed, args.code_fraction)
+    logging.info(f"Loading {args.hf_path}, dir={args.hf_dir}")
+    if args.load_from_disk:
+        dataset = datasets.load_from_disk(args.hf_path)
+    else:
+        dataset = datasets.load_dataset(args.hf_path, args.hf_dir, split='train', trust_remote_code=True)
+    dataset = dataset.shuffle(seed=args.seed).select(range(min(args.num_docs, len(dataset))))
+    return dataset[args.key]
+
+
+def run_timed(fn: Callable, texts: List[str]):
+    t0 = time.time()
+    results = [fn(text) for text in texts]
+    return results, time.time() - t0
+
+
+def report(name: str, texts: List[str], reference: Callable, candidate: Callable, check: bool):
+    reference_results, reference_time = run_timed(reference, texts)
+    candidate_results, candidate_time = run_timed(candidate, texts)
+    logging.info(
+        f"{name}: reference {len(texts) / reference_time:.1f} docs/sec, new {len(texts) / candidate_time:.1f} docs/sec "
+        f"({reference_time / candidate_time:.1f}x)"
+    )
+    if check:
+        mismatches = [i for i, (x, y) in enumerate(zip(reference_results, candidate_results)) if x != y]
+        if mismatches:
+            raise AssertionError(f"{name}: {len(mismatches)} mismatches, e.g. document {mismatches[0]}")
+        logging.info(f"{name}: outputs are identical on {len(texts)} documents")
+
+
+def benchmark_word_lists(texts: List[str], check: bool):
+    def reference(text):
+        pattern_counts = {pattern: count_pattern(text, pattern) for pattern in PATTERNS}
+        word_list_counts = {key: count_word_list(text, word_list) for key, word_list in WORD_LISTS.items()}
+        return pattern_counts, word_list_counts
+
+    pattern_counter = get_pattern_counter(PATTERNS, WORD_LISTS)
+    report("word_lists", texts, reference, pattern_counter.count, check)
+
+
+def benchmark_document_statistics(texts: List[str], check: bool):
+    def reference(text):
+        return mean_word_length(text), fraction_non_alphanumeric(text), fraction_numerical(text), count_PII_items(text)
+
+    def candidate(text):
+        return tuple(values[0] for values in document_statistics([text]).values())
+
+    report("document_statistics", texts, reference, candidate, check)
+
+
+def benchmark_transform(texts: List[str], check: bool):
+    report("transform", texts, transform_sequential, transform, check)
+    unchanged = sum(transform(text) is text for text in texts)
+    logging.info(f"transform: {unchanged} / {len(texts)} documents returned untouched by the fast path")
+
+
+def benchmark_normalization(texts: List[str], check: bool):
+    report(
+        "normalization", texts,
+        lambda text: get_normalized_words(text, fast=False),
+        lambda text: get_normalized_words(text, fast=True),
+        check,
+    )
+    skipped = sum(not needs_ftfy(text) for text in texts)
+    logging.info(f"normalization: ftfy skipped for {skipped} / {len(texts)} documents")
+
+
+def preprocess_dataset(texts: List[str], staged: bool, batch_size: int = 1000):
+    """
+    Returns kept documents and their features as saved by preprocess_and_filter.py with and without --staged-filtering.
+    """
+    dataset = datasets.Dataset.from_dict({"text": texts})
+    preprocess_fn = preprocess_staged if staged else preprocess
+    processed = dataset.map(
+        lambda batch, indices: preprocess_fn(batch, indices, key="text", name="benchmark", shard=0, offset=0),
+        batched=True,
+        batch_size=batch_size,
+        with_indices=True,
+        features=staged_features(dataset.features) if staged else None,
+    )
+    if staged:
+        return processed.filter(lambda rejected_by: [rule is None for rule in rejected_by], input_columns="rejected_by", batched=True).remove_columns("rejected_by")
+    return processed.with_format("arrow").filter(filter_batch, batched=True).with_format(None)
+
+
+def check_same_dataset(name: str, reference: datasets.Dataset, candidate: datasets.Dataset):
+    if reference.features != candidate.features:
+        raise AssertionError(f"{name}: features differ:\n{reference.features}\n{candidate.features}")
+    if reference.to_dict() != candidate.to_dict():
+        raise AssertionError(f"{name}: kept documents differ, {len(reference)} vs {len(candidate)}")
+    logging.info(f"{name}: outputs are identical, {len(candidate)} documents kept")
+
+
+def benchmark_staged(texts: List[str], check: bool):
+    t0 = time.time()
+    reference = preprocess_dataset(texts, staged=False)
+    reference_time = time.time() - t0
+    t0 = time.time()
+    candidate = preprocess_dataset(texts, staged=True)
+    candidate_time = time.time() - t0
+    logging.info(
+        f"staged: reference {len(texts) / reference_time:.1f} docs/sec, new {len(texts) / candidate_time:.1f} docs/sec "
+        f"({reference_time / candidate_time:.1f}x)"
+    )
+    if check:
+        check_same_dataset("staged", reference, candidate)
+        # types of columns are fixed by the first batch unless given to map(), so a batch without rejections comes first
+        mixed = generate_clean_texts(MIXED_BATCH_SIZE) + [text[:MIXED_BATCH_SIZE] for text in texts[:MIXED_BATCH_SIZE]]
+        check_same_dataset(
+            "staged, mixed batches",
+            preprocess_dataset(mixed, staged=False, batch_size=MIXED_BATCH_SIZE),
+            preprocess_dataset(mixed, staged=True, batch_size=MIXED_BATCH_SIZE),
+        )
+
+
+BENCHMARKS = {
+    "word_lists": benchmark_word_lists,
+    "document_statistics": benchmark_document_statistics,
+    "transform": benchmark_transform,
+    "normalization": benchmark_normalization,
+    "staged": benchmark_staged,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hf-path', type=str, default=None, help='Path of HF dataset. If not specified, synthetic documents are used')
+    parser.add_argument('--hf-dir', type=str, default=None, help='Dir in HF dataset')
+    parser.add_argument('--load-from-disk', action='store_true', help='Use datasets.load_from_disk() to load the dataset')
+    parser.add_argument('--key', type=str, default='text', help='Key to extract')
+    parser.add_argument('--num-docs', type=int, default=10_000, help='Number of documents to benchmark on')
+    parser.add_argument('--code-fraction', type=float, default=0.3, help='Fraction of code-like documents among synthetic ones')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for sampling or generating documents')
+    parser.add_argument('--benchmarks', nargs='+', type=str, default=list(BENCHMARKS), choices=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--check', action='store_true', help='Check that new implementations produce outputs identical to reference ones')
+    args = parser.parse_args()
+    print()
+
+    texts = load_texts(args)
+    for benchmark in args.benchmarks:
+        BENCHMARKS[benchmark](texts, args.check)
@@ -12,16 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
-from typing import Dict, List
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
 import os
 import argparse
 import re
 import json
+import numpy as np
 import datasets
 import transformers
-from zyda.utils.text import get_normalized_words
-from zyda.utils.filtering import filter
+from zyda.utils.text import get_normalized_words, get_shingle_hashes, shingle_hashes_column
+from zyda.utils.filtering import check_document_statistics, check_length, check_patterns, check_substrings, filter_batch
+from zyda.utils.pattern_counting import PatternCounter, regex_to_literal
 
 import nltk
 nltk.download('punkt')
@@ -32,9 +34,41 @@ logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
 REPO_BASE = os.environ.get("REPO_BASE", "")
 
 TOKENIZERS = {
-    "neox": transformers.AutoTokenizer.from_pretrained("EleutherAI/gpt-neox-20b"),
+    "neox": "EleutherAI/gpt-neox-20b",
 }
 
+# Tokenizers are loaded lazily, so that every worker process loads them only once and only if needed
+LOADED_TOKENIZERS = {}
+def get_tokenizer(name: str) -> transformers.PreTrainedTokenizerFast:
+    if name not in LOADED_TOKENIZERS:
+        tokenizer = transformers.AutoTokenizer.from_pretrained(TOKENIZERS[name])
+        # calling the backend directly skips transformers' per-call reset of these settings
+        tokenizer.backend_tokenizer.no_truncation()
+        tokenizer.backend_tokenizer.no_padding()
+        LOADED_TOKENIZERS[name] = tokenizer
+    return LOADED_TOKENIZERS[name]
+
+
+def count_tokens(texts: List[str], name: str = "neox") -> List[int]:
+    """
+    Returns the same counts as len(tokenizer.encode(text)), but tokenizes the whole batch
+    in the Rust backend without converting token ids to Python lists.
+    """
+    tokenizer = get_tokenizer(name)
+    encodings = tokenizer.backend_tokenizer.encode_batch(texts, add_special_tokens=True)
+    return [len(encoding) for encoding in encodings]
+
+
+def shingle_hashes(text: str, transformed_text: str, words: List[str], width: int):
+    """
+    Returns hashes of shingles of transformed_text, which is what minhashes are computed from.
+    Normalized words of the original text are reused when transform() left the text untouched.
+    """
+    if transformed_text is not text:
+        words = get_normalized_words(transformed_text)
+    return get_shingle_hashes(words, width)
+
+
 def read_json_file(fname):
     with open(fname, "r") as f:
         result_dict = json.loads(f.read()) 
@@ -90,8 +124,11 @@ def fraction_numerical(text: str):
     return 0.0
 
 
+REGEX_SUBSTRINGS = {}
 def count_substrings(text: str, allowed_num_repeats: int = 7):
-    substrings = re.findall(r'(\w)\1{%d,}' % (allowed_num_repeats - 1), text)
+    if allowed_num_repeats not in REGEX_SUBSTRINGS:
+        REGEX_SUBSTRINGS[allowed_num_repeats] = re.compile(r'(\w)\1{%d,}' % (allowed_num_repeats - 1))
+    substrings = REGEX_SUBSTRINGS[allowed_num_repeats].findall(text)
     return len(substrings)
 
 
@@ -102,6 +139,15 @@ def count_pattern(text: str, pattern: str):
 def count_word_list(text: str, word_list: str):
     return sum([count_pattern(text, word) for word in word_list])
 
+
+# Pattern counters are built lazily, so that every worker process compiles its automaton only once
+PATTERN_COUNTERS = {}
+def get_pattern_counter(patterns: list, word_lists: dict) -> PatternCounter:
+    key = (tuple(patterns), tuple((word_list_key, tuple(word_list)) for word_list_key, word_list in word_lists.items()))
+    if key not in PATTERN_COUNTERS:
+        PATTERN_COUNTERS[key] = PatternCounter(patterns, word_lists)
+    return PATTERN_COUNTERS[key]
+
 REGEX_EMAIL = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
 REGEX_PHONE_NUMBER = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9]{1,2})\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9]{1,2})')
 def count_PII_items(input_string):
@@ -110,7 +156,72 @@ def count_PII_items(input_string):
     return num_email  + num_phone_number
 
 
-def transform(
+CHAR_WORD_SEPARATOR = 1
+CHAR_NON_ALPHANUMERIC = 2
+CHAR_NUMERICAL = 4
+# Character classes are cached per worker process, so every distinct character is classified only once
+CHAR_CLASSES = {}
+def get_char_class(char: str) -> int:
+    char_class = CHAR_CLASSES.get(char)
+    if char_class is None:
+        char_class = 0
+        if REGEX_MEAN_WORD_LENGTH.match(char):
+            char_class |= CHAR_WORD_SEPARATOR
+        if REGEX_NON_ALPHANUMERIC.match(char):
+            char_class |= CHAR_NON_ALPHANUMERIC
+        if REGEX_COUNT_NUMERICS.match(char):
+            char_class |= CHAR_NUMERICAL
+        CHAR_CLASSES[char] = char_class
+    return char_class
+
+
+def document_statistics(texts: List[str]) -> Dict[str, List]:
+    """
+    Computes mean_word_length, fraction_non_alphanumeric, fraction_numerical and pii_count for a batch of texts.
+    Produces the same values as the individual feature functions, but scans every text only once:
+    all these features are derived from counts of single characters, while PII regexes are only
+    run on texts that contain the characters they require.
+    """
+    features = {
+        "mean_word_length": [],
+        "fraction_non_alphanumeric": [],
+        "fraction_numerical": [],
+        "pii_count": [],
+    }
+    for text in texts:
+        if not text:
+            features["mean_word_length"].append(0.0)
+            features["fraction_non_alphanumeric"].append(0.0)
+            features["fraction_numerical"].append(0.0)
+            features["pii_count"].append(0)
+            continue
+
+        n_separators = n_non_alphanumeric = n_numerical = 0
+        char_counts = Counter(text)
+        for char, count in char_counts.items():
+            char_class = get_char_class(char)
+            if char_class & CHAR_WORD_SEPARATOR:
+                n_separators += count
+            if char_class & CHAR_NON_ALPHANUMERIC:
+                n_non_alphanumeric += count
+            if char_class & CHAR_NUMERICAL:
+                n_numerical += count
+
+        # splitting on single-character separators gives n_separators + 1 words made of all other characters
+        features["mean_word_length"].append((len(text) - n_separators) / (n_separators + 1))
+        features["fraction_non_alphanumeric"].append(n_non_alphanumeric / len(text))
+        features["fraction_numerical"].append(n_numerical / len(text))
+
+        pii_count = 0
+        if "@" in char_counts:
+            pii_count += len(REGEX_EMAIL.findall(text))
+        if char_counts.get(".", 0) >= 3 and n_numerical >= 4:
+            pii_count += len(REGEX_PHONE_NUMBER.findall(text))
+        features["pii_count"].append(pii_count)
+    return features
+
+
+def transform_sequential(
     text: str,
     chars_with_thresholds: dict =CHARS_FOR_TRANSFORM,
 ) -> str:
@@ -123,6 +234,56 @@ def transform(
     return new_text
 
 
+# Transform rules and regexes are compiled lazily, once per worker process
+TRANSFORM_RULES = {}
+def get_transform_rules(chars_with_thresholds: dict) -> Optional[List[Tuple[str, int]]]:
+    """
+    Converts repeated-character rules to (character, threshold) pairs.
+    Returns None if some rule is not a single character, in which case rules have to be applied sequentially.
+    """
+    key = tuple(chars_with_thresholds.items())
+    if key not in TRANSFORM_RULES:
+        rules = []
+        for char, threshold in chars_with_thresholds.items():
+            literal = regex_to_literal(char)
+            if literal is None or len(literal) != 1 or literal in dict(rules):
+                rules = None
+                break
+            rules.append((literal, threshold))
+        TRANSFORM_RULES[key] = rules
+    return TRANSFORM_RULES[key]
+
+
+TRANSFORM_REGEXES = {}
+def get_transform_regex(rules: Tuple[Tuple[str, int], ...]) -> re.Pattern:
+    if rules not in TRANSFORM_REGEXES:
+        # spelling out the minimal run lets re search for it as a literal prefix
+        TRANSFORM_REGEXES[rules] = re.compile("|".join(re.escape(char) * threshold + "+" for char, threshold in rules))
+    return TRANSFORM_REGEXES[rules]
+
+
+def transform(
+    text: str,
+    chars_with_thresholds: dict =CHARS_FOR_TRANSFORM,
+) -> str:
+    """
+    Collapses runs of repeated characters. Produces the same output as transform_sequential().
+
+    Collapsing a run of one character can't create or break a run of another character,
+    so all rules that apply to the text are matched by a single regex in a single pass.
+    Rules that apply are found with plain substring searches, and if there are none,
+    the original string object is returned untouched.
+    """
+    rules = get_transform_rules(chars_with_thresholds)
+    if rules is None:
+        return transform_sequential(text, chars_with_thresholds)
+
+    matching_rules = tuple((char, threshold) for char, threshold in rules if char * threshold in text)
+    if not matching_rules:
+        return text
+    return get_transform_regex(matching_rules).sub(lambda match: match.group()[0], text)
+
+
 def preprocess(
     batch,
     indices,
@@ -132,32 +293,23 @@ def preprocess(
     offset: int,
     patterns: list = PATTERNS,
     word_lists: dict = WORD_LISTS,
+    with_token_counts: bool = True,
+    shingle_width: Optional[int] = None,
 ) -> Dict[str, List]:
     texts = batch[key]
     features = defaultdict(list)
-    for ind, text in zip(indices, texts):
-        features["dataset_name"].append(name)
-        features["shard"].append(shard)
-        features["shard_index"].append(ind)
-        features["global_index"].append(ind + offset)
-        features["mean_word_length"].append(mean_word_length(text))
-        features["fraction_non_alphanumeric"].append(fraction_non_alphanumeric(text))
-        features["fraction_numerical"].append(fraction_numerical(text))
-        features["pii_count"].append(count_PII_items(text))
-        
-        pattern_counts = {}
-        for pattern in patterns:
-            pattern_counts[pattern] = count_pattern(text, pattern)
+    features["dataset_name"] = [name] * len(texts)
+    features["shard"] = [shard] * len(texts)
+    features["shard_index"] = list(indices)
+    features["global_index"] = [ind + offset for ind in indices]
+    features.update(document_statistics(texts))
+
+    pattern_counter = get_pattern_counter(patterns, word_lists)
+    for text in texts:
+        pattern_counts, word_list_counts = pattern_counter.count(text)
         features["pattern_counts"].append(pattern_counts)
-        
-        word_list_counts = {}
-        for word_list_key, word_list in word_lists.items():
-            word_list_counts[word_list_key] = count_word_list(text, word_list)
         features["word_list_counts"].append(word_list_counts)
 
-        tokenized = TOKENIZERS["neox"].encode(text)
-        features["n_tokens_neox"].append(len(tokenized))
-
         words = get_normalized_words(text)
         features["n_words"].append(len(words))
 
@@ -165,7 +317,133 @@ def preprocess(
         features["transformed_text"].append(transformed_text)
         features["substrings_counts"].append(count_substrings(transformed_text))
 
-    return features 
+        if shingle_width is not None:
+            features[shingle_hashes_column(shingle_width)].append(shingle_hashes(text, transformed_text, words, shingle_width))
+
+    if with_token_counts:
+        features["n_tokens_neox"] = count_tokens(texts, "neox")
+
+    return features
+
+
+def preprocess_staged(
+    batch,
+    indices,
+    key: str,
+    name: str,
+    shard: int,
+    offset: int,
+    patterns: list = PATTERNS,
+    word_lists: dict = WORD_LISTS,
+    with_token_counts: bool = True,
+    shingle_width: Optional[int] = None,
+) -> Dict[str, List]:
+    """
+    Same as preprocess() followed by filter(), but features are computed in the order of their cost,
+    and every feature is only computed for documents that passed all filtering rules checked so far.
+    Rejected documents get placeholder features and the name of the rule that rejected them in rejected_by column.
+    Kept documents have None in rejected_by column and exactly the same features as preprocess() produces.
+    """
+    texts = batch[key]
+    rows = [{} for _ in texts]
+    rejected_by = [None] * len(texts)
+    alive = list(range(len(texts)))
+
+    def apply_rule(check) -> List[int]:
+        for i in alive:
+            rejected_by[i] = check(rows[i])
+        return [i for i in alive if rejected_by[i] is None]
+
+    for i in alive:
+        rows[i]["transformed_text"] = transform(texts[i])
+    alive = apply_rule(check_length)
+
+    statistics = document_statistics([texts[i] for i in alive])
+    for j, i in enumerate(alive):
+        for feature, values in statistics.items():
+            rows[i][feature] = values[j]
+    alive = apply_rule(check_document_statistics)
+
+    for i in alive:
+        rows[i]["substrings_counts"] = count_substrings(rows[i]["transformed_text"])
+    alive = apply_rule(check_substrings)
+
+    pattern_counter = get_pattern_counter(patterns, word_lists)
+    for i in alive:
+        rows[i]["pattern_counts"], rows[i]["word_list_counts"] = pattern_counter.count(texts[i])
+    alive = apply_rule(check_patterns)
+
+    for i in alive:
+        words = get_normalized_words(texts[i])
+        rows[i]["n_words"] = len(words)
+        if shingle_width is not None:
+            rows[i][shingle_hashes_column(shingle_width)] = shingle_hashes(texts[i], rows[i]["transformed_text"], words, shingle_width)
+    if with_token_counts:
+        for i, n_tokens in zip(alive, count_tokens([texts[i] for i in alive], "neox")):
+            rows[i]["n_tokens_neox"] = n_tokens
+
+    placeholders = {
+        "mean_word_length": 0.0,
+        "fraction_non_alphanumeric": 0.0,
+        "fraction_numerical": 0.0,
+        "pii_count": 0,
+        "pattern_counts": dict.fromkeys(patterns, 0),
+        "word_list_counts": dict.fromkeys(word_lists, 0),
+        "n_words": 0,
+        "transformed_text": "",
+        "substrings_counts": 0,
+    }
+    if with_token_counts:
+        placeholders["n_tokens_neox"] = 0
+    if shingle_width is not None:
+        placeholders[shingle_hashes_column(shingle_width)] = np.zeros(0, dtype=np.uint32)
+
+    features = {}
+    features["dataset_name"] = [name] * len(texts)
+    features["shard"] = [shard] * len(texts)
+    features["shard_index"] = list(indices)
+    features["global_index"] = [ind + offset for ind in indices]
+    for feature, placeholder in placeholders.items():
+        features[feature] = [row.get(feature, placeholder) for row in rows]
+    features["rejected_by"] = rejected_by
+    return features
+
+
+def staged_features(
+    input_features: datasets.Features,
+    patterns: list = PATTERNS,
+    word_lists: dict = WORD_LISTS,
+    with_token_counts: bool = True,
+    shingle_width: Optional[int] = None,
+) -> datasets.Features:
+    """
+    Returns features of input columns followed by the same features as preprocess() produces, and rejected_by column.
+    Types have to be given to map() with preprocess_staged(), or else a batch without rejections types rejected_by as null,
+    and a later batch with rejections fails to be cast to it.
+    """
+    features = datasets.Features(input_features)
+    features.update({
+        "dataset_name": datasets.Value("string"),
+        "shard": datasets.Value("int64"),
+        "shard_index": datasets.Value("int64"),
+        "global_index": datasets.Value("int64"),
+        "mean_word_length": datasets.Value("float64"),
+        "fraction_non_alphanumeric": datasets.Value("float64"),
+        "fraction_numerical": datasets.Value("float64"),
+        "pii_count": datasets.Value("int64"),
+        # fields of structs are sorted, as when datasets infers them from dicts returned by preprocess()
+        "pattern_counts": {pattern: datasets.Value("int64") for pattern in sorted(patterns)},
+        "word_list_counts": {word_list_key: datasets.Value("int64") for word_list_key in sorted(word_lists)},
+        "n_words": datasets.Value("int64"),
+        "transformed_text": datasets.Value("string"),
+        "substrings_counts": datasets.Value("int64"),
+    })
+    if shingle_width is not None:
+        features[shingle_hashes_column(shingle_width)] = datasets.Sequence(datasets.Value("uint32"))
+    if with_token_counts:
+        features["n_tokens_neox"] = datasets.Value("int64")
+    features["rejected_by"] = datasets.Value("string")
+    return features
 
 
 if __name__ == '__main__':
@@ -180,10 +458,27 @@ if __name__ == '__main__':
     parser.add_argument('--keep-key', action='store_true', help='If specified, key column will be saved in shards')
     parser.add_argument('--save-path', type=str, required=True, help='Folder to save processed HF dataset to')
     parser.add_argument('--from-scratch', action='store_true', help='If specified, will forcefully do every shard regardless of previous progress')
+    parser.add_argument('--skip-token-count', action='store_true', help='If specified, n_tokens_neox will not be computed')
+    parser.add_argument(
+        '--skip-filtering', action='store_true',
+        help='If specified, all documents are saved with their features, e.g. for sweeping filtering thresholds with refilter.py'
+    )
+    parser.add_argument(
+        '--staged-filtering', action='store_true',
+        help='If specified, filtering rules are checked while computing features, so that expensive features are not computed for rejected documents'
+    )
+    parser.add_argument(
+        '--shingle-width', type=int, default=None,
+        help='If specified, hashes of normalized n-grams of this size are saved, so that compute_minhash.py --use-shingle-hashes can skip text processing'
+    )
 
     args = parser.parse_args()
     print()
 
+    if args.num_proc > 1:
+        # every worker tokenizes its own batches, so avoid oversubscribing cores with tokenizers' thread pools
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
     logging.info(f"Loading {args.hf_path}, dir={args.hf_dir}")
     if args.load_from_disk:
         dataset = datasets.load_from_disk(args.hf_path)
@@ -210,21 +505,55 @@ if __name__ == '__main__':
         ds_shard = dataset.shard(num_shards=num_shards, index=i, contiguous=True)
         logging.info(f"Cache cleaned: {ds_shard.cleanup_cache_files()}")
 
+        skip_filtering = args.skip_filtering or "starcoder" in args.name
+        if "starcoder" in args.name:
+            logging.info(f"Starcoder detected: skipping filtering")
+        staged = args.staged_filtering and not skip_filtering
+
         logging.info(f"Preprocessing...")
+        preprocess_fn = preprocess_staged if staged else preprocess
+        features = None
+        if staged:
+            input_features = {column: feature for column, feature in ds_shard.features.items() if args.keep_key or column != args.key}
+            features = staged_features(input_features, with_token_counts=not args.skip_token_count, shingle_width=args.shingle_width)
         ds_shard_post = ds_shard.map(
-            lambda batch, indices: preprocess(batch, indices, shard=i, offset=offset, key=args.key, name=args.name),
+            lambda batch, indices: preprocess_fn(
+                batch, indices, shard=i, offset=offset, key=args.key, name=args.name,
+                with_token_counts=not args.skip_token_count, shingle_width=args.shingle_width,
+            ),
             batched=True,
             with_indices=True,
             remove_columns=None if args.keep_key else args.key,
+            features=features,
             num_proc=args.num_proc,
         )
 
-        if "starcoder" in args.name:
-            logging.info(f"Starcoder detected: skipping filtering")
-        else:
+        rejection_counts = None
+        if staged:
+            rejection_counts = {
+                item["values"]: item["counts"]
+                for item in ds_shard_post.data.column("rejected_by").value_counts().to_pylist()
+                if item["values"] is not None
+            }
+            logging.info(f"Rejected documents per filtering rule: {rejection_counts}")
+            ds_shard_post = ds_shard_post.filter(
+                lambda rejected_by: [rule is None for rule in rejected_by],
+                input_columns="rejected_by",
+                batched=True,
+                num_proc=args.num_proc,
+            )
+            ds_shard_post = ds_shard_post.remove_columns("rejected_by")
+        elif not skip_filtering:
             logging.info(f"Filtering...")
-            ds_shard_post = ds_shard_post.filter(lambda row: filter(row), num_proc=args.num_proc)
+            ds_shard_post = ds_shard_post.with_format("arrow").filter(
+                lambda batch: filter_batch(batch),
+                batched=True,
+                num_proc=args.num_proc,
+            ).with_format(None)
 
         offset += len(ds_shard_post)
         ds_shard_post.save_to_disk(save_path, max_shard_size="8GB")
+        if rejection_counts is not None:
+            with open(os.path.join(save_path, "rejection_counts.json"), "w") as f:
+                json.dump(rejection_counts, f, indent=4)
         logging.info(f"Cache cleaned: {ds_shard.cleanup_cache_files()}")
@@ -0,0 +1,123 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import argparse
+import json
+import numpy as np
+import datasets
+import tqdm
+
+from zyda.utils.common import ensure_directory_exists
+from zyda.utils.filtering import (
+    MIN_LENGTH,
+    MIN_MEAN_WORD_LENGTH,
+    MAX_MEAN_WORD_LENGTH,
+    MAX_FRACTION_NON_ALPHANUMERIC,
+    MAX_FRACTION_NUMERICAL,
+    MAX_NUM_REPEATED_SUBSTRINGS,
+    PATTERNS_WITH_MAX_COUNTS,
+    PATTERNS_WITH_MAX_FRACTIONS,
+    WORD_LISTS_WITH_MAX_COUNTS,
+    WORD_LISTS_WITH_MAX_FRACTIONS,
+    filter_batch,
+)
+
+import logging
+logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO)
+
+FILTERING_COLUMNS = [
+    "global_index",
+    "mean_word_length",
+    "fraction_non_alphanumeric",
+    "fraction_numerical",
+    "substrings_counts",
+    "pattern_counts",
+    "word_list_counts",
+]
+SUMMARY_FILE = "selection.json"
+
+
+def save_selection_bitmap(save_path: str, mask: np.ndarray):
+    ensure_directory_exists(save_path)
+    np.save(save_path, np.packbits(mask))
+
+
+def load_selection_bitmap(save_path: str, shard_dir: str) -> np.ndarray:
+    """
+    Returns a boolean mask of rows of a shard selected by refilter.py.
+    """
+    with open(os.path.join(save_path, SUMMARY_FILE), "r") as f:
+        summary = json.load(f)
+    bits = np.load(os.path.join(save_path, f"{shard_dir}.npy"))
+    return np.unpackbits(bits, count=summary["shards"][shard_dir]["rows"]).astype(bool)
+
+
+def refilter_shard(shard: datasets.Dataset, key: str, batch_size: int, thresholds: dict) -> np.ndarray:
+    table = shard.select_columns([key] + FILTERING_COLUMNS).data
+    masks = [filter_batch(batch, key=key, **thresholds) for batch in table.to_batches(max_chunksize=batch_size)]
+    return np.concatenate(masks) if masks else np.zeros(0, dtype=bool)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load-path', type=str, required=True, help='Path to folder with preprocessed shards (ideally saved with --skip-filtering)')
+    parser.add_argument('--save-path', type=str, required=True, help='Folder to save selection bitmaps to')
+    parser.add_argument('--key', type=str, default='transformed_text', help='Key of the text column used for length-based thresholds')
+    parser.add_argument('--batch-size', type=int, default=100_000, help='Number of rows per Arrow record batch')
+    parser.add_argument('--min-length', type=int, default=MIN_LENGTH)
+    parser.add_argument('--min-mean-word-length', type=float, default=MIN_MEAN_WORD_LENGTH)
+    parser.add_argument('--max-mean-word-length', type=float, default=MAX_MEAN_WORD_LENGTH)
+    parser.add_argument('--max-fraction-non-alphanumeric', type=float, default=MAX_FRACTION_NON_ALPHANUMERIC)
+    parser.add_argument('--max-fraction-numerical', type=float, default=MAX_FRACTION_NUMERICAL)
+    parser.add_argument('--max-repeated-substrings', type=int, default=MAX_NUM_REPEATED_SUBSTRINGS)
+    parser.add_argument('--patterns-with-max-counts', type=json.loads, default=PATTERNS_WITH_MAX_COUNTS, help='JSON dict of pattern to max count')
+    parser.add_argument('--patterns-with-max-fractions', type=json.loads, default=PATTERNS_WITH_MAX_FRACTIONS, help='JSON dict of pattern to max fraction')
+    parser.add_argument('--word-lists-with-max-counts', type=json.loads, default=WORD_LISTS_WITH_MAX_COUNTS, help='JSON dict of word list to max count')
+    parser.add_argument('--word-lists-with-max-fractions', type=json.loads, default=WORD_LISTS_WITH_MAX_FRACTIONS, help='JSON dict of word list to max fraction')
+    args = parser.parse_args()
+    print()
+
+    thresholds = {
+        "min_length": args.min_length,
+        "min_mean_word_length": args.min_mean_word_length,
+        "max_mean_word_length": args.max_mean_word_length,
+        "max_fraction_non_alphanumeric": args.max_fraction_non_alphanumeric,
+        "max_fraction_numerical": args.max_fraction_numerical,
+        "max_repeated_substrings": args.max_repeated_substrings,
+        "patterns_with_max_counts": args.patterns_with_max_counts,
+        "patterns_with_max_fractions": args.patterns_with_max_fractions,
+        "word_lists_with_max_counts": args.word_lists_with_max_counts,
+        "word_lists_with_max_fractions": args.word_lists_with_max_fractions,
+    }
+    logging.info(f"Thresholds: {thresholds}")
+
+    shards_dirs = sorted(os.listdir(args.load_path))
+    logging.info(f"Found {len(shards_dirs)} shards")
+    summary = {"key": args.key, "thresholds": thresholds, "shards": {}}
+    total_rows = total_kept = 0
+    for shard_dir in tqdm.tqdm(shards_dirs):
+        shard = datasets.load_from_disk(os.path.join(args.load_path, shard_dir))
+        mask = refilter_shard(shard, args.key, args.batch_size, thresholds)
+        save_selection_bitmap(os.path.join(args.save_path, f"{shard_dir}.npy"), mask)
+        summary["shards"][shard_dir] = {"rows": len(mask), "kept": int(mask.sum())}
+        total_rows += len(mask)
+        total_kept += int(mask.sum())
+
+    summary["rows"] = total_rows
+    summary["kept"] = total_kept
+    with open(os.path.join(args.save_path, SUMMARY_FILE), "w") as f:
+        json.dump(summary, f, indent=4)
+    logging.info(f"Kept {total_kept} / {total_rows} rows ({100 * total_kept / max(total_rows, 1):.2f}%)")
+    logging.info(f"Saved selection bitmaps to {args.save_path}")
@@ -13,6 +13,9 @@
 # limitations under the License.
 
 import os
+import json
+import shutil
+import socket
 import datasets
 import tqdm
 
@@ -41,3 +44,87 @@ class ComboDataset:
 
 def ensure_directory_exists(filename: str):
     os.makedirs(os.path.dirname(filename), exist_ok = True)
+
+
+def write_json_atomic(path: str, data: dict):
+    # written to a temporary file first, so that a file with this path is always complete
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def list_shards(path: str):
+    """
+    Returns sorted names of shard folders, skipping hidden entries such as temporary outputs and lock files.
+    """
+    return sorted(name for name in os.listdir(path) if not name.startswith(".") and os.path.isdir(os.path.join(path, name)))
+
+
+def _lock_owner() -> str:
+    return f"{socket.gethostname()} {os.getpid()}"
+
+
+def _is_stale_lock(lock_path: str) -> bool:
+    # only locks of dead processes on this host can be detected as stale
+    try:
+        with open(lock_path, "r") as f:
+            hostname, pid = f.read().split()
+    except (FileNotFoundError, ValueError):
+        return False
+    if hostname != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def try_lock(lock_path: str) -> bool:
+    """
+    Atomically creates a lock file, so that only one process on any node sharing the filesystem claims a piece of work.
+    Returns False if the lock is held by someone else. Locks left by dead processes of this host are taken over.
+    """
+    ensure_directory_exists(lock_path)
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _is_stale_lock(lock_path):
+                return False
+            try:
+                # renaming is atomic, so only one process takes over a stale lock
+                os.rename(lock_path, f"{lock_path}.stale-{os.getpid()}")
+                os.remove(f"{lock_path}.stale-{os.getpid()}")
+            except FileNotFoundError:
+                return False
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(_lock_owner())
+        return True
+    return False
+
+
+def release_lock(lock_path: str):
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def atomic_output_dir(path: str) -> str:
+    """
+    Returns a hidden temporary folder next to path. Write outputs there and call commit_output_dir(),
+    so that readers never see partially written outputs.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp-{socket.gethostname()}-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return tmp_path
+
+
+def commit_output_dir(tmp_path: str, path: str):
+    os.rename(tmp_path, path)
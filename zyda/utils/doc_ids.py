@@ -0,0 +1,151 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Optional, Tuple
+import os
+import json
+import numpy as np
+import datasets
+
+from zyda.utils.common import ensure_directory_exists, list_shards
+
+# Document ids are packed into uint64: index of the dataset in the registry in the top bits, row position in the dataset in the rest
+ROW_BITS = 40
+MAX_DATASETS = 1 << (64 - ROW_BITS)
+MAX_ROWS = 1 << ROW_BITS
+ROW_MASK = np.uint64(MAX_ROWS - 1)
+NO_DOC = np.uint64(np.iinfo(np.uint64).max)
+
+KEY_COLUMNS = ["dataset_name", "shard", "shard_index", "global_index"]
+
+
+def pack_doc_ids(dataset_idx, rows) -> np.ndarray:
+    return (np.uint64(dataset_idx) << np.uint64(ROW_BITS)) | np.asarray(rows, dtype=np.uint64)
+
+
+def unpack_doc_ids(doc_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    doc_ids = np.asarray(doc_ids, dtype=np.uint64)
+    return (doc_ids >> np.uint64(ROW_BITS)).astype(np.int64), (doc_ids & ROW_MASK).astype(np.int64)
+
+
+def parse_pair(line: str) -> Tuple[int, int]:
+    """
+    Parses a "<doc id> :: <doc id>" line of duplicate pairs files written by build_lsh_index.py.
+    """
+    a, b = line.split(" :: ")
+    try:
+        return int(a), int(b)
+    except ValueError:
+        raise ValueError(f"Duplicate pair {line.strip()!r} is not a pair of document ids: pairs files written with string keys have to be regenerated") from None
+
+
+def load_sharded_dataset(path: str) -> datasets.Dataset:
+    return datasets.concatenate_datasets([datasets.load_from_disk(os.path.join(path, shard_dir)) for shard_dir in list_shards(path)])
+
+
+class DocRegistry:
+    """
+    Ordered list of folders with minhash shards. The id of a document is its row position in the concatenation of shards
+    of its folder, packed together with the index of the folder. Folders are only ever appended, so ids stay valid
+    when an LSH index is extended with new datasets.
+    """
+    def __init__(self, paths: Optional[List[str]] = None):
+        self.paths = []
+        self.num_rows = []
+        self._datasets = {}
+        for path in paths or []:
+            self.add(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path: str, num_rows: Optional[int] = None) -> int:
+        path = os.path.abspath(path)
+        if path in self.paths:
+            return self.paths.index(path)
+        if len(self.paths) == MAX_DATASETS:
+            raise ValueError(f"Registry can't have more than {MAX_DATASETS} datasets")
+        if num_rows is None:
+            num_rows = len(self.dataset(path))
+        if num_rows > MAX_ROWS:
+            raise ValueError(f"Dataset {path} has {num_rows} rows, which is more than {MAX_ROWS} supported by document ids")
+        self.paths.append(path)
+        self.num_rows.append(num_rows)
+        return len(self.paths) - 1
+
+    def index(self, path: str) -> int:
+        return self.paths.index(os.path.abspath(path))
+
+    def dataset(self, path: str, columns: Tuple[str, ...] = tuple(KEY_COLUMNS)) -> datasets.Dataset:
+        # datasets are memory-mapped, so they are loaded lazily and only once
+        if (path, columns) not in self._datasets:
+            self._datasets[(path, columns)] = load_sharded_dataset(path).select_columns(list(columns)).with_format("arrow")
+        return self._datasets[(path, columns)]
+
+    def _tables(self, doc_ids: np.ndarray, columns: List[str]):
+        # yields positions of documents of each dataset together with a table of their rows
+        dataset_inds, rows = unpack_doc_ids(doc_ids)
+        for dataset_idx in np.unique(dataset_inds):
+            positions = np.flatnonzero(dataset_inds == dataset_idx)
+            # rows are fetched in increasing order, which is faster for memory-mapped datasets
+            positions = positions[np.argsort(rows[positions], kind="stable")]
+            yield positions, self.dataset(self.paths[dataset_idx], tuple(columns))[rows[positions].tolist()]
+
+    def key_columns(self, doc_ids: np.ndarray) -> Dict[str, list]:
+        """
+        Returns values of KEY_COLUMNS of documents, in the order of doc_ids.
+        """
+        columns = {col: [None] * len(doc_ids) for col in KEY_COLUMNS}
+        for positions, table in self._tables(doc_ids, KEY_COLUMNS):
+            for col in KEY_COLUMNS:
+                values = columns[col]
+                for position, value in zip(positions.tolist(), table.column(col).to_pylist()):
+                    values[position] = value
+        return columns
+
+    def hashvalues(self, doc_ids: np.ndarray, num_perm: Optional[int] = None) -> np.ndarray:
+        """
+        Returns minhash signatures of documents as an array of shape (len(doc_ids), num_perm), in the order of doc_ids.
+        If num_perm is not given, it is the length of signatures in datasets.
+        """
+        signatures = None if num_perm is None else np.zeros((len(doc_ids), num_perm), dtype=np.uint64)
+        for positions, table in self._tables(doc_ids, ["hashvalues"]):
+            values = table.column("hashvalues").combine_chunks().flatten().to_numpy().reshape(len(positions), -1)
+            if signatures is None:
+                signatures = np.zeros((len(doc_ids), values.shape[1]), dtype=np.uint64)
+            signatures[positions] = values
+        return signatures if signatures is not None else np.zeros((0, 0), dtype=np.uint64)
+
+    def describe(self, doc_ids: np.ndarray) -> List[str]:
+        """
+        Returns human-readable "dataset_name@shard@shard_index@global_index" keys of documents.
+        """
+        columns = self.key_columns(doc_ids)
+        return ["@".join(map(str, values)) for values in zip(*[columns[col] for col in KEY_COLUMNS])]
+
+    def save(self, path: str):
+        ensure_directory_exists(path)
+        with open(path, "w") as f:
+            json.dump({"row_bits": ROW_BITS, "datasets": [{"path": p, "num_rows": n} for p, n in zip(self.paths, self.num_rows)]}, f, indent=4)
+
+    @classmethod
+    def load(cls, path: str) -> "DocRegistry":
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data["row_bits"] != ROW_BITS:
+            raise ValueError(f"Registry {path} packs document ids with {data['row_bits']} row bits instead of {ROW_BITS}")
+        registry = cls()
+        for dataset in data["datasets"]:
+            registry.add(dataset["path"], num_rows=dataset["num_rows"])
+        return registry
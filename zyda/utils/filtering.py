@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Union
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 FILTERING_FEATURES = ["mean_word_length", "fraction_non_alphanumeric", "fraction_numerical", "pii_count", "pattern_counts", "word_list_counts", "substrings_counts"]
 
@@ -44,61 +47,198 @@ WORD_LISTS_WITH_MAX_FRACTIONS = {
     "cursed_substrings.json": 0.01,
 }
 
-def filter(
+def check_length(
     row,
     key: str = "transformed_text",
-    dupe_inds: Optional[set] = None,
     min_length: int = MIN_LENGTH,
+) -> Optional[str]:
+    if len(row[key]) < min_length:
+        return "min_length"
+    return None
+
+
+def check_document_statistics(
+    row,
     min_mean_word_length: int = MIN_MEAN_WORD_LENGTH,
     max_mean_word_length: int = MAX_MEAN_WORD_LENGTH,
     max_fraction_non_alphanumeric: float = MAX_FRACTION_NON_ALPHANUMERIC,
     max_fraction_numerical: float = MAX_FRACTION_NUMERICAL,
-    max_repeated_substrings: int = MAX_NUM_REPEATED_SUBSTRINGS,
-    patterns_with_max_counts: Dict[str, int] = PATTERNS_WITH_MAX_COUNTS,
-    patterns_with_max_fractions: Dict[str, float] = PATTERNS_WITH_MAX_FRACTIONS,
-    word_lists_with_max_counts: Dict[str, int] = WORD_LISTS_WITH_MAX_COUNTS,
-    word_lists_with_max_fractions: Dict[str, float] = WORD_LISTS_WITH_MAX_FRACTIONS,
-) -> bool:
-    """
-    Given a row, decided whether to remove or keep it.
-    Returns True is the row to be kept, False otherwise.
-    """
-
-    if len(row[key]) < min_length:
-        return False
-    
+) -> Optional[str]:
     if row["mean_word_length"] < min_mean_word_length:
-        return False
+        return "min_mean_word_length"
     
     if row["mean_word_length"] > max_mean_word_length:
-        return False
+        return "max_mean_word_length"
     
     if row["fraction_non_alphanumeric"] > max_fraction_non_alphanumeric:
-        return False
+        return "max_fraction_non_alphanumeric"
     
     if row["fraction_numerical"] > max_fraction_numerical:
-        return False
-    
+        return "max_fraction_numerical"
+    return None
+
+
+def check_substrings(
+    row,
+    max_repeated_substrings: int = MAX_NUM_REPEATED_SUBSTRINGS,
+) -> Optional[str]:
     if row["substrings_counts"] > max_repeated_substrings:
-        return False
+        return "max_repeated_substrings"
+    return None
+
 
+def check_patterns(
+    row,
+    key: str = "transformed_text",
+    patterns_with_max_counts: Dict[str, int] = PATTERNS_WITH_MAX_COUNTS,
+    patterns_with_max_fractions: Dict[str, float] = PATTERNS_WITH_MAX_FRACTIONS,
+    word_lists_with_max_counts: Dict[str, int] = WORD_LISTS_WITH_MAX_COUNTS,
+    word_lists_with_max_fractions: Dict[str, float] = WORD_LISTS_WITH_MAX_FRACTIONS,
+) -> Optional[str]:
     for pattern, max_count in patterns_with_max_counts.items():
         if row["pattern_counts"][pattern] > max_count:
-            return False
+            return f"max_count:{pattern}"
         
     for pattern, max_fraction in patterns_with_max_fractions.items():
         if row["pattern_counts"][pattern] / len(row[key]) > max_fraction:
-            return False
+            return f"max_fraction:{pattern}"
         
     for word_list, max_count in word_lists_with_max_counts.items():
         if row["word_list_counts"][word_list] > max_count:
-            return False
+            return f"max_count:{word_list}"
 
     for word_list, max_fraction in word_lists_with_max_fractions.items():
         if row["word_list_counts"][word_list] / len(row[key]) > max_fraction:
-            return False
+            return f"max_fraction:{word_list}"
+    return None
+
+
+def get_rejection_rule(
+    row,
+    key: str = "transformed_text",
+    dupe_inds: Optional[set] = None,
+    min_length: int = MIN_LENGTH,
+    min_mean_word_length: int = MIN_MEAN_WORD_LENGTH,
+    max_mean_word_length: int = MAX_MEAN_WORD_LENGTH,
+    max_fraction_non_alphanumeric: float = MAX_FRACTION_NON_ALPHANUMERIC,
+    max_fraction_numerical: float = MAX_FRACTION_NUMERICAL,
+    max_repeated_substrings: int = MAX_NUM_REPEATED_SUBSTRINGS,
+    patterns_with_max_counts: Dict[str, int] = PATTERNS_WITH_MAX_COUNTS,
+    patterns_with_max_fractions: Dict[str, float] = PATTERNS_WITH_MAX_FRACTIONS,
+    word_lists_with_max_counts: Dict[str, int] = WORD_LISTS_WITH_MAX_COUNTS,
+    word_lists_with_max_fractions: Dict[str, float] = WORD_LISTS_WITH_MAX_FRACTIONS,
+) -> Optional[str]:
+    """
+    Given a row, returns the name of the first rule that rejects it, or None if the row is to be kept.
+    """
+    rule = (
+        check_length(row, key, min_length)
+        or check_document_statistics(
+            row, min_mean_word_length, max_mean_word_length, max_fraction_non_alphanumeric, max_fraction_numerical,
+        )
+        or check_substrings(row, max_repeated_substrings)
+        or check_patterns(
+            row, key, patterns_with_max_counts, patterns_with_max_fractions, word_lists_with_max_counts, word_lists_with_max_fractions,
+        )
+    )
+    if rule is None and dupe_inds is not None and row["global_index"] in dupe_inds:
+        rule = "dupes"
+    return rule
+
+
+def filter(
+    row,
+    key: str = "transformed_text",
+    dupe_inds: Optional[set] = None,
+    min_length: int = MIN_LENGTH,
+    min_mean_word_length: int = MIN_MEAN_WORD_LENGTH,
+    max_mean_word_length: int = MAX_MEAN_WORD_LENGTH,
+    max_fraction_non_alphanumeric: float = MAX_FRACTION_NON_ALPHANUMERIC,
+    max_fraction_numerical: float = MAX_FRACTION_NUMERICAL,
+    max_repeated_substrings: int = MAX_NUM_REPEATED_SUBSTRINGS,
+    patterns_with_max_counts: Dict[str, int] = PATTERNS_WITH_MAX_COUNTS,
+    patterns_with_max_fractions: Dict[str, float] = PATTERNS_WITH_MAX_FRACTIONS,
+    word_lists_with_max_counts: Dict[str, int] = WORD_LISTS_WITH_MAX_COUNTS,
+    word_lists_with_max_fractions: Dict[str, float] = WORD_LISTS_WITH_MAX_FRACTIONS,
+) -> bool:
+    """
+    Given a row, decided whether to remove or keep it.
+    Returns True is the row to be kept, False otherwise.
+    """
+    rule = get_rejection_rule(
+        row,
+        key=key,
+        dupe_inds=dupe_inds,
+        min_length=min_length,
+        min_mean_word_length=min_mean_word_length,
+        max_mean_word_length=max_mean_word_length,
+        max_fraction_non_alphanumeric=max_fraction_non_alphanumeric,
+        max_fraction_numerical=max_fraction_numerical,
+        max_repeated_substrings=max_repeated_substrings,
+        patterns_with_max_counts=patterns_with_max_counts,
+        patterns_with_max_fractions=patterns_with_max_fractions,
+        word_lists_with_max_counts=word_lists_with_max_counts,
+        word_lists_with_max_fractions=word_lists_with_max_fractions,
+    )
+    return rule is None
+
+
+def _column_to_numpy(array: pa.Array) -> np.ndarray:
+    return array.to_numpy(zero_copy_only=False)
+
+
+def _get_column(batch: Union[pa.Table, pa.RecordBatch], name: str) -> pa.Array:
+    column = batch.column(name)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    return column
+
+
+def filter_batch(
+    batch: Union[pa.Table, pa.RecordBatch],
+    key: str = "transformed_text",
+    dupe_inds: Optional[set] = None,
+    min_length: int = MIN_LENGTH,
+    min_mean_word_length: int = MIN_MEAN_WORD_LENGTH,
+    max_mean_word_length: int = MAX_MEAN_WORD_LENGTH,
+    max_fraction_non_alphanumeric: float = MAX_FRACTION_NON_ALPHANUMERIC,
+    max_fraction_numerical: float = MAX_FRACTION_NUMERICAL,
+    max_repeated_substrings: int = MAX_NUM_REPEATED_SUBSTRINGS,
+    patterns_with_max_counts: Dict[str, int] = PATTERNS_WITH_MAX_COUNTS,
+    patterns_with_max_fractions: Dict[str, float] = PATTERNS_WITH_MAX_FRACTIONS,
+    word_lists_with_max_counts: Dict[str, int] = WORD_LISTS_WITH_MAX_COUNTS,
+    word_lists_with_max_fractions: Dict[str, float] = WORD_LISTS_WITH_MAX_FRACTIONS,
+) -> np.ndarray:
+    """
+    Vectorized version of filter() for a batch of rows in Arrow format.
+    Returns a boolean mask with True for rows to be kept.
+    """
+    lengths = _column_to_numpy(pc.utf8_length(_get_column(batch, key)))
+    keep = ~(lengths < min_length)
+
+    mean_word_length = _column_to_numpy(_get_column(batch, "mean_word_length"))
+    keep &= ~(mean_word_length < min_mean_word_length)
+    keep &= ~(mean_word_length > max_mean_word_length)
+    keep &= ~(_column_to_numpy(_get_column(batch, "fraction_non_alphanumeric")) > max_fraction_non_alphanumeric)
+    keep &= ~(_column_to_numpy(_get_column(batch, "fraction_numerical")) > max_fraction_numerical)
+    keep &= ~(_column_to_numpy(_get_column(batch, "substrings_counts")) > max_repeated_substrings)
+
+    # rows with zero length are already rejected by min_length, so divisions by zero don't matter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pattern_counts = _get_column(batch, "pattern_counts")
+        for pattern, max_count in patterns_with_max_counts.items():
+            keep &= ~(_column_to_numpy(pattern_counts.field(pattern)) > max_count)
+        for pattern, max_fraction in patterns_with_max_fractions.items():
+            keep &= ~(_column_to_numpy(pattern_counts.field(pattern)) / lengths > max_fraction)
+
+        word_list_counts = _get_column(batch, "word_list_counts")
+        for word_list, max_count in word_lists_with_max_counts.items():
+            keep &= ~(_column_to_numpy(word_list_counts.field(word_list)) > max_count)
+        for word_list, max_fraction in word_lists_with_max_fractions.items():
+            keep &= ~(_column_to_numpy(word_list_counts.field(word_list)) / lengths > max_fraction)
 
-    if dupe_inds is not None and row["global_index"] in dupe_inds:
-        return False
+    if dupe_inds is not None:
+        global_index = _column_to_numpy(_get_column(batch, "global_index"))
+        keep &= ~np.isin(global_index, np.fromiter(dupe_inds, dtype=np.int64, count=len(dupe_inds)))
 
-    return True
+    return keep
@@ -0,0 +1,186 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Files of duplicate pairs of document ids come in two formats:
+#   text:   "<doc id> :: <doc id>" lines
+#   binary: PAIRS_MAGIC followed by blocks, each of them a (number of pairs, compressed size) uint64 header
+#           and zstd-compressed little-endian uint64 array of shape (number of pairs, 2)
+
+from typing import Iterator
+import itertools
+import os
+import struct
+import numpy as np
+import zstandard
+
+from zyda.utils.doc_ids import parse_pair
+
+PAIRS_MAGIC = b"ZYDAPAIRS\x00\x01"
+BLOCK_HEADER = struct.Struct("<QQ")
+PAIR_DTYPE = np.dtype("<u8")
+
+PAIRS_FORMATS = ["text", "binary"]
+PAIRS_EXTENSIONS = {"text": ".txt", "binary": ".pairs"}
+
+# Number of pairs compressed into one block: 16MB of uncompressed pairs
+BLOCK_SIZE = 1 << 20
+# Number of lines of text files parsed at once
+TEXT_CHUNK_SIZE = 1 << 20
+COMPRESSION_LEVEL = 3
+# Number of bytes of text files read at once when counting lines
+COUNT_CHUNK_SIZE = 1 << 24
+
+
+class TextPairWriter:
+    def __init__(self, path: str, append: bool = False):
+        self.f = open(path, "a" if append else "w")
+
+    def write(self, a: np.ndarray, b: np.ndarray):
+        self.f.writelines(f"{x} :: {y}\n" for x, y in zip(a.tolist(), b.tolist()))
+
+    def sync(self) -> int:
+        """
+        Writes all pairs to disk and returns the size of the file.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BinaryPairWriter:
+    """
+    Buffers pairs and writes them to compressed blocks of block_size pairs.
+    With append, blocks are appended to an existing file, which must end with a complete block.
+    """
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE, level: int = COMPRESSION_LEVEL, append: bool = False):
+        self.f = open(path, "ab" if append else "wb")
+        if self.f.tell() == 0:
+            self.f.write(PAIRS_MAGIC)
+        self.block_size = block_size
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.buffer = np.empty((block_size, 2), dtype=PAIR_DTYPE)
+        self.n = 0
+
+    def write(self, a: np.ndarray, b: np.ndarray):
+        start = 0
+        while start < len(a):
+            n = min(len(a) - start, self.block_size - self.n)
+            self.buffer[self.n:self.n + n, 0] = a[start:start + n]
+            self.buffer[self.n:self.n + n, 1] = b[start:start + n]
+            self.n += n
+            start += n
+            if self.n == self.block_size:
+                self.flush()
+
+    def flush(self):
+        if self.n == 0:
+            return
+        data = self.compressor.compress(self.buffer[:self.n].tobytes())
+        self.f.write(BLOCK_HEADER.pack(self.n, len(data)))
+        self.f.write(data)
+        self.n = 0
+
+    def sync(self) -> int:
+        """
+        Writes buffered pairs as a block and all blocks to disk, and returns the size of the file.
+        """
+        self.flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_pair_writer(path: str, pairs_format: str = "text", append: bool = False):
+    if pairs_format == "binary":
+        return BinaryPairWriter(path, append=append)
+    return TextPairWriter(path, append=append)
+
+
+def is_binary_pairs(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(PAIRS_MAGIC)) == PAIRS_MAGIC
+
+
+def count_pairs(path: str) -> int:
+    """
+    Returns the number of pairs in a file without decompressing or parsing them.
+    """
+    n = 0
+    if is_binary_pairs(path):
+        with open(path, "rb") as f:
+            f.seek(len(PAIRS_MAGIC))
+            while header := f.read(BLOCK_HEADER.size):
+                if len(header) < BLOCK_HEADER.size:
+                    raise ValueError(f"Pairs file {path} is truncated")
+                num_pairs, size = BLOCK_HEADER.unpack(header)
+                n += num_pairs
+                f.seek(size, os.SEEK_CUR)
+    else:
+        with open(path, "rb") as f:
+            while data := f.read(COUNT_CHUNK_SIZE):
+                n += data.count(b"\n")
+    return n
+
+
+def read_binary_pairs(path: str) -> Iterator[np.ndarray]:
+    decompressor = zstandard.ZstdDecompressor()
+    with open(path, "rb") as f:
+        f.read(len(PAIRS_MAGIC))
+        while header := f.read(BLOCK_HEADER.size):
+            if len(header) < BLOCK_HEADER.size:
+                raise ValueError(f"Pairs file {path} is truncated")
+            n, size = BLOCK_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                raise ValueError(f"Pairs file {path} is truncated")
+            yield np.frombuffer(decompressor.decompress(data, max_output_size=n * 2 * PAIR_DTYPE.itemsize), dtype=PAIR_DTYPE).reshape(n, 2)
+
+
+def read_text_pairs(path: str, chunk_size: int = TEXT_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    with open(path, "r") as f:
+        while lines := list(itertools.islice(f, chunk_size)):
+            try:
+                pairs = np.array(" ".join(lines).replace(" :: ", " ").split(), dtype=PAIR_DTYPE).reshape(-1, 2)
+            except ValueError:
+                # parse_pair() explains which line is not a pair of document ids
+                pairs = np.array([parse_pair(line) for line in lines], dtype=PAIR_DTYPE)
+            yield pairs
+
+
+def read_pairs(path: str) -> Iterator[np.ndarray]:
+    """
+    Yields duplicate pairs of a file in either format as uint64 arrays of shape (n, 2).
+    """
+    if is_binary_pairs(path):
+        return read_binary_pairs(path)
+    return read_text_pairs(path)
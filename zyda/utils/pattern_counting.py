@@ -0,0 +1,183 @@
+# Copyright 2024 Zyphra Technologies.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Dict, List, Optional, Tuple
+import ahocorasick
+
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]|()")
+REGEX_QUANTIFIERS = set("*?{")
+MIN_PROBE_LENGTH = 2
+
+
+def regex_to_literal(pattern: str) -> Optional[str]:
+    """
+    Returns the string matched by a regex pattern if the pattern is a plain literal, None otherwise.
+    """
+    literal = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                return None
+            literal.append(pattern[i + 1])
+            i += 2
+        elif c in REGEX_SPECIAL_CHARS:
+            return None
+        else:
+            literal.append(c)
+            i += 1
+    return "".join(literal) or None
+
+
+def has_border(literal: str) -> bool:
+    """
+    Returns True if two occurrences of the literal can overlap, i.e. it has a proper prefix that is also its suffix.
+    """
+    return any(literal[:i] == literal[-i:] for i in range(1, len(literal)))
+
+
+def required_literal(pattern: str) -> Optional[str]:
+    """
+    Returns the longest literal substring that every match of a regex pattern has to contain.
+    Returns None if no such substring can be extracted with a simple left-to-right scan.
+    """
+    if "|" in pattern or "(" in pattern:
+        return None
+    runs = []
+    run = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 == len(pattern):
+                return None
+            if pattern[i + 1].isalnum():
+                runs.append("".join(run))
+                run = []
+            else:
+                run.append(pattern[i + 1])
+            i += 2
+        elif c in REGEX_QUANTIFIERS:
+            # the preceding character is optional or repeated, so it is not part of a required run
+            run = run[:-1]
+            runs.append("".join(run))
+            run = []
+            if c == "{":
+                i = pattern.find("}", i)
+                if i == -1:
+                    return None
+            i += 1
+        elif c == "+":
+            runs.append("".join(run))
+            run = []
+            i += 1
+        elif c == "[":
+            runs.append("".join(run))
+            run = []
+            j = i + 1
+            while j < len(pattern) and pattern[j] != "]":
+                j += 2 if pattern[j] == "\\" else 1
+            if j >= len(pattern):
+                return None
+            i = j + 1
+        elif c in REGEX_SPECIAL_CHARS:
+            runs.append("".join(run))
+            run = []
+            i += 1
+        else:
+            run.append(c)
+            i += 1
+    runs.append("".join(run))
+    longest = max(runs, key=len)
+    return longest or None
+
+
+class PatternCounter:
+    """
+    Counts occurrences of patterns and of words from word lists in a single pass over the text.
+
+    Produces the same counts as running re.findall() for every pattern and every word: plain
+    literals are matched with an Aho-Corasick automaton, while the few patterns using regex
+    syntax are still run with re, but only if their required literal was found by the automaton.
+    """
+    def __init__(self, patterns: List[str], word_lists: Dict[str, List[str]]):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.word_lists_keys = list(word_lists.keys())
+
+        self.automaton = ahocorasick.Automaton()
+        self.literals = []
+        self.literals_slots = []
+        self.regexes = []
+
+        slots = [(pattern, [pattern]) for pattern in self.patterns]
+        slots += [(word_list_key, word_list) for word_list_key, word_list in word_lists.items()]
+        for slot, (_, words) in enumerate(slots):
+            for word in words:
+                literal = regex_to_literal(word)
+                if literal is not None:
+                    self.literals_slots[self._add_literal(literal)].append(slot)
+                else:
+                    probe = required_literal(word)
+                    # probes like a single space would match almost everywhere, so it's cheaper to always run the regex
+                    if probe is None or len(probe.strip()) < MIN_PROBE_LENGTH:
+                        probe_idx = None
+                    else:
+                        probe_idx = self._add_literal(probe)
+                    self.regexes.append((re.compile(word), slot, probe_idx))
+        self.n_slots = len(slots)
+
+        if self.literals:
+            self.automaton.make_automaton()
+
+    def _add_literal(self, literal: str) -> int:
+        value = self.automaton.get(literal, None)
+        if value is not None:
+            idx = value[0]
+        else:
+            idx = len(self.literals)
+            self.automaton.add_word(literal, (idx, len(literal), has_border(literal)))
+            self.literals.append(literal)
+            self.literals_slots.append([])
+        return idx
+
+    def count_literals(self, text: str) -> Dict[int, int]:
+        # re.findall() counts non-overlapping matches, so take occurrences of a literal greedily from the left
+        found = {}
+        last_end = {}
+        if not self.literals:
+            return found
+        for end, (idx, length, overlapping) in self.automaton.iter(text):
+            if overlapping:
+                if end - length + 1 < last_end.get(idx, 0):
+                    continue
+                last_end[idx] = end + 1
+            found[idx] = found.get(idx, 0) + 1
+        return found
+
+    def count(self, text: str) -> Tuple[Dict[str, int], Dict[str, int]]:
+        counts = [0] * self.n_slots
+        found = self.count_literals(text)
+        for idx, n in found.items():
+            for slot in self.literals_slots[idx]:
+                counts[slot] += n
+        for regex, slot, probe_idx in self.regexes:
+            if probe_idx is None or probe_idx in found:
+                counts[slot] += len(regex.findall(text))
+
+        n_patterns = len(self.patterns)
+        pattern_counts = dict(zip(self.patterns, counts[:n_patterns]))
+        word_list_counts = dict(zip(self.word_lists_keys, counts[n_patterns:]))
+        return pattern_counts, word_list_counts
@@ -13,24 +13,92 @@
 # limitations under the License.
 
 import string
+import hashlib
 import ftfy
 import re
+import numpy as np
 import nltk
+from nltk.tokenize.destructive import NLTKWordTokenizer
 nltk.download('punkt')
 
-# Inspired by: https://github.com/Cerebras/modelzoo/blob/0bb30b6e681e792f3ba1804835d3f966a7ec9611/src/cerebras/modelzoo/data_preparation/nlp/slimpajama/dedup/to_hash.py#L32
-def get_normalized_words(s: str):
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+WHITESPACE = re.compile(r"\s+")
+
+# ftfy.fix_text() leaves a string untouched unless it has non-ASCII characters, control characters
+# other than tab, newline and form feed, or '&' (which may start an HTML entity)
+NEEDS_FTFY = re.compile(r"[^\t\n\x0c\x20-\x25\x27-\x7e]")
+
+# After punctuation removal, the only rules of nltk.word_tokenize() that can still apply are the
+# padding of unicode quotes and the splitting of contractions like "cannot" -> "can not".
+# Punkt only splits sentences on '.', '?' and '!', so sentence splitting is a no-op as well.
+UNICODE_QUOTES = re.compile("[«“‘„»”’]")
+CONTRACTIONS = ("cannot", "gimme", "gonna", "gotta", "lemme", "wanna")
+
+
+def needs_ftfy(s: str) -> bool:
+    return NEEDS_FTFY.search(s) is not None
+
+
+def tokenize_normalized(s: str):
+    """
+    Returns the same tokens as nltk.word_tokenize() for a string that was lower cased and stripped of
+    punctuation and repeated whitespace by normalize().
+    """
+    is_ascii = s.isascii()
+    if not is_ascii:
+        s = UNICODE_QUOTES.sub(r" \g<0> ", s)
+    # case-insensitive matching of contractions may also match non-ASCII letters like 'ı'
+    if not is_ascii or any(word in s for word in CONTRACTIONS):
+        s = " " + s + " "
+        for regexp in NLTKWordTokenizer.CONTRACTIONS2:
+            s = regexp.sub(r" \1 \2 ", s)
+    return s.split()
+
+
+def normalize(s: str, fast: bool = True) -> str:
     # normalize string
-    s = ftfy.fix_text(s, normalization="NFC")
+    if not fast or needs_ftfy(s):
+        s = ftfy.fix_text(s, normalization="NFC")
     # lower cased
     s = s.lower()
     # remove punctuation
-    s = s.translate(str.maketrans("", "", string.punctuation))
+    s = s.translate(PUNCTUATION_TABLE)
     # remove consecutive spaces, newlines, tabs in the middle and in the beginning / end
-    s = re.sub(r"\s+", " ", s.strip())
+    return WHITESPACE.sub(" ", s.strip())
+
+
+# Inspired by: https://github.com/Cerebras/modelzoo/blob/0bb30b6e681e792f3ba1804835d3f966a7ec9611/src/cerebras/modelzoo/data_preparation/nlp/slimpajama/dedup/to_hash.py#L32
+def get_normalized_words(s: str, fast: bool = True):
+    """
+    With fast=True, ftfy is skipped for texts it would not change and nltk.word_tokenize() is replaced
+    by an equivalent whitespace split. fast=False runs the full ftfy + NLTK pipeline.
+    """
+    s = normalize(s, fast=fast)
     # return words
-    return nltk.word_tokenize(s)
+    return tokenize_normalized(s) if fast else nltk.word_tokenize(s)
+
+
+def get_features(s: str, width: int, fast: bool = True):
+    return map(lambda x: " ".join(x), nltk.ngrams(get_normalized_words(s, fast=fast), width))
+
+
+def shingle_hashes_column(width: int) -> str:
+    return f"shingle_hashes_{width}"
+
+
+def get_shingle_hashes(words, width: int) -> np.ndarray:
+    """
+    Returns 32-bit hashes of the shingles of get_features(), using the same hash function as datasketch.MinHash,
+    so that minhashes computed from them are identical to minhashes computed from the text.
+    """
+    return hash_shingles(" ".join(x).encode('utf8') for x in nltk.ngrams(words, width))
 
 
-def get_features(s: str, width: int):
-    return map(lambda x: " ".join(x), nltk.ngrams(get_normalized_words(s), width))
+def hash_shingles(shingles) -> np.ndarray:
+    """
+    Same as [datasketch.hashfunc.sha1_hash32(s) for s in shingles], i.e. the first 4 bytes of SHA-1 as
+    little-endian uint32, but unpacks all digests at once instead of calling struct.unpack() per shingle.
+    """
+    digests = b"".join([hashlib.sha1(shingle).digest() for shingle in shingles])
+    # SHA-1 digests are 20 bytes long, so every 5th uint32 is the start of a digest
+    return np.frombuffer(digests, dtype="<u4")[::5].astype(np.uint32)
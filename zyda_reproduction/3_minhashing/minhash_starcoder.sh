@@ -1,32 +1,18 @@
 #!/bin/bash
 
+# All datasets are processed by one pool of workers. The same command can be run on several nodes at once:
+# chunks of shards are claimed with lock files in the save paths.
 python $REPO_BASE/zyda/lsh_minhash/compute_minhash.py \
-    --load-path $DATA_BASE/processed/starcoder-languages \
-    --save-path $DATA_BASE/minhash/starcoder-languages \
-    --num-proc $NUM_PROC \
-    --width 13 \
-    --num-perm 128 \
-    --key content
-
-python $REPO_BASE/zyda/lsh_minhash/compute_minhash.py \
-    --load-path $DATA_BASE/processed/starcoder-github-issues-filtered-structured \
-    --save-path $DATA_BASE/minhash/starcoder-github-issues-filtered-structured \
-    --num-proc $NUM_PROC \
-    --width 13 \
-    --num-perm 128 \
-    --key content
-
-python $REPO_BASE/zyda/lsh_minhash/compute_minhash.py \
-    --load-path $DATA_BASE/processed/starcoder-jupyter-structured-clean-dedup \
-    --save-path $DATA_BASE/minhash/starcoder-jupyter-structured-clean-dedup \
-    --num-proc $NUM_PROC \
-    --width 13 \
-    --num-perm 128 \
-    --key content
-
-python $REPO_BASE/zyda/lsh_minhash/compute_minhash.py \
-    --load-path $DATA_BASE/processed/starcoder-git-commits-cleaned \
-    --save-path $DATA_BASE/minhash/starcoder-git-commits-cleaned \
+    --load-path \
+        $DATA_BASE/processed/starcoder-languages \
+        $DATA_BASE/processed/starcoder-github-issues-filtered-structured \
+        $DATA_BASE/processed/starcoder-jupyter-structured-clean-dedup \
+        $DATA_BASE/processed/starcoder-git-commits-cleaned \
+    --save-path \
+        $DATA_BASE/minhash/starcoder-languages \
+        $DATA_BASE/minhash/starcoder-github-issues-filtered-structured \
+        $DATA_BASE/minhash/starcoder-jupyter-structured-clean-dedup \
+        $DATA_BASE/minhash/starcoder-git-commits-cleaned \
     --num-proc $NUM_PROC \
     --width 13 \
     --num-perm 128 \
@@ -20,7 +20,7 @@ python $REPO_BASE/zyda/lsh_minhash/build_lsh_index.py \
         $DATA_BASE/minhash/starcoder-github-issues-filtered-structured \
         $DATA_BASE/minhash/starcoder-jupyter-structured-clean-dedup \
     --dupes-out $LSH_OUT_DIR/dupes/all_pairs.txt \
-    --lsh-out $LSH_OUT_DIR/lsh_index.pickle \
+    --lsh-out $LSH_OUT_DIR/lsh_index \
     --range $RANGE \
     --bands $BANDS \
     --bands-parallel 2 \
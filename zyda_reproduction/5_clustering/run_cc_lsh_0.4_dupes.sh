@@ -3,6 +3,7 @@
 INPUT_DIR=$DATA_BASE/lsh_0.4/dupes
 CC_PICKLE=$DATA_BASE/lsh_0.4/dupes/output/cc.pickle
 DUPES_PICKLE=$DATA_BASE/lsh_0.4/dupes/output/dupes.pickle
+REGISTRY=$DATA_BASE/lsh_0.4/dupes/all_pairs-registry.json
 
 WORKERS=2
 
@@ -13,6 +14,7 @@ python $REPO_BASE/zyda/connected_components/generate_connected_components.py \
 
 python $REPO_BASE/zyda/connected_components/generate_indices_to_remove.py \
     --input-file $CC_PICKLE \
+    --registry $REGISTRY \
     --out-file $DUPES_PICKLE \
     --ranking \
         starcoder-languages \